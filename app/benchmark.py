@@ -0,0 +1,374 @@
+"""Latency and throughput benchmark for the routes of app.main.
+
+Requests run in-process through an ASGI transport, or against a running
+server with --url. Query parameters cycle through pharmacies, users, masks
+and dates sampled from the database, so repeated requests are not all the
+same. Results are written as JSON, and --compare reports the routes whose
+latency or throughput got worse than a previous result file.
+
+    python -m app.benchmark --requests 500 --concurrency 16 --output bench.json
+    uvicorn app.main:app &
+    python -m app.benchmark --url http://127.0.0.1:8000 --compare bench.json
+
+--serialization N instead times encoding an N-row mask_count response the
+way FastAPI does for a route returning schema objects, against the
+orjson path of app.serialization.
+"""
+import argparse
+import asyncio
+import json
+import math
+import platform
+import sys
+import time
+from dataclasses import dataclass
+from datetime import datetime, timedelta
+from datetime import time as clock
+from typing import Callable, List, Optional, Tuple
+from urllib.parse import quote
+
+import httpx
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+from sqlalchemy import func
+
+from app import models, schemas
+from app.partitions import history_tables
+from app.serialization import page_response, rows_as_dicts
+from app.utils import DAY_ORDER
+
+PERCENTILES = (50, 90, 95, 99)
+# a route regresses when p50/p95 latency grows, or throughput drops, by more than this
+DEFAULT_THRESHOLD = 0.2
+SAMPLE_SIZE = 200
+# orders per POST /purchase/batch request
+BATCH_ORDERS = 20
+
+
+@dataclass
+class Samples:
+    pharmacy_names: List[str]
+    user_ids: List[int]
+    masks: List[Tuple[int, int]]  # (pharmacy_id, mask_id)
+    products: List[Tuple[int, str]]  # (product_id, name)
+    keywords: List[str]
+    first_day: datetime
+    last_day: datetime
+
+
+@dataclass
+class Route:
+    name: str
+    method: str
+    # (samples, request number) -> (url, json body)
+    build: Callable[[Samples, int], Tuple[str, Optional[object]]]
+    writes: bool = False
+
+
+def pick(values: list, i: int):
+    return values[i % len(values)]
+
+
+def day_range(samples: Samples, i: int) -> str:
+    span = max((samples.last_day - samples.first_day).days, 0)
+    start = samples.first_day + timedelta(days=i % (span + 1))
+    end = min(start + timedelta(days=7), samples.last_day)
+    return f"start_date={start:%Y-%m-%d}&end_date={end:%Y-%m-%d}"
+
+
+def open_slot(i: int) -> Tuple[str, str]:
+    return DAY_ORDER[i % 7], f"{i * 7 % 24:02d}:{i * 13 % 60:02d}"
+
+
+def purchase_order(samples: Samples, i: int) -> dict:
+    pharmacy_id, mask_id = pick(samples.masks, i)
+    return {
+        "user_id": pick(samples.user_ids, i),
+        "purchases": [{"pharmacy_id": pharmacy_id, "mask_id": mask_id, "quantity": 1}]
+    }
+
+
+def cheapest_query(samples: Samples, i: int) -> str:
+    # by id or by name, every other pair also limited to the pharmacies open at a time
+    product_id, name = pick(samples.products, i)
+    query = f"product_id={product_id}" if i % 2 else f"mask_name={quote(name, safe='')}"
+    if i // 2 % 2:
+        query += "&day={}&time={}".format(*open_slot(i))
+    return f"/masks/cheapest?{query}&top={i % 5 + 1}"
+
+
+ROUTES = [
+    Route("root", "GET", lambda s, i: ("/", None)),
+    Route("pharmacies_open", "GET", lambda s, i: ("/pharmacies/open?day={}&time={}".format(*open_slot(i)), None)),
+    Route("pharmacies_open_now", "GET", lambda s, i: ("/pharmacies/open_now", None)),
+    Route("pharmacies_open_batch", "POST", lambda s, i: (
+        "/pharmacies/open/batch",
+        [{"day": day, "time": at} for day, at in (open_slot(i + k) for k in range(7))]
+    )),
+    Route("pharmacy_masks", "GET", lambda s, i: (
+        f"/pharmacies/{quote(pick(s.pharmacy_names, i), safe='')}/masks?sort_by={('name', 'price')[i % 2]}&order={('asc', 'desc')[i // 2 % 2]}",
+        None
+    )),
+    Route("mask_count", "GET", lambda s, i: (
+        f"/pharmacies/mask_count?min_price={i % 20}&max_price={i % 20 + 15}&count={i % 4}&op={('gt', 'lt')[i % 2]}",
+        None
+    )),
+    Route("masks_cheapest", "GET", lambda s, i: (cheapest_query(s, i), None)),
+    Route("top_users", "GET", lambda s, i: (f"/users/top_users?top={i % 10 + 1}&{day_range(s, i)}", None)),
+    Route("transactions_summary", "GET", lambda s, i: (f"/transactions/summary?{day_range(s, i)}", None)),
+    Route("search", "GET", lambda s, i: (f"/search?keyword={quote(pick(s.keywords, i))}&limit=20", None)),
+    Route("purchases_export", "GET", lambda s, i: (f"/purchases/export?user_id={pick(s.user_ids, i)}", None)),
+    Route("purchase", "POST", lambda s, i: ("/purchase", purchase_order(s, i)), writes=True),
+    Route("purchase_batch", "POST", lambda s, i: (
+        "/purchase/batch",
+        [purchase_order(s, i * BATCH_ORDERS + k) for k in range(BATCH_ORDERS)]
+    ), writes=True),
+]
+
+
+def load_samples(db) -> Samples:
+    pharmacy_names = [name for (name,) in db.query(models.Pharmacy.name).order_by(models.Pharmacy.id).limit(SAMPLE_SIZE)]
+    user_ids = [user_id for (user_id,) in db.query(models.User.id).order_by(models.User.id).limit(SAMPLE_SIZE)]
+    masks = db.query(models.Mask.pharmacy_id, models.Mask.id).order_by(models.Mask.id).limit(SAMPLE_SIZE).all()
+    products = db.query(models.Product.id, models.Product.name).order_by(models.Product.id).limit(SAMPLE_SIZE).all()
+    # per partition, where the date index answers min and max directly
+    bounds = [
+        db.query(func.min(table.c.transaction_date), func.max(table.c.transaction_date)).one()
+        for table in history_tables(db)
+    ]
+    first = min((low for low, _ in bounds if low is not None), default=None)
+    last = max((high for _, high in bounds if high is not None), default=None)
+    if not (pharmacy_names and user_ids and masks and products):
+        raise RuntimeError("the database is empty; run the ETL before benchmarking")
+
+    # whole words and short fragments of names, as users type them
+    keywords = sorted({word for name in pharmacy_names for word in name.split() if word.isalpha()})
+    keywords += sorted({name[:2] for name in pharmacy_names})
+    today = datetime.now()
+    return Samples(
+        pharmacy_names, user_ids, [tuple(m) for m in masks], [tuple(p) for p in products], keywords,
+        first or today, last or today
+    )
+
+
+def percentile(sorted_values: List[float], q: float) -> float:
+    # nearest rank
+    if not sorted_values:
+        return 0.0
+    return sorted_values[min(len(sorted_values) - 1, max(0, math.ceil(q / 100 * len(sorted_values)) - 1))]
+
+
+def summarize(latencies: List[float], errors: int, elapsed: float) -> dict:
+    values = sorted(latencies)
+    summary = {
+        "requests": len(values),
+        "errors": errors,
+        "throughput_rps": round(len(values) / elapsed, 2) if elapsed else 0.0,
+        "latency_ms": {
+            "mean": round(sum(values) / len(values) * 1000, 3) if values else 0.0,
+            **{f"p{q}": round(percentile(values, q) * 1000, 3) for q in PERCENTILES},
+            "max": round(values[-1] * 1000, 3) if values else 0.0,
+        }
+    }
+    return summary
+
+
+async def run_route(client: httpx.AsyncClient, route: Route, samples: Samples, requests: int, concurrency: int, warmup: int):
+    for i in range(warmup):
+        url, body = route.build(samples, i)
+        await client.request(route.method, url, json=body)
+
+    latencies, errors = [], 0
+    counter = iter(range(warmup, warmup + requests))
+
+    async def worker():
+        nonlocal errors
+        for i in counter:
+            url, body = route.build(samples, i)
+            started = time.perf_counter()
+            response = await client.request(route.method, url, json=body)
+            await response.aread()
+            latencies.append(time.perf_counter() - started)
+            # 400s from the purchase route are expected once a sampled wallet runs dry
+            if response.status_code >= 500 or (response.status_code >= 400 and not route.writes):
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - started)
+
+
+async def run_benchmark(
+    url: Optional[str] = None,
+    requests: int = 200,
+    concurrency: int = 8,
+    warmup: int = 10,
+    routes: Optional[List[str]] = None,
+    include_writes: bool = False,
+    samples: Optional[Samples] = None
+) -> dict:
+    if samples is None:
+        from app.database import SessionLocal
+        db = SessionLocal()
+        try:
+            samples = load_samples(db)
+        finally:
+            db.close()
+
+    if routes is not None:
+        selected = [route for route in ROUTES if route.name in routes]
+    else:
+        selected = [route for route in ROUTES if include_writes or not route.writes]
+    if url is None:
+        from app.main import app
+        client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark")
+    else:
+        client = httpx.AsyncClient(base_url=url, timeout=60)
+
+    results = {}
+    async with client:
+        for route in selected:
+            results[route.name] = await run_route(client, route, samples, requests, concurrency, warmup)
+    if url is None:
+        # the ASGI transport skips the app's lifespan, so close the pooled connections here
+        from app.database import async_engine
+        await async_engine.dispose()
+
+    return {
+        "target": url or "in-process",
+        "started_at": datetime.now().isoformat(timespec="seconds"),
+        "requests_per_route": requests,
+        "concurrency": concurrency,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "routes": results,
+    }
+
+
+def compare(previous: dict, current: dict, threshold: float = DEFAULT_THRESHOLD) -> List[str]:
+    """Descriptions of the routes that got slower than `previous` by more than `threshold`."""
+    regressions = []
+    for name, now in current["routes"].items():
+        before = previous.get("routes", {}).get(name)
+        if before is None:
+            continue
+        for key in ("p50", "p95"):
+            old, new = before["latency_ms"][key], now["latency_ms"][key]
+            if old and new > old * (1 + threshold):
+                regressions.append(f"{name}: {key} {old:.3f}ms -> {new:.3f}ms")
+        old, new = before["throughput_rps"], now["throughput_rps"]
+        if old and new < old * (1 - threshold):
+            regressions.append(f"{name}: throughput {old:.1f} -> {new:.1f} req/s")
+    return regressions
+
+
+def best_of(repeat: int, action: Callable[[], object]) -> float:
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        action()
+        timings.append(time.perf_counter() - started)
+    return min(timings)
+
+
+def serialization_benchmark(rows: int = 100_000, repeat: int = 5) -> dict:
+    """Seconds to encode `rows`-item responses through pydantic and through the fast path."""
+    masks = [(f"Mask {i}", 5.0 + i % 7) for i in range(3)]
+    pharmacies = [(i, f"Pharmacy {i}", len(masks)) for i in range(rows)]
+    hours = [(i, f"Pharmacy {i}", "Mon", clock(8), clock(17, 30)) for i in range(rows)]
+    results = {}
+
+    def schema_path(page_type, build_items):
+        # what FastAPI does with schema objects: build, validate against response_model, dump, json.dumps
+        adapter = TypeAdapter(page_type)
+        return lambda: JSONResponse(adapter.dump_python(
+            adapter.validate_python(schemas.Page(items=build_items()), from_attributes=True), mode="json"
+        )).body
+
+    cases = {
+        "mask_count": (
+            schema_path(schemas.Page[schemas.PharmacyMaskCountSchema], lambda: [
+                schemas.PharmacyMaskCountSchema(
+                    id=pharmacy_id, name=name, mask_count=total,
+                    masks=[schemas.FilteredMask(name=n, price=p) for n, p in masks]
+                )
+                for pharmacy_id, name, total in pharmacies
+            ]),
+            lambda: page_response(rows_as_dicts(schemas.PharmacyMaskCountSchema, (
+                (pharmacy_id, name, total, [{"name": n, "price": p} for n, p in masks])
+                for pharmacy_id, name, total in pharmacies
+            ))).body,
+        ),
+        "pharmacies_open": (
+            schema_path(schemas.Page[schemas.PharmacyOpenInfo], lambda: [
+                schemas.PharmacyOpenInfo(id=i, name=n, day_of_week=d, open_time=o, close_time=c)
+                for i, n, d, o, c in hours
+            ]),
+            lambda: page_response(rows_as_dicts(schemas.PharmacyOpenInfo, hours)).body,
+        ),
+    }
+    for name, (slow, fast) in cases.items():
+        assert json.loads(slow()) == json.loads(fast())
+        pydantic_seconds, fast_seconds = best_of(repeat, slow), best_of(repeat, fast)
+        results[name] = {
+            "rows": rows,
+            "pydantic_ms": round(pydantic_seconds * 1000, 1),
+            "fast_ms": round(fast_seconds * 1000, 1),
+            "speedup": round(pydantic_seconds / fast_seconds, 1),
+        }
+    return results
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.benchmark", description="Benchmark the API routes")
+    parser.add_argument("--url", help="base URL of a running server; default runs the app in-process")
+    parser.add_argument("--requests", type=int, default=200, help="measured requests per route")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--warmup", type=int, default=10, help="unmeasured requests per route")
+    parser.add_argument("--routes", nargs="+", choices=[route.name for route in ROUTES])
+    parser.add_argument("--include-writes", action="store_true", help="also benchmark the purchase routes (changes data)")
+    parser.add_argument("--output", help="write the results JSON here, default stdout")
+    parser.add_argument("--compare", help="previous results JSON to check for regressions")
+    parser.add_argument("--threshold", type=float, default=DEFAULT_THRESHOLD)
+    parser.add_argument("--serialization", type=int, metavar="ROWS", help="only time response encoding of ROWS rows")
+    args = parser.parse_args(argv)
+
+    if args.serialization:
+        print(json.dumps(serialization_benchmark(args.serialization), indent=2))
+        return
+
+    results = asyncio.run(run_benchmark(
+        url=args.url,
+        requests=args.requests,
+        concurrency=args.concurrency,
+        warmup=args.warmup,
+        routes=args.routes,
+        include_writes=args.include_writes
+    ))
+
+    text = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    for name, route in results["routes"].items():
+        latency = route["latency_ms"]
+        print(
+            f"{name:24} {route['throughput_rps']:>9.1f} req/s  p50 {latency['p50']:>8.2f}ms  "
+            f"p95 {latency['p95']:>8.2f}ms  p99 {latency['p99']:>8.2f}ms  errors {route['errors']}",
+            file=sys.stderr
+        )
+
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f), results, args.threshold)
+        for regression in regressions:
+            print(f"REGRESSION {regression}", file=sys.stderr)
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
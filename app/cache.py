@@ -0,0 +1,390 @@
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+from collections import OrderedDict
+from contextvars import ContextVar
+from threading import Lock
+from typing import Optional, Tuple
+from urllib.parse import parse_qsl
+from weakref import WeakKeyDictionary
+
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+
+from app.database import DATABASE_URL
+from app.models import DataVersion
+
+# GET routes whose responses depend only on the query and the stored data
+CACHED_PATHS = [
+    re.compile(r"^/pharmacies/open$"),
+    re.compile(r"^/pharmacies/[^/]+/masks$"),
+    re.compile(r"^/pharmacies/mask_count$"),
+    re.compile(r"^/masks/cheapest$"),
+    re.compile(r"^/search$"),
+    re.compile(r"^/users/top_users$"),
+]
+
+MAX_ENTRIES = 1024
+MAX_BYTES = 32 * 1024 * 1024
+# larger responses are served but not kept
+MAX_ENTRY_BYTES = 1024 * 1024
+# rows per chunk when a DerivedCache fetches its rows on an AsyncSession
+FETCH_CHUNK = 10000
+
+Revision = Tuple[int, ...]
+
+# set by ResponseCacheMiddleware for the request it serves: a DerivedCache
+# that answers with a value being replaced notes it here, and the response
+# is then not kept
+_stale_reads: ContextVar[Optional[list]] = ContextVar("stale_reads", default=None)
+
+
+class DataRevision:
+    """A value that changes whenever the database may have changed.
+
+    Writers in this process call bump(); commits from other processes (an
+    ETL run) are noticed through SQLite's PRAGMA data_version, read on a
+    connection of our own, and a replaced database file by its inode.
+    """
+
+    def __init__(self, database_url: str = DATABASE_URL):
+        url = make_url(database_url)
+        self._path = url.database if url.get_backend_name() == "sqlite" else None
+        if self._path in ("", ":memory:"):
+            self._path = None
+        self._lock = Lock()
+        self._bumps = 0
+        self._conn: Optional[sqlite3.Connection] = None
+        self._inode = None
+
+    def bump(self):
+        with self._lock:
+            self._bumps += 1
+
+    def current(self) -> Revision:
+        with self._lock:
+            return (self._bumps,) + self._file_revision()
+
+    def _file_revision(self) -> Tuple[int, int]:
+        if self._path is None:
+            return (0, 0)
+        try:
+            inode = os.stat(self._path).st_ino
+            if self._conn is None or inode != self._inode:
+                if self._conn is not None:
+                    self._conn.close()
+                self._conn = sqlite3.connect(f"file:{self._path}?mode=ro", uri=True, check_same_thread=False)
+                self._inode = inode
+            return (inode, self._conn.execute("PRAGMA data_version").fetchone()[0])
+        except (OSError, sqlite3.Error):
+            # no database yet; the next call tries again
+            self._conn = None
+            return (0, 0)
+
+
+class ResponseCache:
+    """LRU of response bodies, bounded by entry count and total size."""
+
+    def __init__(self, max_entries: int = MAX_ENTRIES, max_bytes: int = MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._lock = Lock()
+        # key -> (revision, etag, content_type, body)
+        self._entries = OrderedDict()
+        self._size = 0
+
+    def get(self, key, revision: Revision):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] != revision:
+                self._drop(key)
+                return None
+            self._entries.move_to_end(key)
+            return entry[1:]
+
+    def put(self, key, revision: Revision, etag: str, content_type: bytes, body: bytes):
+        if len(body) > min(MAX_ENTRY_BYTES, self.max_bytes):
+            return
+        with self._lock:
+            if key in self._entries:
+                self._drop(key)
+            self._entries[key] = (revision, etag, content_type, body)
+            self._size += len(body)
+            while len(self._entries) > self.max_entries or self._size > self.max_bytes:
+                self._drop(next(iter(self._entries)))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _drop(self, key):
+        self._size -= len(self._entries.pop(key)[3])
+
+
+def cache_key(scope) -> tuple:
+    # parameter order and blank parameters do not change the answer
+    query = parse_qsl(scope.get("query_string", b"").decode("latin-1"))
+    return scope["path"], tuple(sorted((name, value) for name, value in query if value != ""))
+
+
+def make_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+    return "*" in tags or etag in tags
+
+
+class ResponseCacheMiddleware:
+    """Serves repeated GETs from the cache and answers If-None-Match with 304.
+
+    Entries are stamped with the data revision they were computed at, so a
+    purchase or an ETL run makes every older entry a miss. ETags hash the
+    body, so an unchanged answer still matches after the revision moves on.
+    """
+
+    def __init__(self, app, cache: Optional[ResponseCache] = None, revision: Optional[DataRevision] = None):
+        self.app = app
+        self.cache = response_cache if cache is None else cache
+        self.revision = data_revision if revision is None else revision
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["method"] != "GET" or not any(
+            pattern.match(scope["path"]) for pattern in CACHED_PATHS
+        ):
+            await self.app(scope, receive, send)
+            return
+
+        key = cache_key(scope)
+        revision = self.revision.current()
+        if_none_match = next(
+            (value.decode("latin-1") for name, value in scope["headers"] if name == b"if-none-match"), None
+        )
+
+        # Cache-Control: no-cache asks for a fresh answer, which is then cached as usual
+        no_cache = any(name == b"cache-control" and b"no-cache" in value for name, value in scope["headers"])
+        entry = None if no_cache else self.cache.get(key, revision)
+        if entry is not None:
+            etag, content_type, body = entry
+            await self._send(send, etag, content_type, body, if_none_match)
+            return
+
+        start = None
+        chunks = []
+
+        async def capture(message):
+            nonlocal start
+            if message["type"] == "http.response.start":
+                start = message
+                return
+            if message["type"] != "http.response.body":
+                await send(message)
+                return
+            chunks.append(message.get("body", b""))
+            if message.get("more_body", False):
+                return
+
+            body = b"".join(chunks)
+            if start["status"] != 200:
+                await send(start)
+                await send({"type": "http.response.body", "body": body})
+                return
+            content_type = next(
+                (value for name, value in start["headers"] if name == b"content-type"), b"application/json"
+            )
+            etag = make_etag(body)
+            if not stale_reads:
+                self.cache.put(key, revision, etag, content_type, body)
+            await self._send(send, etag, content_type, body, if_none_match)
+
+        stale_reads = []
+        token = _stale_reads.set(stale_reads)
+        try:
+            await self.app(scope, receive, capture)
+        finally:
+            _stale_reads.reset(token)
+
+    @staticmethod
+    async def _send(send, etag: str, content_type: bytes, body: bytes, if_none_match: Optional[str]):
+        if etag_matches(if_none_match, etag):
+            await send({
+                "type": "http.response.start",
+                "status": 304,
+                "headers": [(b"etag", etag.encode())]
+            })
+            await send({"type": "http.response.body", "body": b""})
+            return
+        await send({
+            "type": "http.response.start",
+            "status": 200,
+            "headers": [
+                (b"content-type", content_type),
+                (b"content-length", str(len(body)).encode()),
+                (b"etag", etag.encode())
+            ]
+        })
+        await send({"type": "http.response.body", "body": body})
+
+
+response_cache = ResponseCache()
+data_revision = DataRevision()
+_revisions = {}
+_revisions_lock = Lock()
+
+
+def revision_for(url) -> DataRevision:
+    """The DataRevision of the database a session is bound to.
+
+    This process bumps data_revision on its own writes; other databases (a
+    read replica, or a test database) are followed by data_version alone.
+    """
+    path = url.database
+    if path == make_url(DATABASE_URL).database:
+        return data_revision
+    with _revisions_lock:
+        if path not in _revisions:
+            _revisions[path] = DataRevision(url.render_as_string(hide_password=False))
+        return _revisions[path]
+
+
+async def _acquire(lock: Lock):
+    """Take a threading lock without blocking the event loop."""
+    if lock.acquire(blocking=False):
+        return
+    # held by a worker thread or another loop: wait for it off this loop
+    waiter = asyncio.get_running_loop().run_in_executor(None, lock.acquire)
+    try:
+        await asyncio.shield(waiter)
+    except asyncio.CancelledError:
+        waiter.add_done_callback(lambda _: lock.release())
+        raise
+
+
+def data_version(db, name: str) -> int:
+    """The counter in data_versions that the triggers bump on writes to
+    the tables behind `name` (models.VERSIONED_WRITES)."""
+    return db.execute(data_version_query(name)).scalar()
+
+
+def data_version_query(name: str):
+    return select(DataVersion.version).where(DataVersion.name == name)
+
+
+async def fetch_all(db, statement) -> list:
+    """The rows of `statement` on an AsyncSession, fetched in chunks of
+    FETCH_CHUNK, so other requests run between them."""
+    rows = []
+    result = await db.stream(statement.execution_options(yield_per=FETCH_CHUNK))
+    async for partition in result.partitions():
+        rows.extend(partition)
+    return rows
+
+
+class DerivedCache:
+    """A value built from the database a session is bound to, kept until
+    the data it was built from changes.
+
+    `kind` names what is built: kind.queries are the statements it is built
+    from, and kind.build(rows, previous) builds it from their rows (one
+    list per statement), given the value held so far or None, which lets a
+    builder catch up instead of starting over.
+
+    The data revision is checked on every call and costs no query. With a
+    `version`, a moved revision (every purchase moves it) is followed by a
+    read of that data_versions counter, and the value is only built again
+    when the counter moved as well.
+
+    One build runs at a time. For an AsyncSession the rows are fetched with
+    awaited queries and the value is built in a worker thread, so the event
+    loop keeps serving: meanwhile other callers get the value being
+    replaced, or, when there is none yet, wait for the build on an
+    asyncio.Lock of their event loop.
+    """
+
+    def __init__(self, kind, version: Optional[str] = None):
+        self._kind = kind
+        self._version = version
+        # (key, data version, value)
+        self._state = None
+        self._lock = Lock()
+        self._loop_locks = WeakKeyDictionary()
+
+    @staticmethod
+    def key(db) -> tuple:
+        url = db.get_bind().url
+        return url.database, revision_for(url).current()
+
+    def get(self, db):
+        """The value, for a sync Session."""
+        key = self.key(db)
+        state = self._state
+        if state is not None and state[0] == key:
+            return state[2]
+        with self._lock:
+            state = self._state
+            if state is not None and state[0] == key:
+                return state[2]
+            previous = self._previous(key)
+            # read before the rows, so a commit in between only causes another build
+            version = None if self._version is None else data_version(db, self._version)
+            if previous is not None and version is not None and previous[1] == version:
+                value = previous[2]
+            else:
+                rows = [db.execute(statement).all() for statement in self._kind.queries]
+                value = self._kind.build(rows, None if previous is None else previous[2])
+            self._state = (key, version, value)
+            return value
+
+    async def get_async(self, db):
+        """The value, for an AsyncSession."""
+        key = self.key(db)
+        state = self._state
+        if state is not None and state[0] == key:
+            return state[2]
+        if state is not None and state[0][0] == key[0] and self._lock.locked():
+            # a build is under way; the value it replaces is still served
+            stale_reads = _stale_reads.get()
+            if stale_reads is not None:
+                stale_reads.append(self)
+            return state[2]
+        loop = asyncio.get_running_loop()
+        loop_lock = self._loop_locks.get(loop)
+        if loop_lock is None:
+            loop_lock = self._loop_locks.setdefault(loop, asyncio.Lock())
+        async with loop_lock:
+            await _acquire(self._lock)
+            try:
+                state = self._state
+                if state is not None and state[0] == key:
+                    return state[2]
+                previous = self._previous(key)
+                version = None if self._version is None else await db.scalar(data_version_query(self._version))
+                if previous is not None and version is not None and previous[1] == version:
+                    value = previous[2]
+                else:
+                    rows = [await fetch_all(db, statement) for statement in self._kind.queries]
+                    value = await asyncio.to_thread(self._kind.build, rows, None if previous is None else previous[2])
+                self._state = (key, version, value)
+                return value
+            finally:
+                self._lock.release()
+
+    def _previous(self, key):
+        # a value of the same database, which a build may start from
+        state = self._state
+        return state if state is not None and state[0][0] == key[0] else None
+
+    def clear(self):
+        with self._lock:
+            self._state = None
@@ -0,0 +1,174 @@
+"""Read-only snapshot of pharmacies, products and masks in compact columns.
+
+The masks listing, mask_count and the cheapest offers of a product are
+answered from a CatalogSnapshot instead of the database. A snapshot is
+kept until the "catalog" data version moves, which triggers bump on any
+write to pharmacies, masks or products, from this process or another
+(an ETL run). Purchases leave it alone. A new snapshot replaces the old
+by a single assignment, so readers always see one consistent snapshot.
+"""
+from array import array
+from bisect import bisect_left, bisect_right
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import select
+
+from app import models
+from app.cache import DerivedCache
+
+# (name, price, id)
+MaskRow = Tuple[str, float, int]
+# (id, name, mask count, [(mask name, price), ...])
+MaskCountRow = Tuple[int, str, int, List[Tuple[str, float]]]
+# (pharmacy id, pharmacy name, mask id, price)
+OfferRow = Tuple[int, str, int, float]
+
+
+class CatalogSnapshot:
+    """Pharmacies in id order; the masks of pharmacy i are the positions
+    offsets[i]:offsets[i + 1] of the mask columns, in id order.
+
+    by_name and by_price hold the same positions re-sorted within each
+    pharmacy by (name, id) and (price, id), so sorted listings and price
+    ranges are bisects. offers holds them grouped by product instead,
+    product j at offer_offsets[j]:offer_offsets[j + 1], cheapest first.
+    """
+
+    __slots__ = (
+        "pharmacy_ids", "pharmacy_names", "pharmacy_by_name",
+        "offsets", "mask_ids", "mask_names", "mask_prices", "mask_pharmacies", "by_name", "by_price",
+        "products", "product_by_id", "product_by_name", "offer_offsets", "offers"
+    )
+
+    def __init__(self, pharmacies, masks, products=()):
+        self.pharmacy_ids = array("q", (pharmacy_id for pharmacy_id, _ in pharmacies))
+        self.pharmacy_names = [name for _, name in pharmacies]
+        self.pharmacy_by_name: Dict[str, int] = {name: i for i, name in enumerate(self.pharmacy_names)}
+
+        position = {pharmacy_id: i for i, pharmacy_id in enumerate(self.pharmacy_ids)}
+        # masks arrive ordered by (pharmacy_id, id)
+        masks = [mask for mask in masks if mask[0] in position]
+        counts = [0] * len(self.pharmacy_ids)
+        for pharmacy_id, _, _, _, _ in masks:
+            counts[position[pharmacy_id]] += 1
+        self.offsets = array("q", [0])
+        for count in counts:
+            self.offsets.append(self.offsets[-1] + count)
+        self.mask_ids = array("q", (mask_id for _, mask_id, _, _, _ in masks))
+        self.mask_names = [name for _, _, name, _, _ in masks]
+        self.mask_prices = array("d", (price for _, _, _, price, _ in masks))
+        self.mask_pharmacies = array("q", (position[pharmacy_id] for pharmacy_id, _, _, _, _ in masks))
+
+        self.by_name = array("q")
+        self.by_price = array("q")
+        for lo, hi in zip(self.offsets, self.offsets[1:]):
+            self.by_name.extend(sorted(range(lo, hi), key=lambda p: (self.mask_names[p], self.mask_ids[p])))
+            self.by_price.extend(sorted(range(lo, hi), key=lambda p: (self.mask_prices[p], self.mask_ids[p])))
+
+        # (id, name, brand, color, units_per_pack) in id order
+        self.products = [tuple(product) for product in products]
+        self.product_by_id: Dict[int, int] = {product[0]: j for j, product in enumerate(self.products)}
+        self.product_by_name: Dict[str, int] = {product[1]: j for j, product in enumerate(self.products)}
+        by_product = {}
+        for p, (_, _, _, _, product_id) in enumerate(masks):
+            if product_id in self.product_by_id:
+                by_product.setdefault(self.product_by_id[product_id], []).append(p)
+        self.offer_offsets = array("q", [0])
+        self.offers = array("q")
+        for j in range(len(self.products)):
+            self.offers.extend(sorted(by_product.get(j, ()), key=lambda p: (self.mask_prices[p], self.mask_ids[p])))
+            self.offer_offsets.append(len(self.offers))
+
+    # pharmacies, masks and products, as the constructor takes them
+    queries = (
+        select(models.Pharmacy.id, models.Pharmacy.name).order_by(models.Pharmacy.id),
+        select(models.Mask.pharmacy_id, models.Mask.id, models.Mask.name, models.Mask.price, models.Mask.product_id)
+        .order_by(models.Mask.pharmacy_id, models.Mask.id),
+        select(
+            models.Product.id, models.Product.name, models.Product.brand,
+            models.Product.color, models.Product.units_per_pack
+        ).order_by(models.Product.id),
+    )
+
+    @classmethod
+    def build(cls, rows, previous=None) -> "CatalogSnapshot":
+        return cls(*rows)
+
+    def pharmacy_index(self, name: str) -> Optional[int]:
+        return self.pharmacy_by_name.get(name)
+
+    def masks_page(
+        self, index: int, sort_by: str, descending: bool, after: Optional[tuple], limit: int
+    ) -> List[MaskRow]:
+        """Up to `limit` masks of pharmacy `index` sorted by (sort_by, id) and past `after`."""
+        names, prices, ids = self.mask_names, self.mask_prices, self.mask_ids
+        if sort_by == "price":
+            order, key = self.by_price, lambda p: (prices[p], ids[p])
+        else:
+            order, key = self.by_name, lambda p: (names[p], ids[p])
+        lo, hi = self.offsets[index], self.offsets[index + 1]
+
+        if descending:
+            end = hi if after is None else bisect_left(order, tuple(after), lo, hi, key=key)
+            positions = reversed(order[max(lo, end - limit):end])
+        else:
+            start = lo if after is None else bisect_right(order, tuple(after), lo, hi, key=key)
+            positions = order[start:min(hi, start + limit)]
+        return [(names[p], prices[p], ids[p]) for p in positions]
+
+    def mask_count_page(
+        self, min_price: float, max_price: float, count: int, op: str, after: Optional[int], limit: int
+    ) -> List[MaskCountRow]:
+        """Pharmacies past id `after` with more ("gt") or fewer ("lt") than
+        `count` masks priced within [min_price, max_price], with those masks."""
+        prices, order = self.mask_prices, self.by_price
+        start = 0 if after is None else bisect_right(self.pharmacy_ids, after)
+        rows = []
+        for i in range(start, len(self.pharmacy_ids)):
+            lo, hi = self.offsets[i], self.offsets[i + 1]
+            first = bisect_left(order, min_price, lo, hi, key=prices.__getitem__)
+            last = bisect_right(order, max_price, first, hi, key=prices.__getitem__)
+            total = last - first
+            if not (total > count if op == "gt" else total < count):
+                continue
+            # positions ascend with the mask id
+            masks = [(self.mask_names[p], prices[p]) for p in sorted(order[first:last])]
+            rows.append((self.pharmacy_ids[i], self.pharmacy_names[i], total, masks))
+            if len(rows) == limit:
+                break
+        return rows
+
+    def product_index(self, product_id: Optional[int] = None, name: Optional[str] = None) -> Optional[int]:
+        if product_id is not None:
+            return self.product_by_id.get(product_id)
+        return self.product_by_name.get(name)
+
+    def cheapest_offers(self, product: int, limit: int, pharmacy_ids: Optional[Set[int]] = None) -> List[OfferRow]:
+        """The `limit` cheapest masks of product index `product`, optionally
+        only from the pharmacies in `pharmacy_ids`; ties go to the lower mask id."""
+        rows = []
+        for p in self.offers[self.offer_offsets[product]:self.offer_offsets[product + 1]]:
+            pharmacy = self.mask_pharmacies[p]
+            if pharmacy_ids is not None and self.pharmacy_ids[pharmacy] not in pharmacy_ids:
+                continue
+            rows.append((self.pharmacy_ids[pharmacy], self.pharmacy_names[pharmacy], self.mask_ids[p], self.mask_prices[p]))
+            if len(rows) == limit:
+                break
+        return rows
+
+
+class Catalog:
+    """Hands out the snapshot of the database a session is bound to,
+    loading a new one when its catalog has changed."""
+
+    def __init__(self):
+        self._snapshot = DerivedCache(CatalogSnapshot, version="catalog")
+
+    def ensure_current(self, db) -> CatalogSnapshot:
+        return self._snapshot.get(db)
+
+    async def current(self, db) -> CatalogSnapshot:
+        return await self._snapshot.get_async(db)
+
+
+catalog = Catalog()
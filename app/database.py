@@ -1,14 +1,80 @@
-from sqlalchemy import create_engine
+import os
+from sqlalchemy import create_engine, event
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
 from sqlalchemy.orm import sessionmaker
 from app.models import Base
+from app.migrations import migrate
+from app.metrics import CountingConnection, CountingSession, instrument_engine
 
-DATABASE_URL = "sqlite:///./phantom_mask.db"
+# Every setting can be overridden through the environment
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///./phantom_mask.db")
+# the read endpoints may point at another copy of the database; defaults to the same file
+READ_DATABASE_URL = os.getenv("READ_DATABASE_URL", DATABASE_URL)
 
-engine = create_engine(DATABASE_URL, connect_args={"check_same_thread": False})
+POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))
+READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "10"))
+READ_MAX_OVERFLOW = int(os.getenv("DB_READ_MAX_OVERFLOW", "20"))
+
+# WAL lets readers keep going while /purchase writes
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", str(256 * 1024 * 1024))),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", "-64000")),  # negative: KiB
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000")),  # ms
+}
+
+def async_url(url: str) -> str:
+    return url.replace("sqlite://", "sqlite+aiosqlite://", 1) if url.startswith("sqlite://") else url
+
+def apply_sqlite_pragmas(engine, read_only: bool = False):
+    """Run SQLITE_PRAGMAS on every new connection of `engine`; read-only connections also refuse writes."""
+    if engine.dialect.name != "sqlite":
+        return
+
+    @event.listens_for(engine, "connect")
+    def set_pragmas(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for name, value in SQLITE_PRAGMAS.items():
+            cursor.execute(f"PRAGMA {name} = {value}")
+        if read_only:
+            cursor.execute("PRAGMA query_only = ON")
+        cursor.close()
+
+def engine_options(url: str, pool_size: int, max_overflow: int) -> dict:
+    url = make_url(url)
+    if url.get_backend_name() != "sqlite":
+        return {"pool_size": pool_size, "max_overflow": max_overflow, "pool_timeout": POOL_TIMEOUT}
+    # CountingConnection counts the rows fetched through the sync driver for /metrics
+    options = {"connect_args": {"check_same_thread": False, "factory": CountingConnection}}
+    # in-memory SQLite uses a single static connection, which takes no pool arguments
+    if url.database not in (None, "", ":memory:"):
+        options.update(pool_size=pool_size, max_overflow=max_overflow, pool_timeout=POOL_TIMEOUT)
+    return options
+
+# read-write engine: the ETL, migrations and /purchase
+engine = create_engine(DATABASE_URL, **engine_options(DATABASE_URL, POOL_SIZE, MAX_OVERFLOW))
+apply_sqlite_pragmas(engine)
+instrument_engine(engine)
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# read-only engine: read endpoints await the database instead of holding a threadpool slot
+async_engine = create_async_engine(
+    async_url(READ_DATABASE_URL),
+    **engine_options(READ_DATABASE_URL, READ_POOL_SIZE, READ_MAX_OVERFLOW)
+)
+apply_sqlite_pragmas(async_engine.sync_engine, read_only=True)
+instrument_engine(async_engine.sync_engine)
+AsyncSessionLocal = async_sessionmaker(
+    async_engine, autoflush=False, expire_on_commit=False, sync_session_class=CountingSession
+)
+
 def init_db():
     Base.metadata.create_all(bind=engine)
+    migrate(engine)
 
 def get_db():
     db = SessionLocal()
@@ -16,3 +82,7 @@ def get_db():
         yield db
     finally:
         db.close()
+
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
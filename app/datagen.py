@@ -0,0 +1,209 @@
+"""Synthetic data in the format of data/pharmacies.json and data/users.json.
+
+Everything is written as it is generated; only the catalog is kept in
+memory, as compact arrays, so that purchases can name real masks at their
+real prices. The same seed always produces the same files.
+
+    python -m app.datagen --pharmacies 100000 --masks 1000000 --users 1000000 \\
+        --transactions 50000000 --output-dir data/large
+"""
+import argparse
+import json
+import os
+import random
+from array import array
+from datetime import datetime, timedelta
+
+BRANDS = ["True Barrier", "MaskT", "Second Smile", "Cotton Kiss", "Masquerade"]
+COLORS = ["black", "blue", "green"]
+PACK_SIZES = [3, 6, 10]
+# every (brand, color, pack size), the most masks a pharmacy can list without repeating a name
+MASK_VARIANTS = [(b, c, p) for b in range(len(BRANDS)) for c in range(len(COLORS)) for p in range(len(PACK_SIZES))]
+
+PHARMACY_PREFIXES = [
+    "DFW", "First", "Health", "Keystone", "RX", "Blink", "Medlife", "Centrico", "Carepoint", "Welltrack",
+    "Acculife", "Foundation", "Prescription", "Below", "Pharma", "Cool", "Sunrise", "Lakeside", "Cedar", "Summit",
+]
+PHARMACY_SUFFIXES = [
+    "Pharmacy", "Wellness", "Care Rx", "Drug", "Health", "Mart", "Warehouse", "Element", "Drug Stores", "Rx",
+]
+FIRST_NAMES = [
+    "Yvonne", "Ada", "Geneva", "Lester", "Violet", "Bertha", "Sherri", "Timothy", "Marilyn", "Eric",
+    "Ismael", "Robyn", "Winifred", "Willie", "Marlon", "Holly", "Wilbert", "Felipe", "Pamela", "Bonnie",
+]
+LAST_NAMES = [
+    "Guerrero", "Larson", "Floyd", "Arnold", "Bush", "Guzman", "Lynch", "Schultz", "Cruz", "Underwood",
+    "Cole", "Wilson", "Steele", "Moran", "Watson", "Thompson", "Love", "Gibson", "French", "Malone",
+]
+# the shapes found in data/pharmacies.json, including ranges and hours past midnight
+OPENING_HOURS = [
+    "Mon - Fri 08:00 - 17:00",
+    "Mon - Fri 08:00 - 17:00 / Sat, Sun 08:00 - 12:00",
+    "Mon, Wed, Fri 08:00 - 12:00 / Tue, Thur 14:00 - 18:00",
+    "Mon - Wed 08:00 - 17:00 / Thur, Sat 20:00 - 02:00",
+    "Fri - Sun 20:00 - 02:00",
+    "Mon, Wed, Fri 20:00 - 02:00",
+    "Mon - Sun 00:00 - 23:59",
+    "Tue - Sat 10:00 - 19:30",
+]
+
+
+def mask_name(variant: int) -> str:
+    brand, color, pack = MASK_VARIANTS[variant]
+    return f"{BRANDS[brand]} ({COLORS[color]}) ({PACK_SIZES[pack]} per pack)"
+
+
+def pharmacy_name(index: int) -> str:
+    prefix = PHARMACY_PREFIXES[index % len(PHARMACY_PREFIXES)]
+    suffix = PHARMACY_SUFFIXES[index // len(PHARMACY_PREFIXES) % len(PHARMACY_SUFFIXES)]
+    name = f"{prefix} {suffix}"
+    # names are the pharmacies' natural key, so number them once the combinations run out
+    combinations = len(PHARMACY_PREFIXES) * len(PHARMACY_SUFFIXES)
+    return name if index < combinations else f"{name} #{index // combinations + 1}"
+
+
+class Catalog:
+    """Masks of every pharmacy as parallel arrays; pharmacy i owns masks offsets[i]:offsets[i + 1]."""
+
+    def __init__(self):
+        self.offsets = array("l", [0])
+        self.variants = array("b")
+        self.prices = array("d")
+
+    def add_pharmacy(self, variants, prices):
+        self.variants.extend(variants)
+        self.prices.extend(prices)
+        self.offsets.append(len(self.variants))
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+
+class JsonArrayWriter:
+    """Writes a JSON array one element at a time."""
+
+    def __init__(self, path: str):
+        self._file = open(path, "w", encoding="utf-8")
+        self._file.write("[")
+        self._first = True
+
+    def write(self, item):
+        self._file.write("\n  " if self._first else ",\n  ")
+        self._file.write(json.dumps(item, ensure_ascii=False))
+        self._first = False
+
+    def close(self):
+        self._file.write("\n]\n")
+        self._file.close()
+
+
+def generate_pharmacies(path: str, count: int, masks: int, rng: random.Random) -> Catalog:
+    catalog = Catalog()
+    writer = JsonArrayWriter(path)
+    average = masks / count if count else 0
+
+    for i in range(count):
+        # vary the catalog size, but leave the later pharmacies room for exactly `masks` in total
+        remaining = masks - len(catalog.variants)
+        later = (count - i - 1) * len(MASK_VARIANTS)
+        size = round(rng.uniform(0.5, 1.5) * average)
+        size = min(max(size, remaining - later), remaining, len(MASK_VARIANTS))
+        variants = rng.sample(range(len(MASK_VARIANTS)), size)
+        prices = [
+            round(PACK_SIZES[MASK_VARIANTS[v][2]] * rng.uniform(1.5, 4.5), 2)
+            for v in variants
+        ]
+        catalog.add_pharmacy(variants, prices)
+        writer.write({
+            "name": pharmacy_name(i),
+            "cashBalance": round(rng.uniform(100, 1000), 2),
+            "openingHours": rng.choice(OPENING_HOURS),
+            "masks": [{"name": mask_name(v), "price": p} for v, p in zip(variants, prices)]
+        })
+
+    writer.close()
+    return catalog
+
+
+def generate_users(
+    path: str, count: int, transactions: int, catalog: Catalog, start: datetime, days: int, rng: random.Random
+):
+    writer = JsonArrayWriter(path)
+    stocked = [i for i in range(len(catalog)) if catalog.offsets[i + 1] > catalog.offsets[i]]
+    remaining = transactions
+    seconds = days * 24 * 3600
+
+    for u in range(count):
+        users_left = count - u
+        # a few heavy buyers and many light ones, summing to `transactions`
+        if users_left == 1:
+            size = remaining
+        else:
+            size = min(remaining, int(rng.expovariate(users_left / remaining))) if remaining else 0
+        remaining -= size
+
+        histories = []
+        for _ in range(size if stocked else 0):
+            pharmacy = rng.choice(stocked)
+            mask = rng.randrange(catalog.offsets[pharmacy], catalog.offsets[pharmacy + 1])
+            moment = start + timedelta(seconds=rng.randrange(seconds))
+            histories.append({
+                "pharmacyName": pharmacy_name(pharmacy),
+                "maskName": mask_name(catalog.variants[mask]),
+                "transactionAmount": catalog.prices[mask],
+                "transactionDate": moment.strftime("%Y-%m-%d %H:%M:%S")
+            })
+
+        writer.write({
+            "name": f"{rng.choice(FIRST_NAMES)} {rng.choice(LAST_NAMES)}",
+            "cashBalance": round(rng.uniform(10, 1000), 2),
+            "purchaseHistories": histories
+        })
+
+    writer.close()
+
+
+def generate(
+    output_dir: str,
+    pharmacies: int = 1000,
+    masks: int = 10000,
+    users: int = 1000,
+    transactions: int = 50000,
+    start: datetime = datetime(2021, 1, 1),
+    days: int = 365,
+    seed: int = 0
+):
+    if masks > pharmacies * len(MASK_VARIANTS):
+        raise ValueError(f"at most {len(MASK_VARIANTS)} distinct masks per pharmacy")
+    os.makedirs(output_dir, exist_ok=True)
+    rng = random.Random(seed)
+    catalog = generate_pharmacies(os.path.join(output_dir, "pharmacies.json"), pharmacies, masks, rng)
+    generate_users(os.path.join(output_dir, "users.json"), users, transactions, catalog, start, days, rng)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.datagen", description="Generate synthetic ETL input")
+    parser.add_argument("--pharmacies", type=int, default=1000)
+    parser.add_argument("--masks", type=int, default=10000, help="total masks across all pharmacies")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--transactions", type=int, default=50000, help="total purchase histories")
+    parser.add_argument("--start-date", default="2021-01-01", help="first transaction day, YYYY-MM-DD")
+    parser.add_argument("--days", type=int, default=365, help="days the transactions are spread over")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output-dir", default="data/generated")
+    args = parser.parse_args(argv)
+
+    generate(
+        args.output_dir,
+        pharmacies=args.pharmacies,
+        masks=args.masks,
+        users=args.users,
+        transactions=args.transactions,
+        start=datetime.strptime(args.start_date, "%Y-%m-%d"),
+        days=args.days,
+        seed=args.seed
+    )
+
+
+if __name__ == "__main__":
+    main()
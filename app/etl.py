@@ -1,77 +1,348 @@
-import json, os
+import hashlib, json, math, os
+from collections import defaultdict
 from datetime import datetime
-from app.models import Pharmacy, Mask, OpeningHour, User, PurchaseHistory
-from app.database import SessionLocal, init_db
-from app.utils import parse_opening_hours
+from json.encoder import encode_basestring_ascii
+from sqlalchemy import func, insert
+from app.models import Base, Pharmacy, Mask, OpeningHour, Product, User, PurchaseHistory, EtlCheckpoint, EtlDeferredPurchases
+from app.database import SessionLocal, engine, init_db
+from app.utils import parse_mask_name, parse_opening_hours
+from app.partitions import next_history_id
+from app.rollups import rebuild_rollups
+from app.cache import data_revision
 
-def load_pharmacies(json_path: str):
+# rows per executemany INSERT
+BATCH_SIZE = 5000
+READ_CHUNK_SIZE = 1 << 16
+
+def iter_json_array(json_path: str, chunk_size: int = READ_CHUNK_SIZE):
+    """逐筆讀出 JSON 陣列中的元素，不需把整個檔案載入記憶體"""
+    decoder = json.JSONDecoder()
     with open(json_path, "r") as f:
-        data = json.load(f)
+        buffer = ""
+        while not buffer:
+            chunk = f.read(chunk_size)
+            if not chunk:
+                break
+            buffer = chunk.lstrip()
+        if not buffer.startswith("["):
+            raise ValueError(f"{json_path} is not a JSON array")
+        buffer = buffer[1:]
+        eof = False
 
-    db = SessionLocal()
-    for p in data:
-        pharmacy = Pharmacy(
-            name=p["name"],
-            cash_balance=p.get("cashBalance", 0.0)
+        while True:
+            buffer = buffer.lstrip()
+            if buffer.startswith(","):
+                buffer = buffer[1:].lstrip()
+            if buffer.startswith("]"):
+                return
+
+            try:
+                item, end = decoder.raw_decode(buffer)
+            except json.JSONDecodeError:
+                item, end = None, None
+
+            # an element ending exactly at the buffer end may be a truncated number
+            if end is None or (end == len(buffer) and not eof):
+                chunk = f.read(chunk_size)
+                if chunk:
+                    buffer += chunk
+                elif end is None:
+                    raise ValueError(f"{json_path} ended before the closing ']'")
+                else:
+                    eof = True
+                continue
+
+            yield item
+            buffer = buffer[end:]
+
+class BulkInserter:
+    """Buffers rows per table and writes each batch with one executemany INSERT."""
+
+    def __init__(self, db, batch_size: int = BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self._rows = defaultdict(list)
+
+    def add(self, model, row: dict):
+        rows = self._rows[model.__table__]
+        rows.append(row)
+        if len(rows) >= self.batch_size:
+            self._write(model.__table__)
+
+    def flush(self):
+        for table in list(self._rows):
+            self._write(table)
+
+    def _write(self, table):
+        rows = self._rows.pop(table, None)
+        if rows:
+            self.db.execute(insert(table), rows)
+
+class ProductIds:
+    """口罩名稱對應的產品 ID；遇到新名稱時立即新增 products 列"""
+
+    def __init__(self, db):
+        self.db = db
+        self._ids = dict(db.query(Product.name, Product.id).all())
+
+    def get(self, name: str) -> int:
+        product_id = self._ids.get(name)
+        if product_id is None:
+            brand, color, units_per_pack = parse_mask_name(name)
+            product_id = self.db.execute(
+                insert(Product.__table__)
+                .values(name=name, brand=brand, color=color, units_per_pack=units_per_pack)
+                .returning(Product.__table__.c.id)
+            ).scalar_one()
+            self._ids[name] = product_id
+        return product_id
+
+class StagedRecords:
+    """etl_records rows of a full load.
+
+    They are collected in a temporary table without an index, as plain
+    tuples straight through the driver, and copied over in key order by
+    save(): one sorted INSERT ... SELECT instead of an index insert at a
+    random position for every source record.
+    """
+
+    def __init__(self, db, run_id: int, batch_size: int = BATCH_SIZE):
+        self.db = db
+        self.run_id = run_id
+        self.batch_size = batch_size
+        self._rows = []
+        self._execute("CREATE TEMP TABLE IF NOT EXISTS etl_records_staged (kind, key, content_hash, row_id)")
+        self._execute("DELETE FROM etl_records_staged")
+
+    def add(self, kind: str, key: str, content_hash: str, row_id: int):
+        self._rows.append((kind, key, content_hash, row_id))
+        if len(self._rows) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._rows:
+            self._execute("INSERT INTO etl_records_staged VALUES (?, ?, ?, ?)", self._rows)
+            self._rows = []
+
+    def save(self):
+        self.flush()
+        self._execute(
+            "INSERT INTO etl_records (kind, key, content_hash, row_id, run_id) "
+            "SELECT kind, key, content_hash, row_id, ? FROM etl_records_staged ORDER BY kind, key",
+            (self.run_id,)
         )
-        db.add(pharmacy)
-        db.flush()  # 確保 pharmacy.id 可用
+        self._execute("DROP TABLE etl_records_staged")
+
+    def _execute(self, sql: str, parameters=()):
+        self.db.connection().exec_driver_sql(sql, parameters)
+
+def next_id(db, model) -> int:
+    return (db.query(func.max(model.id)).scalar() or 0) + 1
+
+def _float_json(value: float) -> str:
+    return float.__repr__(value) if math.isfinite(value) else json.dumps(value)
+
+# exact types: bool is an int, and json writes it differently
+SCALAR_JSON = {str: encode_basestring_ascii, int: int.__repr__, float: _float_json}
+
+def canonical_json(value) -> str:
+    """json.dumps(value, sort_keys=True), written out directly for the
+    strings, numbers, lists and dicts of the source files; several times
+    faster, and byte for byte the same, so stored hashes stay valid"""
+    scalar = SCALAR_JSON.get(type(value))
+    if scalar is not None:
+        return scalar(value)
+    if type(value) is dict and all(type(key) is str for key in value):
+        return "{" + ", ".join([
+            f"{encode_basestring_ascii(key)}: {SCALAR_JSON.get(type(item), canonical_json)(item)}"
+            for key, item in sorted(value.items())
+        ]) + "}"
+    if type(value) is list:
+        return "[" + ", ".join([SCALAR_JSON.get(type(item), canonical_json)(item) for item in value]) + "]"
+    return json.dumps(value, sort_keys=True)
+
+def digest(text: str) -> str:
+    return hashlib.blake2b(text.encode(), digest_size=16).hexdigest()
+
+def content_hash(value) -> str:
+    return digest(canonical_json(value))
+
+TRANSACTION_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+def parse_transaction_date(text: str) -> datetime:
+    # fromisoformat is far faster than strptime, but also takes other ISO
+    # forms (a "T", an offset), so it only gets the exact source format
+    if len(text) == 19 and text[10] == " ":
+        return datetime.fromisoformat(text)
+    return datetime.strptime(text, TRANSACTION_DATE_FORMAT)
+
+def mask_key(pharmacy_name: str, mask_name: str) -> str:
+    return f"{pharmacy_name}\x1f{mask_name}"
+
+def keyed_users(users):
+    """使用者的自然鍵：名稱，同名者再依出現順序編號"""
+    occurrences = defaultdict(int)
+    for u in users:
+        yield u, f"{u['name']}\x1f{occurrences[u['name']]}"
+        occurrences[u["name"]] += 1
+
+def purchase_records(u: dict, user_key: str):
+    """消費紀錄的自然鍵：使用者、紀錄內容，以及相同紀錄出現的次數"""
+    occurrences = defaultdict(int)
+    # the key is content_hash([user_key, record_hash, occurrence]), with user_key encoded once
+    prefix = f'[{encode_basestring_ascii(user_key)}, "'
+    for ph in u.get("purchaseHistories", []):
+        record_hash = content_hash(ph)
+        key = digest(f'{prefix}{record_hash}", {occurrences[record_hash]}]')
+        occurrences[record_hash] += 1
+        yield ph, key
+
+def start_run(db, source: str):
+    """回傳 (run_id, 已處理筆數)；上次未完成的載入會從 checkpoint 繼續"""
+    checkpoint = db.get(EtlCheckpoint, source)
+    if checkpoint is None:
+        checkpoint = EtlCheckpoint(source=source, run_id=0, position=0, completed=True)
+        db.add(checkpoint)
+    if checkpoint.completed:
+        checkpoint.run_id += 1
+        checkpoint.position = 0
+        checkpoint.completed = False
+    db.flush()
+    return checkpoint.run_id, checkpoint.position
+
+def save_checkpoint(db, source: str, position: int, completed: bool = False):
+    checkpoint = db.get(EtlCheckpoint, source)
+    checkpoint.position = position
+    checkpoint.completed = completed
+    db.flush()
+
+def load_pharmacies(json_path: str, batch_size: int = BATCH_SIZE):
+    # IDs are assigned here instead of flushing every row; the ETL is the only writer
+    db = SessionLocal()
+    writer = BulkInserter(db, batch_size)
+    pharmacy_id = next_id(db, Pharmacy)
+    mask_id = next_id(db, Mask)
+    products = ProductIds(db)
+    run_id, _ = start_run(db, "pharmacies")
+    records = StagedRecords(db, run_id, batch_size)
+    position = 0
+
+    def record(kind, key, value, row_id):
+        records.add(kind, key, content_hash(value), row_id)
+
+    for p in iter_json_array(json_path):
+        writer.add(Pharmacy, {
+            "id": pharmacy_id,
+            "name": p["name"],
+            "cash_balance": p.get("cashBalance", 0.0)
+        })
+        record("pharmacy", p["name"], p.get("cashBalance", 0.0), pharmacy_id)
+        record("opening_hours", p["name"], p.get("openingHours", ""), pharmacy_id)
 
         # Masks
         for m in p.get("masks", []):
-            db.add(Mask(
-                name=m["name"],
-                price=m["price"],
-                pharmacy_id=pharmacy.id
-            ))
+            writer.add(Mask, {
+                "id": mask_id,
+                "name": m["name"],
+                "price": m["price"],
+                "pharmacy_id": pharmacy_id,
+                "product_id": products.get(m["name"])
+            })
+            record("mask", mask_key(p["name"], m["name"]), m["price"], mask_id)
+            mask_id += 1
 
         # Opening Hours
         for oh in parse_opening_hours(p.get("openingHours", "")):
-            db.add(OpeningHour(
-                day_of_week=oh["day_of_week"],
-                open_time=oh["open_time"],
-                close_time=oh["close_time"],
-                pharmacy_id=pharmacy.id
-            ))
+            writer.add(OpeningHour, {
+                "day_of_week": oh["day_of_week"],
+                "open_time": oh["open_time"],
+                "close_time": oh["close_time"],
+                "pharmacy_id": pharmacy_id
+            })
+
+        pharmacy_id += 1
+        position += 1
 
+    writer.flush()
+    records.save()
+    save_checkpoint(db, "pharmacies", position, completed=True)
     db.commit()
     db.close()
+    data_revision.bump()
 
-def load_users(json_path: str):
-    with open(json_path, "r") as f:
-        data = json.load(f)
-
+def load_users(json_path: str, batch_size: int = BATCH_SIZE):
     db = SessionLocal()
-    pharmacy_lookup = {p.name: p.id for p in db.query(Pharmacy).all()}
+    writer = BulkInserter(db, batch_size)
+    pharmacy_lookup = dict(db.query(Pharmacy.name, Pharmacy.id).all())
+    user_id = next_id(db, User)
+    first_history_id = history_id = next_history_id(db)
+    products = ProductIds(db)
+    run_id, _ = start_run(db, "users")
+    records = StagedRecords(db, run_id, batch_size)
+    position = 0
 
-    for u in data:
-        user = User(
-            name=u["name"],
-            cash_balance=u.get("cashBalance", 0.0)
-        )
-        db.add(user)
-        db.flush()  # 確保 user.id 可用
+    for u, user_key in keyed_users(iter_json_array(json_path)):
+        writer.add(User, {
+            "id": user_id,
+            "name": u["name"],
+            "cash_balance": u.get("cashBalance", 0.0)
+        })
+        records.add("user", user_key, content_hash(u.get("cashBalance", 0.0)), user_id)
 
         for ph in u.get("purchaseHistories", []):
             pharmacy_id = pharmacy_lookup.get(ph["pharmacyName"])
             if pharmacy_id:
-                db.add(PurchaseHistory(
-                    user_id=user.id,
-                    pharmacy_id=pharmacy_id,
-                    mask_name=ph["maskName"],
-                    transaction_amount=ph["transactionAmount"],
-                    transaction_date=datetime.strptime(ph["transactionDate"], "%Y-%m-%d %H:%M:%S")
-                ))
+                writer.add(PurchaseHistory, {
+                    "id": history_id,
+                    "user_id": user_id,
+                    "pharmacy_id": pharmacy_id,
+                    "product_id": products.get(ph["maskName"]),
+                    "transaction_amount": ph["transactionAmount"],
+                    "transaction_date": parse_transaction_date(ph["transactionDate"])
+                })
+                history_id += 1
 
+        user_id += 1
+        position += 1
+
+    writer.flush()
+    records.save()
+    # hashing every purchase would double the load; the next delta load keys them
+    if history_id > first_history_id:
+        db.add(EtlDeferredPurchases(first_id=first_history_id, last_id=history_id - 1, run_id=run_id))
+    rebuild_rollups(db)
+    save_checkpoint(db, "users", position, completed=True)
     db.commit()
     db.close()
+    data_revision.bump()
+
+def reset_database(engine):
+    """Start over with an empty database: a SQLite file is removed along with
+    its -wal and -shm files, wherever DATABASE_URL puts it; anything else
+    has its tables dropped."""
+    engine.dispose()
+    path = engine.url.database
+    if engine.dialect.name == "sqlite" and path not in (None, "", ":memory:"):
+        for name in (path, f"{path}-wal", f"{path}-shm"):
+            if os.path.exists(name):
+                os.remove(name)
+    else:
+        Base.metadata.drop_all(bind=engine)
 
-def run_etl():
-    if os.path.exists("phantom_mask.db"):
-        os.remove("phantom_mask.db")
+def run_etl(data_dir: str = "data"):
+    reset_database(engine)
     init_db()
-    load_pharmacies("data/pharmacies.json")
-    load_users("data/users.json")
+    load_pharmacies(os.path.join(data_dir, "pharmacies.json"))
+    load_users(os.path.join(data_dir, "users.json"))
 
 if __name__ == "__main__":
-    run_etl()
+    import argparse
+    parser = argparse.ArgumentParser(prog="python -m app.etl")
+    parser.add_argument("--delta", action="store_true", help="apply only what changed since the last load")
+    parser.add_argument("--data-dir", default="data", help="directory with pharmacies.json and users.json")
+    args = parser.parse_args()
+    if args.delta:
+        from app.etl_delta import run_delta_etl
+        run_delta_etl(os.path.join(args.data_dir, "pharmacies.json"), os.path.join(args.data_dir, "users.json"))
+    else:
+        run_etl(args.data_dir)
@@ -0,0 +1,316 @@
+"""Incremental ETL.
+
+Every source record is compared with the content hash the previous load
+stored in etl_records under its natural key, and only new, changed and
+vanished records are written. Progress is committed together with a
+checkpoint every `checkpoint_every` source records, so an interrupted
+load resumes where it stopped instead of starting over.
+
+Natural keys: pharmacies by name, users by name (same-named users numbered
+in file order), masks by (pharmacy, mask name), opening hours by pharmacy,
+purchase histories by user and content.
+
+A full load leaves its purchases without records, as hashing each one
+would double its time; the first delta load keys them from the rows the
+full load wrote (key_deferred_purchases), before it changes anything.
+"""
+from itertools import groupby, islice
+from operator import itemgetter
+
+from sqlalchemy import delete, insert, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from app.cache import data_revision
+from app.database import SessionLocal
+from app.etl import (
+    TRANSACTION_DATE_FORMAT, ProductIds, StagedRecords, content_hash, iter_json_array, keyed_users, mask_key,
+    parse_transaction_date, purchase_records, save_checkpoint, start_run
+)
+from app.models import EtlDeferredPurchases, EtlRecord, Mask, OpeningHour, Pharmacy, Product, PurchaseHistory, User
+from app.partitions import history_tables, history_union, writable
+from app.rollups import record_purchase
+from app.utils import parse_opening_hours
+
+CHECKPOINT_EVERY = 1000
+# keys per IN (...) lookup, well below SQLite's bound parameter limit
+LOOKUP_CHUNK_SIZE = 500
+
+
+def batched(iterable, size: int):
+    iterator = iter(iterable)
+    while batch := list(islice(iterator, size)):
+        yield batch
+
+
+def sync_pharmacies(json_path: str, checkpoint_every: int = CHECKPOINT_EVERY):
+    db = SessionLocal()
+    key_deferred_purchases(db)
+    run_id, position = start_run(db, "pharmacies")
+    _check_baseline(db, run_id, position, Pharmacy)
+    products = ProductIds(db)
+
+    for batch in batched(islice(iter_json_array(json_path), position, None), checkpoint_every):
+        _sync_pharmacy_batch(db, run_id, batch, products)
+        position += len(batch)
+        save_checkpoint(db, "pharmacies", position)
+        db.commit()
+
+    mask_ids = _take_unseen(db, "mask", run_id)
+    _delete_in(db, Mask.__table__.c.id, mask_ids)
+
+    pharmacy_ids = _take_unseen(db, "pharmacy", run_id)
+    _take_unseen(db, "opening_hours", run_id)
+    _delete_in(db, OpeningHour.__table__.c.pharmacy_id, pharmacy_ids)
+    _delete_in(db, Mask.__table__.c.pharmacy_id, pharmacy_ids)
+    _delete_in(db, Pharmacy.__table__.c.id, pharmacy_ids)
+
+    save_checkpoint(db, "pharmacies", position, completed=True)
+    db.commit()
+    db.close()
+    data_revision.bump()
+
+
+def sync_users(json_path: str, checkpoint_every: int = CHECKPOINT_EVERY):
+    db = SessionLocal()
+    key_deferred_purchases(db)
+    run_id, position = start_run(db, "users")
+    _check_baseline(db, run_id, position, User)
+    pharmacy_lookup = dict(db.query(Pharmacy.name, Pharmacy.id).all())
+    products = ProductIds(db)
+
+    users = keyed_users(iter_json_array(json_path))
+    for batch in batched(islice(users, position, None), checkpoint_every):
+        _sync_user_batch(db, run_id, batch, pharmacy_lookup, products)
+        position += len(batch)
+        save_checkpoint(db, "users", position)
+        db.commit()
+
+    _delete_histories(db, "id", _take_unseen(db, "purchase", run_id))
+    user_ids = _take_unseen(db, "user", run_id)
+    _delete_histories(db, "user_id", user_ids)
+    _delete_in(db, User.__table__.c.id, user_ids)
+
+    save_checkpoint(db, "users", position, completed=True)
+    db.commit()
+    db.close()
+    data_revision.bump()
+
+
+def key_deferred_purchases(db):
+    """Write the etl_records of the purchases a full load left without.
+
+    The source record of a purchase is rebuilt from its row: the full load
+    stored its fields as read, and nothing but the delta load changes them.
+    Pharmacy names are read before the delta load renames or removes any.
+    A purchase whose row does not give back its source record (an amount
+    written as an integer, say) is merely replaced by the delta load.
+    """
+    user_keys = None
+    histories = history_union(
+        db, ("id", "user_id", "pharmacy_id", "product_id", "transaction_amount", "transaction_date")
+    ).subquery()
+    for deferred in db.query(EtlDeferredPurchases).order_by(EtlDeferredPurchases.first_id).all():
+        if user_keys is None:
+            user_keys = dict(db.query(EtlRecord.row_id, EtlRecord.key).filter(EtlRecord.kind == "user"))
+        rows = db.execute(
+            select(
+                histories.c.user_id, histories.c.id, Pharmacy.name, Product.name,
+                histories.c.transaction_amount, histories.c.transaction_date
+            )
+            .join(Pharmacy, Pharmacy.id == histories.c.pharmacy_id)
+            .join(Product, Product.id == histories.c.product_id)
+            .where(histories.c.id.between(deferred.first_id, deferred.last_id))
+            .order_by(histories.c.user_id, histories.c.id)
+        )
+        # none of them has a record yet: one sorted insert, as in the full load
+        records = StagedRecords(db, deferred.run_id)
+        for user_id, purchases in groupby(rows, key=itemgetter(0)):
+            purchases = list(purchases)
+            if user_id not in user_keys:
+                continue
+            u = {"purchaseHistories": [
+                {
+                    "pharmacyName": pharmacy_name,
+                    "maskName": mask_name,
+                    "transactionAmount": amount,
+                    "transactionDate": transaction_date.strftime(TRANSACTION_DATE_FORMAT)
+                }
+                for _, _, pharmacy_name, mask_name, amount, transaction_date in purchases
+            ]}
+            for row, (_, key) in zip(purchases, purchase_records(u, user_keys[user_id])):
+                records.add("purchase", key, key, row[1])
+        records.save()
+        db.delete(deferred)
+        db.commit()
+
+
+def run_delta_etl(
+    pharmacies_path: str = "data/pharmacies.json",
+    users_path: str = "data/users.json",
+    checkpoint_every: int = CHECKPOINT_EVERY
+):
+    sync_pharmacies(pharmacies_path, checkpoint_every)
+    sync_users(users_path, checkpoint_every)
+
+
+def _sync_pharmacy_batch(db, run_id: int, batch: list, products: ProductIds):
+    names = [p["name"] for p in batch]
+    known_pharmacies = _load_records(db, "pharmacy", names)
+    known_hours = _load_records(db, "opening_hours", names)
+    known_masks = _load_records(db, "mask", [
+        mask_key(p["name"], m["name"]) for p in batch for m in p.get("masks", [])
+    ])
+    pharmacies, masks = Pharmacy.__table__, Mask.__table__
+    records = []
+
+    for p in batch:
+        name = p["name"]
+        balance = p.get("cashBalance", 0.0)
+        pharmacy_id = _apply_record(
+            db, known_pharmacies.get(name), content_hash(balance),
+            insert_stmt=insert(pharmacies).values(name=name, cash_balance=balance),
+            update_stmt=update(pharmacies).values(cash_balance=balance)
+        )
+        records.append(("pharmacy", name, content_hash(balance), pharmacy_id))
+
+        opening_hours = p.get("openingHours", "")
+        digest = content_hash(opening_hours)
+        known = known_hours.get(name)
+        if known is None or known[0] != digest:
+            db.execute(delete(OpeningHour.__table__).where(OpeningHour.__table__.c.pharmacy_id == pharmacy_id))
+            rows = [dict(oh, pharmacy_id=pharmacy_id) for oh in parse_opening_hours(opening_hours)]
+            if rows:
+                db.execute(insert(OpeningHour.__table__), rows)
+        records.append(("opening_hours", name, digest, pharmacy_id))
+
+        for m in p.get("masks", []):
+            key = mask_key(name, m["name"])
+            mask_id = _apply_record(
+                db, known_masks.get(key), content_hash(m["price"]),
+                insert_stmt=insert(masks).values(
+                    name=m["name"], price=m["price"], pharmacy_id=pharmacy_id, product_id=products.get(m["name"])
+                ),
+                update_stmt=update(masks).values(price=m["price"])
+            )
+            records.append(("mask", key, content_hash(m["price"]), mask_id))
+
+    _save_records(db, run_id, records)
+
+
+def _sync_user_batch(db, run_id: int, batch: list, pharmacy_lookup: dict, products: ProductIds):
+    known_users = _load_records(db, "user", [user_key for _, user_key in batch])
+    known_purchases = _load_records(db, "purchase", [
+        key for u, user_key in batch for _, key in purchase_records(u, user_key)
+    ])
+    users, histories = User.__table__, PurchaseHistory.__table__
+    records = []
+
+    for u, user_key in batch:
+        balance = u.get("cashBalance", 0.0)
+        user_id = _apply_record(
+            db, known_users.get(user_key), content_hash(balance),
+            insert_stmt=insert(users).values(name=u["name"], cash_balance=balance),
+            update_stmt=update(users).values(cash_balance=balance)
+        )
+        records.append(("user", user_key, content_hash(balance), user_id))
+
+        for ph, key in purchase_records(u, user_key):
+            # purchases at a pharmacy that is gone are left unseen and removed
+            pharmacy_id = pharmacy_lookup.get(ph["pharmacyName"])
+            if not pharmacy_id:
+                continue
+            if key in known_purchases:
+                records.append(("purchase", key, key, known_purchases[key][1]))
+                continue
+            transaction_date = parse_transaction_date(ph["transactionDate"])
+            history_id = db.execute(insert(histories).values(
+                user_id=user_id,
+                pharmacy_id=pharmacy_id,
+                product_id=products.get(ph["maskName"]),
+                transaction_amount=ph["transactionAmount"],
+                transaction_date=transaction_date
+            ).returning(histories.c.id)).scalar_one()
+            record_purchase(db, user_id, transaction_date, 1, ph["transactionAmount"])
+            records.append(("purchase", key, key, history_id))
+
+    _save_records(db, run_id, records)
+
+
+def _apply_record(db, known, digest: str, insert_stmt, update_stmt) -> int:
+    """Insert a new record or update a changed one; returns its row id."""
+    if known is None:
+        return db.execute(insert_stmt.returning(insert_stmt.table.c.id)).scalar_one()
+    stored_digest, row_id = known
+    if stored_digest != digest:
+        db.execute(update_stmt.where(update_stmt.table.c.id == row_id))
+    return row_id
+
+
+def _check_baseline(db, run_id: int, position: int, model):
+    # a database filled before etl_records existed cannot be diffed
+    if run_id == 1 and position == 0 and db.query(model.id).first() is not None:
+        raise RuntimeError(
+            f"{model.__tablename__} has rows without ETL records; run the full ETL once before delta loads"
+        )
+
+
+def _load_records(db, kind: str, keys: list) -> dict:
+    found = {}
+    for chunk in batched(set(keys), LOOKUP_CHUNK_SIZE):
+        rows = db.query(EtlRecord.key, EtlRecord.content_hash, EtlRecord.row_id).filter(
+            EtlRecord.kind == kind,
+            EtlRecord.key.in_(chunk)
+        )
+        for key, digest, row_id in rows:
+            found[key] = (digest, row_id)
+    return found
+
+
+def _save_records(db, run_id: int, records: list):
+    if not records:
+        return
+    stmt = sqlite_insert(EtlRecord)
+    db.execute(
+        stmt.on_conflict_do_update(
+            index_elements=[EtlRecord.kind, EtlRecord.key],
+            set_={
+                "content_hash": stmt.excluded.content_hash,
+                "row_id": stmt.excluded.row_id,
+                "run_id": stmt.excluded.run_id
+            }
+        ),
+        [
+            {"kind": kind, "key": key, "content_hash": digest, "row_id": row_id, "run_id": run_id}
+            for kind, key, digest, row_id in records
+        ]
+    )
+
+
+def _take_unseen(db, kind: str, run_id: int) -> list:
+    """Drop the records of `kind` missing from this run; returns their row ids."""
+    unseen = (EtlRecord.kind == kind, EtlRecord.run_id != run_id)
+    row_ids = [row_id for (row_id,) in db.query(EtlRecord.row_id).filter(*unseen)]
+    db.execute(delete(EtlRecord).where(*unseen))
+    return row_ids
+
+
+def _delete_in(db, column, values: list):
+    for chunk in batched(values, LOOKUP_CHUNK_SIZE):
+        db.execute(delete(column.table).where(column.in_(chunk)))
+
+
+def _delete_histories(db, column_name: str, values: list):
+    # from every partition, archived months included
+    for table in history_tables(db):
+        column = table.c[column_name]
+        for chunk in batched(values, LOOKUP_CHUNK_SIZE):
+            rows = db.execute(
+                select(table.c.user_id, table.c.transaction_date, table.c.transaction_amount).where(column.in_(chunk))
+            ).all()
+            if not rows:
+                continue
+            # take the deleted purchases back out of the rollups
+            for user_id, transaction_date, amount in rows:
+                record_purchase(db, user_id, transaction_date, -1, -amount)
+            with writable(db, table):
+                db.execute(delete(table).where(column.in_(chunk)))
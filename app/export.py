@@ -0,0 +1,137 @@
+"""Bulk export of purchase histories as NDJSON or CSV.
+
+Rows are read through a server-side cursor (yield_per) in id order and
+written out one batch at a time, so memory stays flat however many rows
+match.
+
+    python -m app.export --format csv --start-date 2021-01-01 --output purchases.csv
+"""
+import argparse
+import csv
+import io
+import json
+import sys
+from datetime import datetime, timedelta
+from typing import Iterable, List, Optional
+
+from sqlalchemy import Table, select, union_all
+
+from app.models import Product
+from app.partitions import history_tables, in_range
+
+FORMATS = {
+    "ndjson": "application/x-ndjson",
+    "csv": "text/csv",
+}
+COLUMNS = ("id", "user_id", "pharmacy_id", "mask_name", "transaction_amount", "transaction_date")
+PRODUCTS = Product.__table__
+# rows fetched from the cursor and written per chunk
+YIELD_PER = 1000
+
+
+def export_query(
+    tables: List[Table],
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    user_id: Optional[int] = None,
+    pharmacy_id: Optional[int] = None
+):
+    """Histories with start <= transaction_date < end in `tables`, ordered by id."""
+    selects = []
+    for table in tables:
+        # a purchase names its mask through its product; labelled, so the
+        # union below is ordered by its own id rather than the products one
+        columns = [
+            (PRODUCTS.c.name if column == "mask_name" else table.c[column]).label(column)
+            for column in COLUMNS
+        ]
+        query = select(*columns).outerjoin_from(table, PRODUCTS, table.c.product_id == PRODUCTS.c.id)
+        query = in_range(query, table, start, end)
+        if user_id is not None:
+            query = query.where(table.c.user_id == user_id)
+        if pharmacy_id is not None:
+            query = query.where(table.c.pharmacy_id == pharmacy_id)
+        selects.append(query)
+    # SQLite merges the id-ordered partitions rather than sorting their union
+    query = selects[0] if len(selects) == 1 else union_all(*selects)
+    return query.order_by(query.selected_columns.id).execution_options(yield_per=YIELD_PER)
+
+
+def header(fmt: str) -> str:
+    return ",".join(COLUMNS) + "\r\n" if fmt == "csv" else ""
+
+
+def format_rows(rows: Iterable, fmt: str) -> str:
+    if fmt == "csv":
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        for row in rows:
+            writer.writerow(row[:-1] + (row[-1].isoformat(sep=" "),))
+        return buffer.getvalue()
+    return "".join(
+        json.dumps(dict(zip(COLUMNS, row[:-1] + (row[-1].isoformat(sep=" "),))), ensure_ascii=False) + "\n"
+        for row in rows
+    )
+
+
+def iter_export(db, fmt: str, **filters):
+    """Export chunks read through a sync session."""
+    yield header(fmt)
+    tables = history_tables(db, filters.get("start"), filters.get("end"))
+    for chunk in db.execute(export_query(tables, **filters)).partitions():
+        yield format_rows(chunk, fmt)
+
+
+async def stream_export(session_factory, fmt: str, **filters):
+    """Export chunks read through an async session, for a StreamingResponse.
+
+    The session is opened here rather than taken from a request dependency,
+    because the response body is produced after the endpoint has returned.
+    """
+    async with session_factory() as db:
+        yield header(fmt)
+        tables = await db.run_sync(history_tables, filters.get("start"), filters.get("end"))
+        result = await db.stream(export_query(tables, **filters))
+        async for chunk in result.partitions():
+            yield format_rows(chunk, fmt)
+
+
+def parse_date(value: str) -> datetime:
+    try:
+        return datetime.strptime(value, "%Y-%m-%d")
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid date {value!r}, use YYYY-MM-DD")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m app.export", description="Export purchase histories")
+    parser.add_argument("--format", choices=list(FORMATS), default="ndjson")
+    parser.add_argument("--start-date", type=parse_date, help="first day, YYYY-MM-DD")
+    parser.add_argument("--end-date", type=parse_date, help="last day (inclusive), YYYY-MM-DD")
+    parser.add_argument("--user-id", type=int)
+    parser.add_argument("--pharmacy-id", type=int)
+    parser.add_argument("--output", help="file to write, default stdout")
+    args = parser.parse_args(argv)
+
+    from app.database import SessionLocal
+
+    db = SessionLocal()
+    out = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    try:
+        for chunk in iter_export(
+            db,
+            args.format,
+            start=args.start_date,
+            end=args.end_date + timedelta(days=1) if args.end_date else None,
+            user_id=args.user_id,
+            pharmacy_id=args.pharmacy_id
+        ):
+            out.write(chunk)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
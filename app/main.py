@@ -1,123 +1,218 @@
 from fastapi import FastAPI, Depends, Query, HTTPException
+from fastapi.responses import ORJSONResponse, PlainTextResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy import select
 from typing import List, Optional
+from contextlib import asynccontextmanager
 from datetime import datetime, time, timedelta
 
 from app import models, schemas
-from app.database import get_db
+from app.database import AsyncSessionLocal, SessionLocal, async_engine, engine, get_async_db, get_db
+from app.migrations import migrate
 from app.utils import WEEKDAYS
-
-app = FastAPI()
+from app.search import search_indexes
+from app.catalog import catalog
+from app.opening_hours import MAX_BATCH_SLOTS, entry_key, opening_hours_indexes
+from app.rollups import summarize_transactions, top_spenders
+from app.purchases import GROUP_COMMIT, MAX_BATCH_ORDERS, GroupCommitQueue, execute_purchase, execute_purchase_batch
+from app.cache import ResponseCacheMiddleware
+from app.metrics import MetricsMiddleware, metrics
+from app.profiling import PROFILING, ProfilingMiddleware, record_query_plans
+from app.pagination import decode_cursor, limit_param, paginate
+from app.export import FORMATS, stream_export
+from app.serialization import page_response, rows_as_dicts
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # bring an existing database up to the current schema without re-running the ETL
+    migrate(engine)
+    async with AsyncSessionLocal() as db:
+        await catalog.current(db)
+    yield
+    if group_commit is not None:
+        group_commit.close()
+    await async_engine.dispose()
+
+# off by default: every POST /purchase commits on its own
+group_commit = GroupCommitQueue(SessionLocal) if GROUP_COMMIT else None
+
+app = FastAPI(lifespan=lifespan)
+app.add_middleware(ResponseCacheMiddleware)
+# off by default, and then not installed at all
+if PROFILING != "off":
+    record_query_plans(engine)
+    record_query_plans(async_engine.sync_engine)
+    app.add_middleware(ProfilingMiddleware)
+# outermost, so cached responses are measured too
+app.add_middleware(MetricsMiddleware)
 
 @app.get("/")
 def root():
     return {"message": "Phantom Mask API is live"}
 
 
-@app.get("/pharmacies/open", response_model=List[schemas.PharmacyOpenInfo])
-def get_open_pharmacies(
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+def parse_open_time(time_str: str):
+    try:
+        return datetime.strptime(time_str, "%H:%M").time()
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid time format")
+
+def to_open_info(entries):
+    # entries are (id, name, day_of_week, open_time, close_time)
+    return rows_as_dicts(schemas.PharmacyOpenInfo, entries)
+
+@app.get("/pharmacies/open", response_model=schemas.Page[schemas.PharmacyOpenInfo])
+async def get_open_pharmacies(
     day: Optional[str] = Query(None, examples={"example": {"value": "Mon"}}),
     time: Optional[str] = Query(None, examples={"example": {"value": "10:00"}}),
-    db: Session = Depends(get_db)
+    limit: int = limit_param(),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db)
 ):
     # Monday" → "Mon" 
     if day:
         day = WEEKDAYS.get(day, day)
 
     # string to time conversion
-    target_time = None
-    if time:
-        try:
-            target_time = datetime.strptime(time, "%H:%M").time()
-        except ValueError:
-            raise HTTPException(status_code=400, detail="Invalid time format")
+    target_time = parse_open_time(time) if time else None
 
-    query = db.query(models.Pharmacy, models.OpeningHour).join(models.OpeningHour)
+    after = decode_cursor(cursor, "open")
 
-    # filter by day and time if provided
-    if day:
-        query = query.filter(models.OpeningHour.day_of_week == day)
-    if target_time:
-        query = query.filter(
-            models.OpeningHour.open_time <= target_time,
-            models.OpeningHour.close_time >= target_time
-        )
+    index = await opening_hours_indexes.get_async(db)
+    entries, next_cursor = paginate(
+        index.query_page(day or None, target_time, after, limit + 1), limit, "open", entry_key
+    )
+    return page_response(to_open_info(entries), next_cursor)
 
-    result = query.all()
 
-    return [
-        schemas.PharmacyOpenInfo(
-            id=pharmacy.id,
-            name=pharmacy.name,
-            day_of_week=oh.day_of_week,
-            open_time=oh.open_time,
-            close_time=oh.close_time
-        )
-        for pharmacy, oh in result
-    ]
+@app.get("/pharmacies/open_now", response_model=schemas.Page[schemas.PharmacyOpenInfo])
+async def get_pharmacies_open_now(
+    limit: int = limit_param(),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db)
+):
+    after = decode_cursor(cursor, "open_now")
+
+    index = await opening_hours_indexes.get_async(db)
+    entries, next_cursor = paginate(
+        index.open_at_page(datetime.now(), after, limit + 1), limit, "open_now", entry_key
+    )
+    return page_response(to_open_info(entries), next_cursor)
 
 
-@app.get("/pharmacies/{pharmacy_name}/masks", response_model=List[schemas.MaskSchema])
-def list_masks_by_pharmacy_name(
+@app.post("/pharmacies/open/batch", response_model=List[schemas.OpenSlotResult])
+async def get_open_pharmacies_batch(
+    slots: List[schemas.OpenSlot],
+    limit: int = limit_param(),
+    db: AsyncSession = Depends(get_async_db)
+):
+    if len(slots) > MAX_BATCH_SLOTS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_SLOTS} slots per batch.")
+    parsed = [(WEEKDAYS.get(slot.day, slot.day), parse_open_time(slot.time)) for slot in slots]
+
+    # each slot is a first page of /pharmacies/open, so its cursor continues there
+    index = await opening_hours_indexes.get_async(db)
+    results = []
+    for slot, (day, at) in zip(slots, parsed):
+        entries, next_cursor = paginate(index.query_page(day, at, None, limit + 1), limit, "open", entry_key)
+        results.append({
+            "day": slot.day,
+            "time": slot.time,
+            "pharmacies": to_open_info(entries),
+            "next_cursor": next_cursor
+        })
+    return ORJSONResponse(results)
+
+
+@app.get("/pharmacies/{pharmacy_name}/masks", response_model=schemas.Page[schemas.MaskSchema])
+async def list_masks_by_pharmacy_name(
     pharmacy_name: str,
     sort_by: Optional[str] = Query("name", enum=["name", "price"]),
     order: Optional[str] = Query("asc", enum=["asc", "desc"]),
-    db: Session = Depends(get_db)
+    limit: int = limit_param(),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db)
 ):
-    pharmacy = db.query(models.Pharmacy).filter(models.Pharmacy.name == pharmacy_name).first()
-    
-    if not pharmacy:
-        raise HTTPException(status_code=404, detail="Pharmacy not found")
+    listing = f"masks:{sort_by}:{order}"
+    after = decode_cursor(cursor, listing)
 
-    query = db.query(models.Mask).filter(models.Mask.pharmacy_id == pharmacy.id)
-    
-    # Apply sorting if specified (default is by name)
-    sort_column = models.Mask.price if sort_by == "price" else models.Mask.name
-
-    if order == "desc":
-        query = query.order_by(sort_column.desc())
-    else:  # Default to ascending order
-        query = query.order_by(sort_column)
+    catalog_snapshot = await catalog.current(db)
+    index = catalog_snapshot.pharmacy_index(pharmacy_name)
+    if index is None:
+        raise HTTPException(status_code=404, detail="Pharmacy not found")
 
-    return query.all()
+    # sorted by name (the default) or price, the mask id breaks ties
+    rows = catalog_snapshot.masks_page(index, sort_by, order == "desc", after, limit + 1)
+    rows, next_cursor = paginate(
+        rows, limit, listing, lambda row: (row[1] if sort_by == "price" else row[0], row[2])
+    )
+    return page_response(rows_as_dicts(schemas.MaskSchema, ((name, price) for name, price, _ in rows)), next_cursor)
 
-@app.get("/pharmacies/mask_count", response_model=List[schemas.PharmacyMaskCountSchema])
-def mask_count(
+@app.get("/pharmacies/mask_count", response_model=schemas.Page[schemas.PharmacyMaskCountSchema])
+async def mask_count(
     min_price: float = Query(...),
     max_price: float = Query(...),
     count: int = Query(...),
     op: str = Query(..., pattern="^(gt|lt)$"),
-    db: Session = Depends(get_db)
+    limit: int = limit_param(),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db)
 ):
-    op_map = {
-        'gt': lambda a, b: a > b,
-        'lt': lambda a, b: a < b
-    }
+    after = decode_cursor(cursor, "mask_count")
 
-    pharmacies = db.query(models.Pharmacy).all()
-    result = []
-
-    for pharmacy in pharmacies:
-        # Filter masks by price range
-        filtered_masks = [
-            m for m in pharmacy.masks
-            if min_price <= m.price <= max_price
-        ]
-
-        # Check if the count of filtered masks meets the condition
-        if op_map[op](len(filtered_masks), count):
-            result.append(schemas.PharmacyMaskCountSchema(
-                id=pharmacy.id,
-                name=pharmacy.name,
-                mask_count=len(filtered_masks),
-                masks=[
-                    schemas.FilteredMask(name=m.name, price=m.price)
-                    for m in filtered_masks
-                ]
-            ))
-
-    return result
+    # pharmacies with more or fewer than `count` masks priced in the range, in id order
+    catalog_snapshot = await catalog.current(db)
+    matching = catalog_snapshot.mask_count_page(
+        min_price, max_price, count, op, after[0] if after else None, limit + 1
+    )
+    matching, next_cursor = paginate(matching, limit, "mask_count", lambda row: (row[0],))
+
+    return page_response(
+        rows_as_dicts(
+            schemas.PharmacyMaskCountSchema,
+            (
+                (pharmacy_id, name, total, [{"name": mask_name, "price": price} for mask_name, price in masks])
+                for pharmacy_id, name, total, masks in matching
+            )
+        ),
+        next_cursor
+    )
+
+@app.get("/masks/cheapest", response_model=schemas.CheapestOffers)
+async def cheapest_offers(
+    product_id: Optional[int] = None,
+    mask_name: Optional[str] = Query(None, examples={"example": {"value": "True Barrier (green) (3 per pack)"}}),
+    top: int = Query(5, ge=1, le=100),
+    day: Optional[str] = Query(None, examples={"example": {"value": "Mon"}}),
+    time: Optional[str] = Query(None, examples={"example": {"value": "10:00"}}),
+    db: AsyncSession = Depends(get_async_db)
+):
+    if product_id is None and not mask_name:
+        raise HTTPException(status_code=400, detail="Specify product_id or mask_name.")
+    if day:
+        day = WEEKDAYS.get(day, day)
+    target_time = parse_open_time(time) if time else None
+
+    catalog_snapshot = await catalog.current(db)
+    index = catalog_snapshot.product_index(product_id, mask_name)
+    if index is None:
+        raise HTTPException(status_code=404, detail="Product not found")
+
+    # only pharmacies open at the given day and/or time
+    open_ids = None
+    if day or target_time:
+        hours = await opening_hours_indexes.get_async(db)
+        open_ids = {entry[0] for entry in hours.query(day or None, target_time)}
+
+    product = dict(zip(schemas.ProductSchema.model_fields, catalog_snapshot.products[index]))
+    offers = rows_as_dicts(schemas.MaskOffer, catalog_snapshot.cheapest_offers(index, top, open_ids))
+    return ORJSONResponse({"product": product, "offers": offers})
 
 def validate_date_format(date_str: str) -> datetime:
     try:
@@ -127,171 +222,95 @@ def validate_date_format(date_str: str) -> datetime:
     return date
 
 @app.get("/users/top_users", response_model=List[schemas.UserWithTotalAmount])
-def get_top_users(
+async def get_top_users(
     top: int = Query(5, ge=1), # Minimum limit of 1, default to 5
     start_date: Optional[str] = None, # YYYY-MM-DD format
     end_date: Optional[str] = None, # YYYY-MM-DD format
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    query = db.query(
-        models.User,
-        func.sum(models.PurchaseHistory.transaction_amount).label("total_amount")
-    ).join(models.PurchaseHistory).group_by(models.User.id)
-
-    if start_date:
-        start = validate_date_format(start_date)
-        query = query.filter(models.PurchaseHistory.transaction_date >= start)
-
-    if end_date:
-        end = validate_date_format(end_date) + timedelta(days=1) - timedelta(seconds=1)
-        query = query.filter(models.PurchaseHistory.transaction_date <= end)
-        
-    query = query.order_by(func.sum(models.PurchaseHistory.transaction_amount).desc()).limit(top)
-
-    result = query.all()
+    first_day = validate_date_format(start_date).date() if start_date else None
+    last_day = validate_date_format(end_date).date() if end_date else None
+
+    top_users = top_spenders(top, first_day, last_day)
+    result = await db.execute(
+        select(models.User.id, models.User.name, models.User.cash_balance, top_users.c.total_amount)
+        .join(top_users, top_users.c.user_id == models.User.id)
+        .order_by(top_users.c.total_amount.desc())
+    )
 
-    return [
-        schemas.UserWithTotalAmount(
-            id=user.id,
-            name=user.name,
-            cash_balance=user.cash_balance,
-            total_amount=round(total_amount, 2)
-        )
-        for user, total_amount in result
-    ]
+    return ORJSONResponse(rows_as_dicts(
+        schemas.UserWithTotalAmount,
+        ((user_id, name, cash_balance, round(total_amount, 2)) for user_id, name, cash_balance, total_amount in result)
+    ))
 
 
 @app.get("/transactions/summary")
-def get_transaction_summary(
+async def get_transaction_summary(
     start_date: Optional[str] = None, # YYYY-MM-DD format
     end_date: Optional[str] = None, # YYYY-MM-DD format
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    query = db.query(models.PurchaseHistory)
-
-    if start_date:
-        start = validate_date_format(start_date)
-        query = query.filter(models.PurchaseHistory.transaction_date >= start)
+    start = validate_date_format(start_date) if start_date else None
+    # end_date is inclusive, so the range runs up to the next midnight
+    end = validate_date_format(end_date) + timedelta(days=1) if end_date else None
 
-    if end_date:
-        end = validate_date_format(end_date) + timedelta(days=1) - timedelta(seconds=1)
-        query = query.filter(models.PurchaseHistory.transaction_date <= end)
-
-    total_value = sum([p.transaction_amount for p in query.all()])
-    total_count = query.count()
+    total_count, total_value = await db.run_sync(summarize_transactions, start, end)
 
     return {
         "total_transactions": total_count,
         "total_amount": round(total_value, 2)
     }
 
-@app.get("/search", response_model=List[schemas.SearchResult])
-def search_items(
+@app.get("/purchases/export")
+async def export_purchases(
+    fmt: str = Query("ndjson", alias="format", pattern="^(ndjson|csv)$"),
+    start_date: Optional[str] = None, # YYYY-MM-DD format
+    end_date: Optional[str] = None, # YYYY-MM-DD format, inclusive
+    user_id: Optional[int] = None,
+    pharmacy_id: Optional[int] = None
+):
+    start = validate_date_format(start_date) if start_date else None
+    end = validate_date_format(end_date) + timedelta(days=1) if end_date else None
+
+    return StreamingResponse(
+        stream_export(AsyncSessionLocal, fmt, start=start, end=end, user_id=user_id, pharmacy_id=pharmacy_id),
+        media_type=FORMATS[fmt],
+        headers={"Content-Disposition": f'attachment; filename="purchase_histories.{fmt}"'}
+    )
+
+@app.get("/search", response_model=schemas.Page[schemas.SearchResult])
+async def search_items(
     keyword: str = Query(..., min_length=1),
-    db: Session = Depends(get_db)
+    limit: int = limit_param(),
+    cursor: Optional[str] = None,
+    db: AsyncSession = Depends(get_async_db)
 ):
-    keyword_lower = keyword.lower()
-    results = []
+    listing = f"search:{keyword}"
+    after = decode_cursor(cursor, listing)
 
-    # Search pharmacies
-    pharmacies = db.query(models.Pharmacy).all()
-    for p in pharmacies:
-        if keyword_lower in p.name.lower():
-            results.append({
-                "type": "pharmacy",
-                "name": p.name,
-                "relevance": len(keyword) / len(p.name)
-            })
-
-    # Search masks
-    masks = db.query(models.Mask).all()
-    for m in masks:
-        if keyword_lower in m.name.lower():
-            results.append({
-                "type": "mask",
-                "name": m.name,
-                "relevance": len(keyword) / len(m.name)
-            })
-
-    return sorted(results, key=lambda x: x["relevance"], reverse=True)
+    index = await search_indexes.get_async(db)
+    results, keys = index.search_page(keyword, limit + 1, after)
+    page, next_cursor = paginate(list(zip(results, keys)), limit, listing, lambda hit: hit[1])
+    return page_response([result for result, _ in page], next_cursor)
 
+# writes stay on the sync session: a purchase is one short transaction with its own busy retries
 @app.post("/purchase", response_model=schemas.PurchaseResponse)
 def purchase_masks(purchase: schemas.PurchaseRequest, db: Session = Depends(get_db)):
-    # check if user exists
-    user = db.query(models.User).filter(models.User.id == purchase.user_id).first()
-
-    if not user:
-        raise HTTPException(status_code=404, detail="User not found")
-
-    total_cost = 0
-
-    # check if all masks exist and calculate total cost
-    for item in purchase.purchases:
-
-        mask = db.query(models.Mask).filter(
-            models.Mask.id == item.mask_id,
-            models.Mask.pharmacy_id == item.pharmacy_id
-        ).first()
-
-        if not mask:
-            raise HTTPException(status_code=404, detail=f"Mask {item.mask_id} not found in pharmacy {item.pharmacy_id}")
-        
-        # if mask.price is None:
-        #     raise HTTPException(status_code=500, detail=f"Mask {mask.id} has no price")
-
-        total_cost += round(mask.price * item.quantity, 2)
-
-    # check if user has enough balance
-    if user.cash_balance < total_cost:
-        raise HTTPException(status_code=400, detail="Insufficient balance")
-
-    details = []
-    now = datetime.now()
-
-    # execute the purchase and update database
-    for item in purchase.purchases:
-        pharmacy = db.query(models.Pharmacy).filter(models.Pharmacy.id == item.pharmacy_id).first()
-        if not pharmacy:
-            raise HTTPException(status_code=404, detail=f"Pharmacy {item.pharmacy_id} not found")
-
-        mask = db.query(models.Mask).filter(
-            models.Mask.id == item.mask_id,
-            models.Mask.pharmacy_id == item.pharmacy_id
-        ).first()
-
-        item_total = round(mask.price * item.quantity, 2)
-
-        # update purchase history
-        db.add(models.PurchaseHistory(
-            user_id=user.id,
-            pharmacy_id=pharmacy.id,
-            mask_name=mask.name,
-            transaction_amount=item_total,
-            transaction_date=now
-        ))
-
-        # update pharmacy cash balance
-        pharmacy.cash_balance += item_total
-
-        # return purchase details
-        details.append(schemas.PurchaseItemDetail(
-            pharmacy_id=pharmacy.id,
-            pharmacy_name=pharmacy.name,
-            mask_id=mask.id,
-            mask_name=mask.name,
-            quantity=item.quantity,
-            unit_price=mask.price,
-            total_price=item_total
-        ))
-
-    # update user's cash balance
-    user.cash_balance -= total_cost
-
-    db.commit()
-
-    return schemas.PurchaseResponse(
-        message="Purchase successful",
-        total_cost=round(total_cost, 2),
-        remaining_balance=round(user.cash_balance, 2),
-        details=details
-    )
+    if group_commit is not None:
+        return group_commit.submit(purchase)
+    return execute_purchase(db, purchase)
+
+
+@app.post("/purchase/batch", response_model=List[schemas.BatchPurchaseResult])
+def purchase_masks_batch(purchases: List[schemas.PurchaseRequest], db: Session = Depends(get_db)):
+    if len(purchases) > MAX_BATCH_ORDERS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_ORDERS} orders per batch.")
+
+    # one transaction for all orders; each order succeeds or fails on its own
+    results = execute_purchase_batch(db, purchases)
+    return [
+        schemas.BatchPurchaseResult(user_id=purchase.user_id, status_code=result.status_code, detail=result.detail)
+        if isinstance(result, HTTPException)
+        else schemas.BatchPurchaseResult(user_id=purchase.user_id, status_code=200, result=result)
+        for purchase, result in zip(purchases, results)
+    ]
@@ -0,0 +1,248 @@
+"""Request and SQL metrics in the Prometheus text format.
+
+MetricsMiddleware times every request and labels it with its route
+template. While a request runs, its RequestStats sits in a context
+variable, and the cursor hooks that instrument_engine() puts on an engine
+add each statement, its rows and its time to it. GET /metrics renders
+everything with render().
+
+Rows are counted where the request's context is at hand: as the sync
+driver hands them out (CountingCursor), and, as the async driver fetches
+them on a thread of its own, per result of a CountingSession.
+"""
+import sqlite3
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from threading import Lock
+from typing import Dict, Optional, Sequence, Tuple
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from starlette.routing import Match
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 250)
+
+
+class RequestStats:
+    __slots__ = ("statements", "rows", "sql_seconds")
+
+    def __init__(self):
+        self.statements = 0
+        self.rows = 0
+        self.sql_seconds = 0.0
+
+
+_current_stats: ContextVar[Optional[RequestStats]] = ContextVar("request_stats", default=None)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count")
+
+    def __init__(self, buckets: Sequence[float]):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self):
+        self._lock = Lock()
+        self.requests: Dict[Tuple[str, str, str], int] = {}
+        self.latency: Dict[Tuple[str, str], Histogram] = {}
+        self.sql_statements: Dict[Tuple[str, str], int] = {}
+        self.sql_rows: Dict[Tuple[str, str], int] = {}
+        self.sql_time: Dict[Tuple[str, str], Histogram] = {}
+        self.statements_per_request: Dict[Tuple[str, str], Histogram] = {}
+
+    def observe_request(self, method: str, route: str, status: int, seconds: float, stats: RequestStats):
+        key = (method, route)
+        with self._lock:
+            self.requests[key + (str(status),)] = self.requests.get(key + (str(status),), 0) + 1
+            self._histogram(self.latency, key, LATENCY_BUCKETS).observe(seconds)
+            self.sql_statements[key] = self.sql_statements.get(key, 0) + stats.statements
+            self.sql_rows[key] = self.sql_rows.get(key, 0) + stats.rows
+            self._histogram(self.sql_time, key, LATENCY_BUCKETS).observe(stats.sql_seconds)
+            self._histogram(self.statements_per_request, key, STATEMENT_BUCKETS).observe(stats.statements)
+
+    def reset(self):
+        with self._lock:
+            for series in (
+                self.requests, self.latency, self.sql_statements, self.sql_rows,
+                self.sql_time, self.statements_per_request
+            ):
+                series.clear()
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            _counter(lines, "phantom_mask_http_requests_total", "Requests handled, by route and status.",
+                     self.requests, ("method", "route", "status"))
+            _histograms(lines, "phantom_mask_http_request_duration_seconds", "Request latency.", self.latency)
+            _counter(lines, "phantom_mask_sql_statements_total", "SQL statements executed while serving the route.",
+                     self.sql_statements, ("method", "route"))
+            _counter(lines, "phantom_mask_sql_rows_total", "Rows fetched or written by those statements.",
+                     self.sql_rows, ("method", "route"))
+            _histograms(lines, "phantom_mask_sql_duration_seconds", "Time spent in SQL per request.", self.sql_time)
+            _histograms(lines, "phantom_mask_sql_statements_per_request", "SQL statements per request.",
+                        self.statements_per_request)
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _histogram(series: dict, key, buckets) -> Histogram:
+        histogram = series.get(key)
+        if histogram is None:
+            histogram = series[key] = Histogram(buckets)
+        return histogram
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: Sequence[str], values: Sequence[str], **extra) -> str:
+    pairs = list(zip(names, values)) + list(extra.items())
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+def _counter(lines: list, name: str, help_text: str, series: dict, label_names: Sequence[str]):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} counter")
+    for key, value in sorted(series.items()):
+        lines.append(f"{name}{_labels(label_names, key)} {value}")
+
+
+def _histograms(lines: list, name: str, help_text: str, series: dict):
+    lines.append(f"# HELP {name} {help_text}")
+    lines.append(f"# TYPE {name} histogram")
+    for key, histogram in sorted(series.items()):
+        cumulative = 0
+        for bound, count in zip(list(histogram.buckets) + ["+Inf"], histogram.counts):
+            cumulative += count
+            lines.append(f"{name}_bucket{_labels(('method', 'route'), key, le=bound)} {cumulative}")
+        lines.append(f"{name}_sum{_labels(('method', 'route'), key)} {histogram.sum}")
+        lines.append(f"{name}_count{_labels(('method', 'route'), key)} {histogram.count}")
+
+
+class CountingCursor(sqlite3.Cursor):
+    """sqlite3 cursor that adds the rows it hands out to the current request."""
+
+    def fetchone(self):
+        row = super().fetchone()
+        if row is not None:
+            _add_rows(1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = super().fetchmany(*args, **kwargs)
+        _add_rows(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = super().fetchall()
+        _add_rows(len(rows))
+        return rows
+
+
+class CountingConnection(sqlite3.Connection):
+    """Pass as the sqlite3 `factory` connect argument to count fetched rows."""
+
+    def cursor(self, factory=CountingCursor):
+        return super().cursor(factory)
+
+
+class CountingSession(Session):
+    """Session that adds the rows of each result to the current request;
+    the sync session class of sessions on the async driver."""
+
+
+@event.listens_for(CountingSession, "do_orm_execute")
+def _count_result_rows(orm_execute_state):
+    options = orm_execute_state.execution_options
+    if _current_stats.get() is None or options.get("stream_results") or options.get("yield_per"):
+        return None
+    result = orm_execute_state.invoke_statement()
+    if not getattr(result, "returns_rows", True):
+        return result
+    # the driver has buffered the rows already, so this only copies the list
+    frozen = result.freeze()
+    _add_rows(len(frozen.data))
+    return frozen()
+
+
+def _add_rows(count: int):
+    stats = _current_stats.get()
+    if stats is not None:
+        stats.rows += count
+
+
+def instrument_engine(engine):
+    """Add the statements run on `engine` during a request to its RequestStats."""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if _current_stats.get() is not None:
+            conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        stats = _current_stats.get()
+        if stats is None:
+            return
+        stats.sql_seconds += time.perf_counter() - conn.info["query_started"].pop()
+        stats.statements += 1
+        if cursor.description is None:
+            stats.rows += max(cursor.rowcount, 0)
+
+
+class MetricsMiddleware:
+    """Records latency and SQL work per route template."""
+
+    def __init__(self, app, registry: Optional[Metrics] = None):
+        self.app = app
+        self.metrics = metrics if registry is None else registry
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = _current_stats.set(stats)
+        status = 500
+        started = time.perf_counter()
+
+        async def record_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, record_status)
+        finally:
+            _current_stats.reset(token)
+            self.metrics.observe_request(
+                scope["method"], self._route(scope), status, time.perf_counter() - started, stats
+            )
+
+    def _route(self, scope) -> str:
+        route = scope.get("route")
+        if route is None:
+            # answered before routing (e.g. from the response cache), so match it here
+            for candidate in getattr(scope.get("app"), "routes", ()):
+                if candidate.matches(scope)[0] == Match.FULL:
+                    route = candidate
+                    break
+        # unmatched paths share one label to keep the series count bounded
+        return getattr(route, "path", "unmatched")
+
+
+metrics = Metrics()
@@ -0,0 +1,152 @@
+"""Schema migrations for existing databases.
+
+The number of applied migrations is kept in SQLite's PRAGMA user_version.
+Every migration is idempotent, so a database created from scratch by
+create_all() runs them as no-ops and is just stamped with the latest
+version, and an interrupted migration can simply be run again.
+
+    python -m app.migrations
+"""
+from sqlalchemy import inspect, insert, select, text
+from sqlalchemy.orm import Session
+
+from app import models
+from app.partitions import HOT_TABLE, archived_months, partition_table, writable
+from app.rollups import rebuild_rollups
+from app.utils import parse_mask_name
+
+
+def create_missing_tables(conn):
+    # rollups, ETL bookkeeping and data version tables; create_all() also
+    # adds the data version triggers (models.create_version_triggers)
+    models.Base.metadata.create_all(bind=conn)
+
+
+def backfill_rollups(conn):
+    db = Session(bind=conn)
+    # only columns that existed at this version; later migrations add more
+    if db.query(models.PurchaseDailyRollup.date).first() is None and db.query(models.PurchaseHistory.id).first() is not None:
+        rebuild_rollups(db)
+        db.flush()
+    db.close()
+
+
+def _column_names(conn, table: str) -> set:
+    return {column["name"] for column in inspect(conn).get_columns(table)}
+
+
+def add_product_columns(conn):
+    for table in ("masks", "purchase_histories"):
+        if "product_id" not in _column_names(conn, table):
+            conn.execute(text(f"ALTER TABLE {table} ADD COLUMN product_id INTEGER REFERENCES products (id)"))
+
+
+def _insert_products(conn, names: set):
+    products = models.Product.__table__
+    known = set(conn.execute(select(products.c.name)).scalars())
+    rows = [
+        dict(zip(("name", "brand", "color", "units_per_pack"), (name,) + parse_mask_name(name)))
+        for name in sorted(names - known)
+    ]
+    if rows:
+        conn.execute(insert(products), rows)
+
+
+def _backfill_history_products(conn, table: str):
+    names = set(conn.execute(text(f"SELECT DISTINCT mask_name FROM {table} WHERE product_id IS NULL")).scalars())
+    _insert_products(conn, names)
+    conn.execute(text(
+        f"UPDATE {table} SET product_id = "
+        f"(SELECT id FROM products WHERE products.name = {table}.mask_name) "
+        "WHERE product_id IS NULL"
+    ))
+
+
+def backfill_products(conn):
+    # a database created after drop_history_mask_names has no history names to copy
+    history_names = "mask_name" in _column_names(conn, "purchase_histories")
+    names = set(conn.execute(text("SELECT DISTINCT name FROM masks")).scalars())
+    if history_names:
+        names |= set(conn.execute(text("SELECT DISTINCT mask_name FROM purchase_histories")).scalars())
+    _insert_products(conn, names)
+    # products.name is unique, so each lookup is an index search
+    conn.execute(text(
+        "UPDATE masks SET product_id = (SELECT id FROM products WHERE products.name = masks.name) "
+        "WHERE product_id IS NULL"
+    ))
+    if history_names:
+        _backfill_history_products(conn, "purchase_histories")
+
+
+def autoincrement_history_ids(conn):
+    # archiving a month moves its rows out of purchase_histories; AUTOINCREMENT
+    # keeps their ids from being handed out again. SQLite cannot add it to an
+    # existing table, so the table is rebuilt.
+    table = models.PurchaseHistory.__table__
+    sql = conn.execute(text("SELECT sql FROM sqlite_master WHERE type = 'table' AND name = 'purchase_histories'")).scalar()
+    if "AUTOINCREMENT" in sql.upper():
+        return
+    for index in table.indexes:
+        conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+    conn.execute(text("ALTER TABLE purchase_histories RENAME TO purchase_histories_old"))
+    table.create(bind=conn)
+    columns = ", ".join(column.name for column in table.columns)
+    conn.execute(text(f"INSERT INTO purchase_histories ({columns}) SELECT {columns} FROM purchase_histories_old"))
+    conn.execute(text("DROP TABLE purchase_histories_old"))
+
+
+def drop_history_mask_names(conn):
+    # purchases name their mask through product_id; rows that have none get
+    # it from the copied name before that goes, in the archived months too
+    db = Session(bind=conn)
+    for table in [HOT_TABLE] + [partition_table(month) for month in archived_months(db)]:
+        if "mask_name" not in _column_names(conn, table.name):
+            continue
+        with writable(db, table):
+            _backfill_history_products(conn, table.name)
+            conn.execute(text(f"ALTER TABLE {table.name} DROP COLUMN mask_name"))
+    db.close()
+
+
+def create_indexes(conn):
+    # create_all() skips tables that already exist, so add their indexes here;
+    # an index on a column that a later migration adds waits for that migration
+    for table in models.Base.metadata.sorted_tables:
+        columns = _column_names(conn, table.name)
+        for index in table.indexes:
+            if all(column.name in columns for column in index.columns):
+                index.create(bind=conn, checkfirst=True)
+
+
+MIGRATIONS = [
+    create_missing_tables,
+    backfill_rollups,
+    create_indexes,
+    create_missing_tables,
+    add_product_columns,
+    backfill_products,
+    create_indexes,
+    create_missing_tables,
+    autoincrement_history_ids,
+    create_missing_tables,
+    create_missing_tables,
+    create_missing_tables,
+    drop_history_mask_names,
+]
+
+
+def current_version(conn) -> int:
+    return conn.execute(text("PRAGMA user_version")).scalar()
+
+
+def migrate(engine):
+    with engine.begin() as conn:
+        version = current_version(conn)
+        for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+            migration(conn)
+            conn.execute(text(f"PRAGMA user_version = {number}"))
+
+
+if __name__ == "__main__":
+    from app.database import engine
+    migrate(engine)
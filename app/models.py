@@ -1,5 +1,5 @@
 # app/models.py
-from sqlalchemy import Column, Integer, String, Float, ForeignKey, Time, DateTime
+from sqlalchemy import Column, Integer, String, Float, ForeignKey, Time, DateTime, Date, Boolean, Index, event, text
 from sqlalchemy.orm import declarative_base, relationship
 
 Base = declarative_base()
@@ -17,6 +17,10 @@ class Pharmacy(Base):
 
 class OpeningHour(Base):
     __tablename__ = 'opening_hours'
+    __table_args__ = (
+        Index('ix_opening_hours_day_open_close', 'day_of_week', 'open_time', 'close_time'),
+        Index('ix_opening_hours_pharmacy_id', 'pharmacy_id'),
+    )
 
     id = Column(Integer, primary_key=True)
     pharmacy_id = Column(Integer, ForeignKey('pharmacies.id'))
@@ -27,15 +31,34 @@ class OpeningHour(Base):
     pharmacy = relationship("Pharmacy", back_populates="opening_hours")
 
 
+# one row per distinct mask name, parsed into its parts
+class Product(Base):
+    __tablename__ = 'products'
+
+    id = Column(Integer, primary_key=True)
+    name = Column(String, unique=True, nullable=False)
+    brand = Column(String, nullable=False)
+    color = Column(String)
+    units_per_pack = Column(Integer)
+
+    masks = relationship("Mask", back_populates="product")
+
+
 class Mask(Base):
     __tablename__ = 'masks'
+    __table_args__ = (
+        Index('ix_masks_pharmacy_id_price', 'pharmacy_id', 'price'),
+        Index('ix_masks_product_id_price', 'product_id', 'price'),
+    )
 
     id = Column(Integer, primary_key=True)
     name = Column(String, nullable=False)
     price = Column(Float, nullable=False)
     pharmacy_id = Column(Integer, ForeignKey('pharmacies.id'))
+    product_id = Column(Integer, ForeignKey('products.id'))
 
     pharmacy = relationship("Pharmacy", back_populates="masks")
+    product = relationship("Product", back_populates="masks")
 
 class User(Base):
     __tablename__ = 'users'
@@ -49,13 +72,115 @@ class User(Base):
 
 class PurchaseHistory(Base):
     __tablename__ = 'purchase_histories'
+    __table_args__ = (
+        # covers the date-range SUM/COUNT without touching the table
+        Index('ix_purchase_histories_date_user_amount', 'transaction_date', 'user_id', 'transaction_amount'),
+        Index('ix_purchase_histories_user_id', 'user_id'),
+        # ids of rows archived to a month partition are never handed out again
+        {'sqlite_autoincrement': True},
+    )
 
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey('users.id'))
     pharmacy_id = Column(Integer, ForeignKey('pharmacies.id'))
-    mask_name = Column(String, nullable=False)
+    product_id = Column(Integer, ForeignKey('products.id'))
     transaction_amount = Column(Float, nullable=False)
     transaction_date = Column(DateTime, nullable=False)
 
     user = relationship("User", back_populates="purchase_histories")
     pharmacy = relationship("Pharmacy")
+    product = relationship("Product")
+
+
+class PurchaseDailyRollup(Base):
+    __tablename__ = 'purchase_daily_rollup'
+
+    date = Column(Date, primary_key=True)
+    transaction_count = Column(Integer, nullable=False, default=0)
+    transaction_amount = Column(Float, nullable=False, default=0.0)
+
+
+class UserDailySpend(Base):
+    __tablename__ = 'user_daily_spend'
+
+    date = Column(Date, primary_key=True)
+    user_id = Column(Integer, ForeignKey('users.id'), primary_key=True)
+    transaction_amount = Column(Float, nullable=False, default=0.0)
+
+
+# months of purchase_histories moved to their own read-only table (app/partitions.py)
+class HistoryPartition(Base):
+    __tablename__ = 'history_partitions'
+
+    month = Column(Date, primary_key=True)  # first day of the month
+    sealed_at = Column(DateTime, nullable=False)
+    compacted_at = Column(DateTime)
+
+
+# content hash of every source record loaded by the ETL, by natural key
+class EtlRecord(Base):
+    __tablename__ = 'etl_records'
+    __table_args__ = (
+        Index('ix_etl_records_kind_run_id', 'kind', 'run_id'),
+    )
+
+    kind = Column(String, primary_key=True)
+    key = Column(String, primary_key=True)
+    content_hash = Column(String, nullable=False)
+    row_id = Column(Integer)
+    run_id = Column(Integer, nullable=False)
+
+
+class EtlCheckpoint(Base):
+    __tablename__ = 'etl_checkpoints'
+
+    source = Column(String, primary_key=True)
+    run_id = Column(Integer, nullable=False)
+    position = Column(Integer, nullable=False, default=0)
+    completed = Column(Boolean, nullable=False, default=False)
+
+
+# purchase history ids a full load wrote without etl_records; the next
+# delta load keys them from the rows (app/etl_delta.py)
+class EtlDeferredPurchases(Base):
+    __tablename__ = 'etl_deferred_purchases'
+
+    first_id = Column(Integer, primary_key=True)
+    last_id = Column(Integer, nullable=False)
+    run_id = Column(Integer, nullable=False)
+
+
+# a counter per set of tables that an in-memory index is built from, bumped
+# by triggers on every write to them, whichever process makes it
+class DataVersion(Base):
+    __tablename__ = 'data_versions'
+
+    name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+
+
+# (version, table, what bumps it); purchases only touch cash balances and
+# histories, so they leave every version alone
+VERSIONED_WRITES = [
+    ("catalog", "pharmacies", ("INSERT", "DELETE", "UPDATE OF name")),
+    ("catalog", "masks", ("INSERT", "DELETE", "UPDATE OF name, price, pharmacy_id, product_id")),
+    ("catalog", "products", ("INSERT", "DELETE", "UPDATE")),
+    ("opening_hours", "pharmacies", ("INSERT", "DELETE", "UPDATE OF name")),
+    ("opening_hours", "opening_hours", ("INSERT", "DELETE", "UPDATE")),
+    # search only reads names
+    ("search", "pharmacies", ("INSERT", "DELETE", "UPDATE OF name")),
+    ("search", "masks", ("INSERT", "DELETE", "UPDATE OF name")),
+]
+
+
+@event.listens_for(Base.metadata, "after_create")
+def create_version_triggers(target, connection, **kw):
+    for name in sorted({name for name, _, _ in VERSIONED_WRITES}):
+        connection.execute(text("INSERT OR IGNORE INTO data_versions (name, version) VALUES (:name, 0)"), {"name": name})
+    for name, table, operations in VERSIONED_WRITES:
+        for operation in operations:
+            connection.execute(text(
+                f"CREATE TRIGGER IF NOT EXISTS {table}_{operation.split()[0].lower()}_bumps_{name} "
+                f"AFTER {operation} ON {table} "
+                f"BEGIN UPDATE data_versions SET version = version + 1 WHERE name = '{name}'; END"
+            ))
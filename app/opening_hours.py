@@ -0,0 +1,153 @@
+from bisect import bisect_right
+from datetime import datetime, time
+from typing import Dict, List, Optional, Tuple
+
+from sqlalchemy import select
+
+from app import models
+from app.cache import DerivedCache
+from app.utils import DAY_ORDER, expand_days
+
+MINUTES_PER_DAY = 24 * 60
+MINUTES_PER_WEEK = 7 * MINUTES_PER_DAY
+
+# slots accepted by one POST /pharmacies/open/batch
+MAX_BATCH_SLOTS = 100
+
+# (pharmacy_id, pharmacy_name, day_of_week, open_time, close_time)
+OpenEntry = Tuple[int, str, str, time, time]
+
+
+def minute_of_day(t: time) -> int:
+    return t.hour * 60 + t.minute
+
+
+def entry_key(entry: OpenEntry) -> Tuple[int, int, int, int]:
+    # entries are numbered in this order, which is also the order of every listing
+    pharmacy_id, _, day, open_time, close_time = entry
+    day_index = DAY_ORDER.index(day) if day in DAY_ORDER else len(DAY_ORDER)
+    return (
+        pharmacy_id,
+        day_index,
+        open_time.hour * 3600 + open_time.minute * 60 + open_time.second,
+        close_time.hour * 3600 + close_time.minute * 60 + close_time.second
+    )
+
+
+class OpeningHoursIndex:
+    """Weekly opening hours as sorted minute-of-week segments.
+
+    The week is cut at every minute where some pharmacy opens or closes, and
+    each segment keeps the entries open throughout it, so a lookup is one
+    bisect. Intervals with close_time < open_time run past midnight into the
+    next day (and from Sunday into Monday).
+
+    An index is never changed once built. opening_hours_indexes builds a new
+    one when the "opening_hours" data version moves, which triggers bump on
+    any write to opening hours or pharmacy names, from this process or
+    another.
+    """
+
+    def __init__(self, rows=()):
+        entries = sorted(
+            (
+                (pharmacy_id, name, day, open_time, close_time)
+                for pharmacy_id, name, day_of_week, open_time, close_time in rows
+                for day in expand_days(day_of_week)
+            ),
+            key=entry_key
+        )
+        by_day, intervals = {}, []
+        for entry_id, (_, _, day, open_time, close_time) in enumerate(entries):
+            by_day.setdefault(day, []).append(entry_id)
+            if day in DAY_ORDER:
+                intervals.extend(self._week_intervals(entry_id, day, open_time, close_time))
+
+        # segment boundaries: every opening minute and the minute after every closing
+        starts = {0}
+        for _, start, end in intervals:
+            starts.add(start)
+            if end + 1 < MINUTES_PER_WEEK:
+                starts.add(end + 1)
+        starts = sorted(starts)
+        segments = [[] for _ in starts]
+        for entry_id, start, end in intervals:
+            first = bisect_right(starts, start) - 1
+            last = bisect_right(starts, end) - 1
+            for segment in range(first, last + 1):
+                segments[segment].append(entry_id)
+
+        self._entries: List[OpenEntry] = entries
+        self._by_day: Dict[str, List[int]] = by_day
+        self._starts: List[int] = starts
+        self._segments: List[Tuple[int, ...]] = [tuple(sorted(set(s))) for s in segments]
+
+    queries = (
+        select(
+            models.Pharmacy.id,
+            models.Pharmacy.name,
+            models.OpeningHour.day_of_week,
+            models.OpeningHour.open_time,
+            models.OpeningHour.close_time
+        )
+        .join(models.OpeningHour)
+        .order_by(models.OpeningHour.id),
+    )
+
+    @classmethod
+    def build(cls, rows, previous=None) -> "OpeningHoursIndex":
+        return cls(rows[0])
+
+    def query(self, day: Optional[str] = None, at: Optional[time] = None) -> List[OpenEntry]:
+        """Entries open on `day` at `at`; either filter may be omitted."""
+        return [self._entries[entry_id] for entry_id in self._entry_ids(day, at)]
+
+    def query_page(
+        self, day: Optional[str], at: Optional[time], after: Optional[tuple], limit: int
+    ) -> List[OpenEntry]:
+        """The first `limit` entries of query(day, at) whose entry_key is greater than `after`."""
+        entry_ids = self._entry_ids(day, at)
+        start = 0
+        if after is not None:
+            start = bisect_right(entry_ids, tuple(after), key=lambda entry_id: entry_key(self._entries[entry_id]))
+        return [self._entries[entry_id] for entry_id in entry_ids[start:start + limit]]
+
+    def open_at_page(self, moment: datetime, after: Optional[tuple], limit: int) -> List[OpenEntry]:
+        return self.query_page(DAY_ORDER[moment.weekday()], moment.time(), after, limit)
+
+    def _entry_ids(self, day: Optional[str], at: Optional[time]):
+        # ascending entry ids, so ascending entry_key
+        if day is None and at is None:
+            return range(len(self._entries))
+        if at is None:
+            return self._by_day.get(day, [])
+        if day is None:
+            return sorted({
+                entry_id
+                for d in DAY_ORDER
+                for entry_id in self._open_at(d, at)
+            })
+        return self._open_at(day, at)
+
+    def _open_at(self, day: str, at: time) -> Tuple[int, ...]:
+        if day not in DAY_ORDER:
+            return ()
+        minute = DAY_ORDER.index(day) * MINUTES_PER_DAY + minute_of_day(at)
+        return self._segments[bisect_right(self._starts, minute) - 1]
+
+    @staticmethod
+    def _week_intervals(entry_id: int, day: str, open_time: time, close_time: time):
+        # inclusive [start, end] in minutes of the week, matching open_time <= t <= close_time
+        start = DAY_ORDER.index(day) * MINUTES_PER_DAY + minute_of_day(open_time)
+        end = start - minute_of_day(open_time) + minute_of_day(close_time)
+        if close_time < open_time:
+            end += MINUTES_PER_DAY
+        if end < MINUTES_PER_WEEK:
+            return [(entry_id, start, end)]
+        return [
+            (entry_id, start, MINUTES_PER_WEEK - 1),
+            (entry_id, 0, end - MINUTES_PER_WEEK)
+        ]
+
+
+opening_hours_indexes = DerivedCache(OpeningHoursIndex, version="opening_hours")
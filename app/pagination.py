@@ -0,0 +1,45 @@
+"""Keyset pagination helpers.
+
+A cursor is the sort key of the last item on the previous page, so the next
+page starts with a range condition instead of an OFFSET and costs the same
+however deep it is. Cursors are opaque to clients and carry the listing and
+sort order they were issued for.
+"""
+import base64
+import json
+from typing import Callable, List, Optional, Sequence, Tuple
+
+from fastapi import HTTPException, Query
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+
+def limit_param():
+    return Query(DEFAULT_PAGE_SIZE, ge=1, le=MAX_PAGE_SIZE)
+
+
+def encode_cursor(listing: str, key: Sequence) -> str:
+    raw = json.dumps([listing, list(key)], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).rstrip(b"=").decode()
+
+
+def decode_cursor(cursor: Optional[str], listing: str) -> Optional[list]:
+    if cursor is None:
+        return None
+    try:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        issued_for, key = json.loads(raw)
+    except (ValueError, TypeError):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    if issued_for != listing or not isinstance(key, list):
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+    return key
+
+
+def paginate(rows: List, limit: int, listing: str, key: Callable) -> Tuple[List, Optional[str]]:
+    """Split `limit + 1` fetched rows into the page and the cursor of the next one."""
+    if len(rows) <= limit:
+        return rows, None
+    rows = rows[:limit]
+    return rows, encode_cursor(listing, key(rows[-1]))
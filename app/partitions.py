@@ -0,0 +1,216 @@
+"""Month partitions of purchase histories.
+
+purchase_histories holds the recent months, where purchases and the ETL
+write. archive_months() moves every closed month before a cutoff into a
+table of its own, purchase_histories_YYYYMM, with the same columns and
+indexes, and records it in history_partitions. Triggers make an archived
+month read-only; maintenance that must change one (the delta ETL removing
+purchases) goes through writable(). compact() then VACUUMs the file, so
+the pages the archived rows left behind in purchase_histories are freed.
+
+Reads of a date range go through history_tables(), which returns
+purchase_histories plus only the archived months that overlap the range.
+A purchase dated in an archived month (a late delta ETL row) lands in
+purchase_histories, which is why that table is always read.
+
+    python -m app.partitions --keep-months 2 --compact
+"""
+import argparse
+from contextlib import contextmanager
+from datetime import date, datetime, time, timedelta
+from threading import Lock
+from typing import List, Optional
+
+from sqlalchemy import Column, Index, MetaData, Table, func, insert, select, text, union_all
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from app.models import HistoryPartition, PurchaseHistory
+
+HOT_TABLE = PurchaseHistory.__table__
+COLUMNS = [column.name for column in HOT_TABLE.columns]
+OPERATIONS = ("INSERT", "UPDATE", "DELETE")
+
+# archived months are defined here, not on models.Base, so create_all() leaves them alone
+partition_metadata = MetaData()
+_tables_lock = Lock()
+
+
+def month_start(day: date) -> date:
+    return date(day.year, day.month, 1)
+
+
+def next_month(month: date) -> date:
+    return date(month.year + month.month // 12, month.month % 12 + 1, 1)
+
+
+def _midnight(day: date) -> datetime:
+    return datetime.combine(day, time.min)
+
+
+def partition_table(month: date) -> Table:
+    name = f"purchase_histories_{month:%Y%m}"
+    with _tables_lock:
+        if name not in partition_metadata.tables:
+            Table(
+                name, partition_metadata,
+                *(
+                    Column(column.name, column.type, primary_key=column.primary_key, nullable=column.nullable)
+                    for column in HOT_TABLE.columns
+                ),
+                Index(f"ix_{name}_date_user_amount", "transaction_date", "user_id", "transaction_amount"),
+                Index(f"ix_{name}_user_id", "user_id"),
+            )
+        return partition_metadata.tables[name]
+
+
+def archived_months(db: Session) -> List[date]:
+    return list(db.scalars(select(HistoryPartition.month).order_by(HistoryPartition.month)))
+
+
+def history_tables(db: Session, start: Optional[datetime] = None, end: Optional[datetime] = None) -> List[Table]:
+    """purchase_histories and the archived months overlapping [start, end)."""
+    tables = [HOT_TABLE]
+    for month in archived_months(db):
+        first, last = _midnight(month), _midnight(next_month(month))
+        if (start is None or last > start) and (end is None or first < end):
+            tables.append(partition_table(month))
+    return tables
+
+
+def in_range(query, table: Table, start: Optional[datetime], end: Optional[datetime]):
+    if start is not None:
+        query = query.where(table.c.transaction_date >= start)
+    if end is not None:
+        query = query.where(table.c.transaction_date < end)
+    return query
+
+
+def history_union(db: Session, columns, start: Optional[datetime] = None, end: Optional[datetime] = None):
+    """`columns` of the histories in [start, end), across partitions, as one selectable."""
+    selects = [
+        in_range(select(*(table.c[column] for column in columns)), table, start, end)
+        for table in history_tables(db, start, end)
+    ]
+    return selects[0] if len(selects) == 1 else union_all(*selects)
+
+
+def next_history_id(db: Session) -> int:
+    # sqlite_sequence remembers the largest id ever used, archived rows included
+    used = db.execute(text("SELECT seq FROM sqlite_sequence WHERE name = 'purchase_histories'")).scalar()
+    hot = db.execute(select(func.max(HOT_TABLE.c.id))).scalar()
+    return max(used or 0, hot or 0) + 1
+
+
+def _begin(db: Session):
+    # pysqlite opens a transaction only before DML; open it now, so that the
+    # triggers and tables created below commit or roll back with the rows
+    dbapi_connection = db.connection().connection.dbapi_connection
+    if not dbapi_connection.in_transaction:
+        dbapi_connection.execute("BEGIN")
+
+
+def _seal(db: Session, table: Table):
+    for operation in OPERATIONS:
+        db.execute(text(
+            f"CREATE TRIGGER IF NOT EXISTS {table.name}_read_only_{operation.lower()} "
+            f"BEFORE {operation} ON {table.name} "
+            f"BEGIN SELECT RAISE(ABORT, '{table.name} is read-only'); END"
+        ))
+
+
+def _unseal(db: Session, table: Table):
+    for operation in OPERATIONS:
+        db.execute(text(f"DROP TRIGGER IF EXISTS {table.name}_read_only_{operation.lower()}"))
+
+
+@contextmanager
+def writable(db: Session, table: Table):
+    """Lift the read-only triggers of an archived month inside the caller's transaction."""
+    if table is HOT_TABLE:
+        yield table
+        return
+    _begin(db)
+    _unseal(db, table)
+    yield table
+    _seal(db, table)
+
+
+def archive_month(db: Session, month: date) -> int:
+    """Move the rows of `month` from purchase_histories to its partition
+    inside the caller's transaction; returns how many were moved."""
+    if month >= month_start(date.today()):
+        raise ValueError(f"{month:%Y-%m} is not closed yet")
+    start, end = _midnight(month), _midnight(next_month(month))
+    table = partition_table(month)
+    _begin(db)
+    table.create(bind=db.connection(), checkfirst=True)
+
+    with writable(db, table):
+        # in date order, so a range scan of the partition reads neighbouring pages
+        rows = in_range(select(*HOT_TABLE.c), HOT_TABLE, start, end)
+        moved = db.execute(insert(table).from_select(
+            COLUMNS, rows.order_by(HOT_TABLE.c.transaction_date, HOT_TABLE.c.id)
+        )).rowcount
+        db.execute(in_range(HOT_TABLE.delete(), HOT_TABLE, start, end))
+
+    db.execute(sqlite_insert(HistoryPartition).values(month=month, sealed_at=datetime.now()).on_conflict_do_nothing())
+    return moved
+
+
+def archive_months(db: Session, before: date) -> List[date]:
+    """Archive every month before `before` that still has rows in purchase_histories."""
+    cutoff = _midnight(month_start(before))
+    months = sorted(
+        date.fromisoformat(f"{month}-01") for month in db.scalars(
+            select(func.strftime("%Y-%m", HOT_TABLE.c.transaction_date).distinct())
+            .where(HOT_TABLE.c.transaction_date < cutoff)
+        )
+    )
+    for month in months:
+        archive_month(db, month)
+    return months
+
+
+def compact(engine):
+    """VACUUM the database and refresh the planner statistics."""
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+        conn.execute(text("VACUUM"))
+        conn.execute(text("ANALYZE"))
+        conn.execute(
+            HistoryPartition.__table__.update()
+            .where(HistoryPartition.compacted_at.is_(None))
+            .values(compacted_at=datetime.now())
+        )
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="python -m app.partitions", description="Archive closed months of purchase histories"
+    )
+    parser.add_argument("--keep-months", type=int, default=2, help="recent months left in purchase_histories")
+    parser.add_argument("--compact", action="store_true", help="VACUUM afterwards to reclaim the freed space")
+    args = parser.parse_args(argv)
+
+    from app.cache import data_revision
+    from app.database import SessionLocal, engine
+
+    # the current month counts as the first kept month
+    before = month_start(date.today())
+    for _ in range(args.keep_months - 1):
+        before = month_start(before - timedelta(days=1))
+
+    db = SessionLocal()
+    try:
+        for month in archive_months(db, before):
+            print(f"archived {month:%Y-%m}")
+        db.commit()
+    finally:
+        db.close()
+    data_revision.bump()
+    if args.compact:
+        compact(engine)
+
+
+if __name__ == "__main__":
+    main()
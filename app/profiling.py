@@ -0,0 +1,238 @@
+"""Opt-in profiling of single requests.
+
+With PROFILING=header a request that sends `X-Profile: <PROFILE_TOKEN>`
+is profiled; without a PROFILE_TOKEN, only a request from a loopback
+address that sends `X-Profile: 1` is. With PROFILING=all every request is.
+With the default, PROFILING=off, nothing here is installed at all.
+
+A profiled request runs under a sampling profiler that records the Python
+stack of every busy thread each PROFILE_INTERVAL seconds. Sampling, rather
+than cProfile, is needed because sync routes run in threadpool workers.
+Every SQL statement the request issues is recorded with its time and its
+EXPLAIN QUERY PLAN. The report is written as JSON to PROFILE_DIR, and its
+id is returned in the X-Profile-Id response header. Only the newest
+PROFILE_KEEP reports are kept. Profiled requests are
+run one at a time and skip the response cache, so the samples belong to
+that request alone, apart from any other traffic the server has.
+"""
+import asyncio
+import hmac
+import ipaddress
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from collections import Counter
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Optional
+
+from sqlalchemy import event
+
+PROFILING = os.getenv("PROFILING", "off")  # off | header | all
+PROFILE_DIR = os.getenv("PROFILE_DIR", "profiles")
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.001"))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN", "")
+PROFILE_KEEP = int(os.getenv("PROFILE_KEEP", "100"))
+PROFILE_HEADER = b"x-profile"
+TOP_FUNCTIONS = 40
+
+# innermost frames of threads that are waiting rather than working
+IDLE_FRAMES = {("selectors.py", "select"), ("threading.py", "wait"), ("queue.py", "get")}
+
+
+class Profile:
+    def __init__(self):
+        self.statements = []
+
+
+_current_profile: ContextVar[Optional[Profile]] = ContextVar("profile", default=None)
+
+
+class Sampler(threading.Thread):
+    """Counts the stacks of the other threads until stop() is called."""
+
+    def __init__(self, interval: float = PROFILE_INTERVAL):
+        super().__init__(name="profile-sampler", daemon=True)
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopped = threading.Event()
+
+    def run(self):
+        me = threading.get_ident()
+        while not self._stopped.wait(self.interval):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == me:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                if stack and (os.path.basename(stack[0][0]), stack[0][2]) not in IDLE_FRAMES:
+                    self.stacks[tuple(reversed(stack))] += 1
+
+    def stop(self):
+        self._stopped.set()
+        self.join()
+
+    def report(self) -> dict:
+        own, total, packages = Counter(), Counter(), Counter()
+        for stack, count in self.stacks.items():
+            own[stack[-1]] += count
+            packages[_package(stack[-1][0])] += count
+            for function in set(stack):
+                total[function] += count
+        samples = sum(self.stacks.values())
+        return {
+            "interval_seconds": self.interval,
+            "samples": samples,
+            # where the innermost Python frame was: app, sqlalchemy, pydantic, ...
+            "packages": dict(packages.most_common()),
+            "functions": [
+                {"function": _describe(function), "self": own[function], "total": count}
+                for function, count in total.most_common(TOP_FUNCTIONS)
+            ],
+        }
+
+
+def _describe(function) -> str:
+    filename, line, name = function
+    if filename.startswith(os.getcwd() + os.sep):
+        filename = os.path.relpath(filename)
+    return f"{filename}:{line}({name})"
+
+
+def _package(filename: str) -> str:
+    parts = filename.split(os.sep)
+    if "site-packages" in parts:
+        return parts[parts.index("site-packages") + 1]
+    if filename.startswith(os.path.join(os.getcwd(), "app") + os.sep):
+        return "app"
+    return "other"
+
+
+def format_plan(rows) -> list:
+    """EXPLAIN QUERY PLAN rows (id, parent, notused, detail) as indented lines."""
+    depth = {0: -1}
+    lines = []
+    for node, parent, _, detail in rows:
+        depth[node] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node] + detail)
+    return lines
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current_profile.get() is not None:
+        conn.info.setdefault("profile_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    profile = _current_profile.get()
+    if profile is None:
+        return
+    entry = {"sql": statement, "seconds": time.perf_counter() - conn.info["profile_started"].pop()}
+    if executemany:
+        entry["executemany"] = len(parameters)
+    else:
+        entry["parameters"] = list(parameters)
+        # a plain DBAPI cursor, so the plan lookup fires no events of its own
+        plan_cursor = conn.connection.dbapi_connection.cursor()
+        try:
+            plan_cursor.execute("EXPLAIN QUERY PLAN " + statement, parameters)
+            entry["plan"] = format_plan(plan_cursor.fetchall())
+        except Exception as e:  # PRAGMAs and the like have no plan
+            entry["plan_error"] = str(e)
+        finally:
+            plan_cursor.close()
+    profile.statements.append(entry)
+
+
+def record_query_plans(engine):
+    """Record the statements, and their plans, that profiled requests run on `engine`."""
+    if engine.dialect.name != "sqlite" or event.contains(engine, "after_cursor_execute", _after_cursor_execute):
+        return
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+
+
+def is_loopback(client) -> bool:
+    try:
+        return client is not None and ipaddress.ip_address(client[0]).is_loopback
+    except ValueError:  # not an IP address, e.g. a unix socket peer
+        return False
+
+
+class ProfilingMiddleware:
+    def __init__(
+        self, app, mode: str = PROFILING, directory: str = PROFILE_DIR, token: str = PROFILE_TOKEN,
+        keep: int = PROFILE_KEEP
+    ):
+        self.app = app
+        self.mode = mode
+        self.directory = directory
+        self.token = token.encode()
+        self.keep = keep
+        self._lock = asyncio.Lock()
+
+    def _wanted(self, scope) -> bool:
+        if self.mode == "all":
+            return True
+        value = next((value for name, value in scope["headers"] if name == PROFILE_HEADER), b"")
+        if value in (b"", b"0"):
+            return False
+        # a profiled request runs alone and writes a file, so not anyone may ask for one
+        if self.token:
+            return hmac.compare_digest(value, self.token)
+        return is_loopback(scope.get("client"))
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._wanted(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = f"{datetime.now():%Y%m%dT%H%M%S%f}-{uuid.uuid4().hex[:8]}"
+        scope = dict(scope, headers=scope["headers"] + [(b"cache-control", b"no-cache")])
+        status = None
+
+        async def add_header(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message = dict(message, headers=list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())])
+            await send(message)
+
+        async with self._lock:
+            profile = Profile()
+            token = _current_profile.set(profile)
+            sampler = Sampler()
+            started = time.perf_counter()
+            sampler.start()
+            try:
+                await self.app(scope, receive, add_header)
+            finally:
+                sampler.stop()
+                elapsed = time.perf_counter() - started
+                _current_profile.reset(token)
+                self._write(profile_id, {
+                    "id": profile_id,
+                    "method": scope["method"],
+                    "path": scope["path"],
+                    "query": scope["query_string"].decode("latin-1"),
+                    "status": status,
+                    "elapsed_seconds": elapsed,
+                    "sql_seconds": sum(statement["seconds"] for statement in profile.statements),
+                    "profile": sampler.report(),
+                    "statements": profile.statements,
+                })
+
+    def _write(self, profile_id: str, report: dict):
+        os.makedirs(self.directory, exist_ok=True)
+        with open(os.path.join(self.directory, f"{profile_id}.json"), "w") as f:
+            json.dump(report, f, indent=2, default=str)
+        # ids start with the time, so the oldest reports sort first
+        reports = sorted(name for name in os.listdir(self.directory) if name.endswith(".json"))
+        for name in reports[:max(len(reports) - self.keep, 0)]:
+            os.remove(os.path.join(self.directory, name))
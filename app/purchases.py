@@ -0,0 +1,305 @@
+import os
+import queue
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Union
+
+from fastapi import HTTPException
+from sqlalchemy import bindparam, insert, select, update
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import Session
+
+from app import models, schemas
+from app.cache import data_revision
+from app.rollups import record_purchase
+
+# Retries when SQLite reports the database as busy/locked
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 0.02  # seconds, doubled after every attempt
+RETRY_MAX_DELAY = 0.5
+
+# orders accepted by one POST /purchase/batch
+MAX_BATCH_ORDERS = 500
+
+# coalesce concurrent POST /purchase requests into one commit (off by default)
+GROUP_COMMIT = os.environ.get("PURCHASE_GROUP_COMMIT", "0") == "1"
+GROUP_COMMIT_WINDOW = float(os.environ.get("PURCHASE_GROUP_COMMIT_WINDOW", "0.002"))  # seconds
+GROUP_COMMIT_MAX_ORDERS = int(os.environ.get("PURCHASE_GROUP_COMMIT_MAX_ORDERS", "256"))
+
+
+def is_busy_error(error: OperationalError) -> bool:
+    message = str(error.orig).lower()
+    return "locked" in message or "busy" in message
+
+
+def execute_purchase(db: Session, purchase: schemas.PurchaseRequest) -> schemas.PurchaseResponse:
+    """Run a purchase in its own transaction, retrying while the database is busy."""
+    return _run_transaction(db, lambda: apply_purchase(db, purchase))
+
+
+def execute_purchase_batch(
+    db: Session, purchases: List[schemas.PurchaseRequest]
+) -> List[Union[schemas.PurchaseResponse, HTTPException]]:
+    """Run many purchases in one transaction, retrying while the database is busy.
+
+    The result of each order is its response, or the HTTPException it failed
+    with; a failed order changes nothing and does not stop the others.
+    """
+    return _run_transaction(db, lambda: apply_purchase_batch(db, purchases))
+
+
+def _run_transaction(db: Session, apply):
+    for attempt in range(MAX_ATTEMPTS):
+        try:
+            result = apply()
+            db.commit()
+            data_revision.bump()
+            return result
+        except OperationalError as e:
+            db.rollback()
+            if not is_busy_error(e):
+                raise
+        except Exception:
+            db.rollback()
+            raise
+
+        delay = min(RETRY_BASE_DELAY * 2 ** attempt, RETRY_MAX_DELAY)
+        time.sleep(delay * random.uniform(0.5, 1.0))
+
+    raise HTTPException(status_code=503, detail="Database is busy, please retry")
+
+
+def apply_purchase_batch(
+    db: Session, purchases: List[schemas.PurchaseRequest]
+) -> List[Union[schemas.PurchaseResponse, HTTPException]]:
+    """Apply many purchases inside the caller's transaction without committing.
+
+    Users, masks and pharmacies are fetched once for the whole batch, and the
+    pharmacy credits, histories and rollups of all orders are written together.
+    """
+    user_ids = set(db.scalars(
+        select(models.User.id).where(models.User.id.in_({purchase.user_id for purchase in purchases}))
+    ))
+    masks = fetch_masks(db, {item.mask_id for purchase in purchases for item in purchase.purchases})
+    writes = PurchaseWrites()
+
+    results = []
+    for purchase in purchases:
+        try:
+            results.append(apply_purchase(db, purchase, user_ids, masks, writes))
+        except HTTPException as e:
+            # raised before the order wrote anything
+            results.append(e)
+    writes.flush(db)
+    return results
+
+
+def fetch_masks(db: Session, mask_ids: Set[int]) -> Dict[int, tuple]:
+    """(mask, pharmacy) by mask id, in one query."""
+    return {
+        mask.id: (mask, pharmacy)
+        for mask, pharmacy in db.query(models.Mask, models.Pharmacy)
+        .outerjoin(models.Pharmacy, models.Mask.pharmacy_id == models.Pharmacy.id)
+        .filter(models.Mask.id.in_(mask_ids))
+    }
+
+
+class PurchaseWrites:
+    """Pharmacy credits, history rows and rollup amounts of one or more
+    purchases, written with one statement per kind by flush()."""
+
+    def __init__(self):
+        self.pharmacy_income = defaultdict(float)
+        self.histories = []
+        # (user_id, day) -> [when, count, amount]
+        self.rollups = {}
+
+    def add(self, user_id: int, when: datetime, histories: List[dict], amount: float):
+        for history in histories:
+            self.pharmacy_income[history["pharmacy_id"]] += history["transaction_amount"]
+        self.histories.extend(histories)
+        rollup = self.rollups.setdefault((user_id, when.date()), [when, 0, 0.0])
+        rollup[1] += len(histories)
+        rollup[2] += amount
+
+    def flush(self, db: Session):
+        if self.histories:
+            pharmacies = models.Pharmacy.__table__
+            db.execute(
+                update(pharmacies)
+                .where(pharmacies.c.id == bindparam("pharmacy_id"))
+                .values(cash_balance=pharmacies.c.cash_balance + bindparam("income")),
+                [{"pharmacy_id": pharmacy_id, "income": income} for pharmacy_id, income in self.pharmacy_income.items()]
+            )
+            db.execute(insert(models.PurchaseHistory.__table__), self.histories)
+        for (user_id, _), (when, count, amount) in self.rollups.items():
+            record_purchase(db, user_id, when, count, amount)
+
+
+def apply_purchase(
+    db: Session,
+    purchase: schemas.PurchaseRequest,
+    user_ids: Optional[Set[int]] = None,
+    masks: Optional[Dict[int, tuple]] = None,
+    writes: Optional[PurchaseWrites] = None
+) -> schemas.PurchaseResponse:
+    """Apply a purchase inside the caller's transaction without committing.
+
+    Balances are changed with relative UPDATEs, and the user's debit only
+    succeeds while the balance still covers the cost, so concurrent
+    purchases can neither lose an update nor overdraw a wallet. Nothing is
+    written before the debit, so a purchase that raises leaves no trace.
+
+    A batch passes the users and masks it prefetched, and its own writes to
+    be flushed once all orders are applied.
+    """
+    # check if user exists
+    if user_ids is None:
+        user_ids = set(db.scalars(select(models.User.id).where(models.User.id == purchase.user_id)))
+
+    if purchase.user_id not in user_ids:
+        raise HTTPException(status_code=404, detail="User not found")
+
+    # fetch every referenced mask together with its pharmacy in one query
+    if masks is None:
+        masks = fetch_masks(db, {item.mask_id for item in purchase.purchases})
+
+    total_cost = 0
+    lines = []
+
+    # check if all masks exist and calculate total cost
+    for item in purchase.purchases:
+        mask, pharmacy = masks.get(item.mask_id, (None, None))
+
+        if not mask or mask.pharmacy_id != item.pharmacy_id:
+            raise HTTPException(status_code=404, detail=f"Mask {item.mask_id} not found in pharmacy {item.pharmacy_id}")
+        if not pharmacy:
+            raise HTTPException(status_code=404, detail=f"Pharmacy {item.pharmacy_id} not found")
+
+        item_total = round(mask.price * item.quantity, 2)
+        total_cost += item_total
+        lines.append((item, mask, pharmacy, item_total))
+
+    # debit the user only if the balance still covers the cost
+    users = models.User.__table__
+    remaining_balance = db.execute(
+        update(users)
+        .where(users.c.id == purchase.user_id, users.c.cash_balance >= total_cost)
+        .values(cash_balance=users.c.cash_balance - total_cost)
+        .returning(users.c.cash_balance)
+    ).scalar()
+
+    if remaining_balance is None:
+        raise HTTPException(status_code=400, detail="Insufficient balance")
+
+    details = []
+    histories = []
+    now = datetime.now()
+
+    for item, mask, pharmacy, item_total in lines:
+        histories.append({
+            "user_id": purchase.user_id,
+            "pharmacy_id": pharmacy.id,
+            "product_id": mask.product_id,
+            "transaction_amount": item_total,
+            "transaction_date": now
+        })
+
+        # return purchase details
+        details.append(schemas.PurchaseItemDetail(
+            pharmacy_id=pharmacy.id,
+            pharmacy_name=pharmacy.name,
+            mask_id=mask.id,
+            mask_name=mask.name,
+            quantity=item.quantity,
+            unit_price=mask.price,
+            total_price=item_total
+        ))
+
+    if writes is None:
+        single = PurchaseWrites()
+        single.add(purchase.user_id, now, histories, total_cost)
+        single.flush(db)
+    else:
+        writes.add(purchase.user_id, now, histories, total_cost)
+
+    return schemas.PurchaseResponse(
+        message="Purchase successful",
+        total_cost=round(total_cost, 2),
+        remaining_balance=round(remaining_balance, 2),
+        details=details
+    )
+
+
+class GroupCommitQueue:
+    """Coalesces the single purchases of concurrent requests into one commit.
+
+    A request thread queues its purchase and waits. One writer thread takes
+    whatever arrives within `window` seconds of the first order, up to
+    `max_orders`, and applies it with execute_purchase_batch, so the orders
+    share one transaction and one fsync. Each caller still gets its own
+    response or error, and only once its order is committed.
+    """
+
+    def __init__(self, session_factory, window: float = GROUP_COMMIT_WINDOW, max_orders: int = GROUP_COMMIT_MAX_ORDERS):
+        self.session_factory = session_factory
+        self.window = window
+        self.max_orders = max_orders
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def submit(self, purchase: schemas.PurchaseRequest) -> schemas.PurchaseResponse:
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="purchase-group-commit", daemon=True)
+                self._thread.start()
+        future = Future()
+        self._queue.put((purchase, future))
+        return future.result()
+
+    def close(self):
+        with self._lock:
+            thread, self._thread = self._thread, None
+        if thread is not None:
+            self._queue.put(None)
+            thread.join()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            order = self._queue.get()
+            if order is None:
+                return
+            orders = [order]
+            deadline = time.monotonic() + self.window
+            while len(orders) < self.max_orders:
+                try:
+                    order = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if order is None:
+                    stopping = True
+                    break
+                orders.append(order)
+            self._commit(orders)
+
+    def _commit(self, orders):
+        db = self.session_factory()
+        try:
+            results = execute_purchase_batch(db, [purchase for purchase, _ in orders])
+        except Exception as e:
+            for _, future in orders:
+                future.set_exception(e)
+            return
+        finally:
+            db.close()
+        for (_, future), result in zip(orders, results):
+            if isinstance(result, HTTPException):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
@@ -0,0 +1,149 @@
+from datetime import date, datetime, time, timedelta
+from typing import List, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session
+
+from app.models import PurchaseDailyRollup, UserDailySpend
+from app.partitions import history_tables, history_union, in_range
+
+
+def record_purchase(db: Session, user_id: int, when: datetime, count: int, amount: float):
+    """Add a purchase to the rollups inside the caller's transaction."""
+    daily = sqlite_insert(PurchaseDailyRollup).values(
+        date=when.date(),
+        transaction_count=count,
+        transaction_amount=amount
+    )
+    db.execute(daily.on_conflict_do_update(
+        index_elements=[PurchaseDailyRollup.date],
+        set_={
+            "transaction_count": PurchaseDailyRollup.transaction_count + daily.excluded.transaction_count,
+            "transaction_amount": PurchaseDailyRollup.transaction_amount + daily.excluded.transaction_amount
+        }
+    ))
+
+    spend = sqlite_insert(UserDailySpend).values(
+        date=when.date(),
+        user_id=user_id,
+        transaction_amount=amount
+    )
+    db.execute(spend.on_conflict_do_update(
+        index_elements=[UserDailySpend.date, UserDailySpend.user_id],
+        set_={"transaction_amount": UserDailySpend.transaction_amount + spend.excluded.transaction_amount}
+    ))
+
+
+def rebuild_rollups(db: Session):
+    """Recompute all rollups from the purchase histories of every partition."""
+    histories = history_union(db, ("id", "user_id", "transaction_amount", "transaction_date")).subquery()
+    day = func.date(histories.c.transaction_date)
+    db.execute(delete(PurchaseDailyRollup))
+    db.execute(insert(PurchaseDailyRollup).from_select(
+        ["date", "transaction_count", "transaction_amount"],
+        select(
+            day,
+            func.count(histories.c.id),
+            func.sum(histories.c.transaction_amount)
+        ).group_by(day)
+    ))
+    db.execute(delete(UserDailySpend))
+    db.execute(insert(UserDailySpend).from_select(
+        ["date", "user_id", "transaction_amount"],
+        select(
+            day,
+            histories.c.user_id,
+            func.sum(histories.c.transaction_amount)
+        ).group_by(day, histories.c.user_id)
+    ))
+
+
+def top_spenders(
+    top: int,
+    first_day: Optional[date] = None,
+    last_day: Optional[date] = None
+):
+    """Subquery of the `top` (user_id, total_amount) pairs over [first_day, last_day]."""
+    total_amount = func.sum(UserDailySpend.transaction_amount)
+    query = select(
+        UserDailySpend.user_id,
+        total_amount.label("total_amount")
+    ).group_by(UserDailySpend.user_id)
+    if first_day is not None:
+        query = query.where(UserDailySpend.date >= first_day)
+    if last_day is not None:
+        query = query.where(UserDailySpend.date <= last_day)
+    return query.order_by(total_amount.desc()).limit(top).subquery()
+
+
+def summarize_transactions(
+    db: Session,
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None
+) -> Tuple[int, float]:
+    """Count and total amount of purchases in [start, end).
+
+    Whole days are read from the daily rollup; only a partial first or last
+    day is aggregated from the purchase histories.
+    """
+    whole_days, edges = split_days(start, end)
+    total_count, total_amount = (0, 0.0) if whole_days is None else _rollup_totals(db, *whole_days)
+    for edge_start, edge_end in edges:
+        count, amount = _history_totals(db, edge_start, edge_end)
+        total_count += count
+        total_amount += amount
+
+    return total_count, total_amount
+
+
+def split_days(
+    start: Optional[datetime], end: Optional[datetime]
+) -> Tuple[Optional[Tuple[Optional[date], Optional[date]]], List[Tuple[datetime, datetime]]]:
+    """[start, end) as the whole days [first_day, last_day), or None when no
+    day fits, and the partial days before and after them."""
+    first_day = None
+    if start is not None:
+        first_day = start.date()
+        if start.time() != time.min:
+            first_day += timedelta(days=1)
+    last_day = end.date() if end is not None else None
+
+    if first_day is not None and last_day is not None and first_day > last_day:
+        return None, [(start, end)]
+
+    edges = []
+    if start is not None and start.date() != first_day:
+        edges.append((start, datetime.combine(first_day, time.min)))
+    if end is not None and end.time() != time.min:
+        edges.append((datetime.combine(last_day, time.min), end))
+    return (first_day, last_day), edges
+
+
+def _rollup_totals(db: Session, first_day: Optional[date], last_day: Optional[date]) -> Tuple[int, float]:
+    if first_day is not None and first_day == last_day:
+        return 0, 0.0
+    query = db.query(
+        func.coalesce(func.sum(PurchaseDailyRollup.transaction_count), 0),
+        func.coalesce(func.sum(PurchaseDailyRollup.transaction_amount), 0.0)
+    )
+    if first_day is not None:
+        query = query.filter(PurchaseDailyRollup.date >= first_day)
+    if last_day is not None:
+        query = query.filter(PurchaseDailyRollup.date < last_day)
+    return query.one()
+
+
+def _history_totals(db: Session, start: datetime, end: datetime) -> Tuple[int, float]:
+    if start >= end:
+        return 0, 0.0
+    # only the partitions holding the range are read
+    total_count, total_amount = 0, 0.0
+    for table in history_tables(db, start, end):
+        count, amount = db.execute(in_range(
+            select(func.count(table.c.id), func.coalesce(func.sum(table.c.transaction_amount), 0.0)),
+            table, start, end
+        )).one()
+        total_count += count
+        total_amount += amount
+    return total_count, total_amount
@@ -1,7 +1,15 @@
-from typing import List
+from typing import Generic, List, Optional, TypeVar
 from pydantic import BaseModel
 from datetime import time
 
+T = TypeVar("T")
+
+
+# envelope of the paginated list endpoints
+class Page(BaseModel, Generic[T]):
+    items: List[T]
+    next_cursor: Optional[str] = None  # pass as `cursor` to get the next page; null on the last page
+
 
 # /pharmacies/open
 class PharmacyOpenInfo(BaseModel):
@@ -11,6 +19,17 @@ class PharmacyOpenInfo(BaseModel):
     open_time: time
     close_time: time
 
+# /pharmacies/open/batch
+class OpenSlot(BaseModel):
+    day: str
+    time: str
+
+class OpenSlotResult(BaseModel):
+    day: str
+    time: str
+    pharmacies: List[PharmacyOpenInfo]
+    next_cursor: Optional[str] = None  # continues the slot on /pharmacies/open
+
 # /pharmacies/{pharmacy_name}/masks
 class MaskSchema(BaseModel):
     name: str
@@ -37,6 +56,24 @@ class PharmacyMaskCountSchema(BaseModel):
     class Config:
         from_attributes = True
 
+# /masks/cheapest
+class ProductSchema(BaseModel):
+    id: int
+    name: str
+    brand: str
+    color: Optional[str] = None
+    units_per_pack: Optional[int] = None
+
+class MaskOffer(BaseModel):
+    pharmacy_id: int
+    pharmacy_name: str
+    mask_id: int
+    price: float
+
+class CheapestOffers(BaseModel):
+    product: ProductSchema
+    offers: List[MaskOffer]  # cheapest first
+
 # /users/top_users
 class UserWithTotalAmount(BaseModel):
     id: int
@@ -78,3 +115,9 @@ class PurchaseResponse(BaseModel):
     remaining_balance: float
     details: List[PurchaseItemDetail]
 
+# /purchase/batch
+class BatchPurchaseResult(BaseModel):
+    user_id: int
+    status_code: int  # 200, or the status the order would have failed with on its own
+    detail: Optional[str] = None
+    result: Optional[PurchaseResponse] = None
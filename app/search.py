@@ -0,0 +1,179 @@
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import select
+
+from app import models
+from app.cache import DerivedCache
+
+# Names are indexed by every n-gram up to this length, so keywords shorter
+# than NGRAM_SIZE are answered by a single posting list lookup
+NGRAM_SIZE = 3
+
+# A delta touching more than this share of the names is rebuilt from scratch
+REBUILD_FRACTION = 0.25
+
+# Pharmacies rank before masks when the relevance is equal
+TYPES = ("pharmacy", "mask")
+TYPE_ORDER = {doc_type: order for order, doc_type in enumerate(TYPES)}
+
+# (type order, row id)
+DocKey = Tuple[int, int]
+# (name length, type order, row id)
+RankKey = Tuple[int, int, int]
+
+
+def ngrams(text: str, min_size: int = 1) -> Set[str]:
+    return {
+        text[i:i + n]
+        for n in range(min_size, NGRAM_SIZE + 1)
+        for i in range(len(text) - n + 1)
+    }
+
+
+class SearchIndex:
+    """In-memory n-gram inverted index over pharmacy and mask names.
+
+    An index is never changed once built. search_indexes builds a new one
+    when the "search" data version moves, which triggers bump when a
+    pharmacy or mask is added, removed or renamed, from this process or
+    another; price changes leave it alone. The new index is the previous
+    one patched with the names that changed, sharing every untouched
+    posting bucket with it.
+    """
+
+    def __init__(self, pharmacies=(), masks=()):
+        self._names: Dict[DocKey, Tuple[str, str]] = {}
+        # n-gram -> name length -> keys of the names of that length holding
+        # it, sorted, so a walk over the lengths in order is a walk in rank order
+        self._postings: Dict[str, Dict[int, List[DocKey]]] = defaultdict(lambda: defaultdict(list))
+        for row_id, name in sorted(pharmacies):
+            self._add((TYPE_ORDER["pharmacy"], row_id), name)
+        for row_id, name in sorted(masks):
+            self._add((TYPE_ORDER["mask"], row_id), name)
+
+    queries = (
+        select(models.Pharmacy.id, models.Pharmacy.name).order_by(models.Pharmacy.id),
+        select(models.Mask.id, models.Mask.name).order_by(models.Mask.id),
+    )
+
+    @classmethod
+    def build(cls, rows, previous=None) -> "SearchIndex":
+        if previous is None:
+            return cls(*rows)
+        # rows come in TYPES order
+        names = {
+            (order, row_id): name
+            for order, type_rows in enumerate(rows)
+            for row_id, name in type_rows
+        }
+        removed = [key for key, (name, _) in previous._names.items() if names.get(key) != name]
+        added = [
+            (key, name) for key, name in names.items()
+            if key not in previous._names or previous._names[key][0] != name
+        ]
+        if len(removed) + len(added) > len(names) * REBUILD_FRACTION:
+            return cls(*rows)
+        return previous._patched(removed, added)
+
+    def search(self, keyword: str, limit: Optional[int] = None) -> List[dict]:
+        return [result for result, _ in self._ranked(keyword, limit, None)]
+
+    def search_page(
+        self, keyword: str, limit: int, after: Optional[tuple] = None
+    ) -> Tuple[List[dict], List[RankKey]]:
+        """Up to `limit` results ranked after `after`, with the rank key of each."""
+        ranked = self._ranked(keyword, limit, after)
+        return [result for result, _ in ranked], [key for _, key in ranked]
+
+    def _ranked(self, keyword: str, limit: Optional[int], after: Optional[tuple]):
+        keyword_lower = keyword.lower()
+        if len(keyword_lower) <= NGRAM_SIZE:
+            grams = {keyword_lower}
+        else:
+            grams = ngrams(keyword_lower, min_size=NGRAM_SIZE)
+        postings = [self._postings.get(gram) for gram in grams]
+        if not all(postings):
+            return []
+        # a short keyword's own posting holds exactly the names containing it
+        confirmed = len(keyword_lower) <= NGRAM_SIZE
+        after = tuple(after) if after is not None else None
+
+        # relevance is len(keyword) / len(name), so shorter names rank first
+        # and the walk stops as soon as `limit` hits are found
+        ranked = []
+        for length in sorted(min(postings, key=len)):
+            if after is not None and length < after[0]:
+                continue
+            buckets = [posting.get(length) for posting in postings]
+            if not all(buckets):
+                continue
+            bucket = min(buckets, key=len)
+            start = bisect_right(bucket, after[1:]) if after is not None and length == after[0] else 0
+            for i in range(start, len(bucket)):
+                key = bucket[i]
+                name, name_lower = self._names[key]
+                # n-gram matches are only candidates, confirm the substring
+                if not confirmed and keyword_lower not in name_lower:
+                    continue
+                ranked.append((
+                    {
+                        "type": TYPES[key[0]],
+                        "name": name,
+                        "relevance": len(keyword) / len(name)
+                    },
+                    (length,) + key
+                ))
+                if limit is not None and len(ranked) == limit:
+                    return ranked
+        return ranked
+
+    def _patched(self, removed: List[DocKey], added: List[Tuple[DocKey, str]]) -> "SearchIndex":
+        """A copy without the names of `removed` and with `added` indexed.
+
+        Only the posting buckets those names fall in are copied, so this
+        index is left as it was for the requests still reading it.
+        """
+        index = object.__new__(type(self))
+        index._names = dict(self._names)
+        index._postings = dict(self._postings)
+        copied_grams, copied_buckets = set(), set()
+
+        def bucket(gram: str, length: int) -> List[DocKey]:
+            if gram not in copied_grams:
+                index._postings[gram] = dict(index._postings.get(gram, ()))
+                copied_grams.add(gram)
+            posting = index._postings[gram]
+            if (gram, length) not in copied_buckets:
+                posting[length] = list(posting.get(length, ()))
+                copied_buckets.add((gram, length))
+            return posting[length]
+
+        for key in removed:
+            name, name_lower = index._names.pop(key)
+            for gram in ngrams(name_lower):
+                keys = bucket(gram, len(name))
+                del keys[bisect_left(keys, key)]
+        for key, name in added:
+            name_lower = name.lower()
+            index._names[key] = (name, name_lower)
+            for gram in ngrams(name_lower):
+                insort(bucket(gram, len(name)), key)
+
+        for gram in copied_grams:
+            posting = index._postings[gram]
+            for length in [length for length, keys in posting.items() if not keys]:
+                del posting[length]
+            if not posting:
+                del index._postings[gram]
+        return index
+
+    def _add(self, key: DocKey, name: str):
+        name_lower = name.lower()
+        self._names[key] = (name, name_lower)
+        for gram in ngrams(name_lower):
+            self._postings[gram][len(name)].append(key)
+
+
+search_indexes = DerivedCache(SearchIndex, version="search")
@@ -0,0 +1,27 @@
+"""Fast JSON responses for the large read endpoints.
+
+A route returning a schemas object makes FastAPI validate it a second time
+against response_model and then encode it field by field. The routes here
+instead return a JSONResponse built from plain dicts, which FastAPI passes
+through untouched, and orjson writes the bytes. The dict keys are taken
+from the schema classes, so the documented shapes stay the single source
+of truth; response_model is still declared for the OpenAPI docs.
+"""
+from typing import Iterable, List, Optional, Type
+
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+
+
+def fields(schema: Type[BaseModel]) -> tuple:
+    return tuple(schema.model_fields)
+
+
+def rows_as_dicts(schema: Type[BaseModel], rows: Iterable[tuple]) -> List[dict]:
+    """Rows whose values are in the field order of `schema`, as dicts of its fields."""
+    names = fields(schema)
+    return [dict(zip(names, row)) for row in rows]
+
+
+def page_response(items: list, next_cursor: Optional[str] = None) -> ORJSONResponse:
+    return ORJSONResponse({"items": items, "next_cursor": next_cursor})
@@ -11,9 +11,31 @@ WEEKDAYS = {
     "Sun": "Sun", "Sunday": "Sun",
 }
 
+DAY_ORDER = ["Mon", "Tue", "Wed", "Thu", "Fri", "Sat", "Sun"]
+
+# "True Barrier (green) (3 per pack)"
+MASK_NAME = re.compile(r"^(?P<brand>.*?)\s*\((?P<color>[^()]*)\)\s*\((?P<units>\d+) per pack\)$")
+
 def parse_time(t: str) -> time:
     return datetime.strptime(t.strip(), "%H:%M").time()
 
+def expand_days(days_raw: str):
+    """輸入: 'Mon - Wed, Fri'
+       輸出: ['Mon', 'Tue', 'Wed', 'Fri']
+    """
+    days = []
+    for part in days_raw.split(","):
+        if "-" in part:
+            first, last = (WEEKDAYS.get(d.strip(), d.strip()) for d in part.split("-", 1))
+            if first in DAY_ORDER and last in DAY_ORDER:
+                start = DAY_ORDER.index(first)
+                span = (DAY_ORDER.index(last) - start) % 7
+                days.extend(DAY_ORDER[(start + i) % 7] for i in range(span + 1))
+                continue
+        day = part.strip()
+        days.append(WEEKDAYS.get(day, day))
+    return days
+
 def parse_opening_hours(raw: str):
     """輸入: 'Mon, Wed, Fri 08:00 - 12:00 / Tue, Thur 14:00 - 18:00'
        輸出: List[{"day_of_week": "Mon", "open_time": time(), "close_time": time()}, ...]
@@ -28,11 +50,19 @@ def parse_opening_hours(raw: str):
         days_raw, open_str, close_str = match.groups()
         open_time = parse_time(open_str)
         close_time = parse_time(close_str)
-        days = [WEEKDAYS.get(d.strip(), d.strip()) for d in days_raw.split(",")]
-        for day in days:
+        for day in expand_days(days_raw):
             result.append({
                 "day_of_week": day,
                 "open_time": open_time,
                 "close_time": close_time
             })
     return result
+
+def parse_mask_name(name: str):
+    """輸入: 'True Barrier (green) (3 per pack)'
+       輸出: ('True Barrier', 'green', 3)；無法解析的名稱整個當作品牌: (name, None, None)
+    """
+    match = MASK_NAME.match(name.strip())
+    if not match:
+        return name.strip(), None, None
+    return match["brand"], match["color"], int(match["units"])
@@ -10,8 +10,9 @@ from fastapi.testclient import TestClient
 sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 from app.main import app
 from unittest.mock import mock_open, patch, MagicMock
-from app import etl
-from datetime import datetime
+from app import etl, schemas
+from datetime import date, datetime
+from typing import List
 
 client = TestClient(app)
 
@@ -20,7 +21,7 @@ client = TestClient(app)
 def test_open_pharmacies_valid():
     response = client.get('/pharmacies/open?day=Mon&time=10:00')
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
     assert isinstance(data, list)
     if data:
         assert 'id' in data[0]
@@ -34,12 +35,83 @@ def test_open_pharmacies_invalid_time_format():
     assert response.status_code == 400
     assert response.json() == {"detail": "Invalid time format"}
 
+def test_open_pharmacies_across_midnight():
+    # "Fri - Sun 20:00 - 02:00" keeps First Pharmacy open early on Monday
+    response = client.get('/pharmacies/open?day=Mon&time=01:30')
+    assert response.status_code == 200
+    names = [p['name'] for p in response.json()["items"]]
+    assert 'First Pharmacy' in names
+    assert all(p['close_time'] < p['open_time'] for p in response.json()["items"])
+
+def test_open_pharmacies_day_range():
+    # "Mon - Fri 08:00 - 17:00"
+    response = client.get('/pharmacies/open?day=Wed&time=16:00')
+    assert 'Carepoint' in [p['name'] for p in response.json()["items"]]
+
+def test_open_pharmacies_now():
+    response = client.get('/pharmacies/open_now?limit=1')
+    assert response.status_code == 200
+    assert len(response.json()["items"]) <= 1
+    # a cursor of /pharmacies/open does not continue it
+    cursor = client.get('/pharmacies/open?limit=1').json()["next_cursor"]
+    assert client.get(f'/pharmacies/open_now?cursor={cursor}').status_code == 400
+
+def test_open_pharmacies_batch():
+    slots = [{"day": "Mon", "time": "10:00"}, {"day": "Saturday", "time": "01:00"}]
+    response = client.post('/pharmacies/open/batch', json=slots)
+    assert response.status_code == 200
+    data = response.json()
+    assert [(r['day'], r['time']) for r in data] == [("Mon", "10:00"), ("Saturday", "01:00")]
+    assert data[0]['pharmacies'] == client.get('/pharmacies/open?day=Mon&time=10:00').json()["items"]
+    assert data[1]['pharmacies'] == client.get('/pharmacies/open?day=Sat&time=01:00').json()["items"]
+    assert data[0]['next_cursor'] is None
+
+def test_open_pharmacies_batch_pages_each_slot():
+    from app.opening_hours import MAX_BATCH_SLOTS
+
+    slot = {"day": "Mon", "time": "10:00"}
+    full = client.get('/pharmacies/open?day=Mon&time=10:00').json()["items"]
+    assert len(full) > 1
+    data = client.post('/pharmacies/open/batch?limit=1', json=[slot, slot]).json()
+    assert [r['pharmacies'] for r in data] == [full[:1], full[:1]]
+    # the slot continues on /pharmacies/open
+    rest = client.get(f"/pharmacies/open?day=Mon&time=10:00&cursor={data[0]['next_cursor']}").json()["items"]
+    assert rest == full[1:]
+
+    assert client.post('/pharmacies/open/batch', json=[slot] * MAX_BATCH_SLOTS).status_code == 200
+    assert client.post('/pharmacies/open/batch', json=[slot] * (MAX_BATCH_SLOTS + 1)).status_code == 400
+
+def test_open_pharmacies_batch_invalid_time_format():
+    response = client.post('/pharmacies/open/batch', json=[{"day": "Mon", "time": "25:61"}])
+    assert response.status_code == 400
+
+def test_open_pharmacies_follow_writes_from_another_connection():
+    import sqlite3
+
+    engine = _seed_catalog_db(2)
+    url = "/pharmacies/open?day=Tue&time=10:00"
+    assert _request_with_statement_count(engine, "GET", url)[1]["items"] == []
+
+    # e.g. an ETL run in another process
+    outside = sqlite3.connect(engine.url.database)
+    outside.execute(
+        "INSERT INTO opening_hours (pharmacy_id, day_of_week, open_time, close_time) "
+        "VALUES (2, 'Tue', '09:00:00.000000', '18:00:00.000000')"
+    )
+    outside.commit()
+    assert [p["name"] for p in _request_with_statement_count(engine, "GET", url)[1]["items"]] == ["Pharmacy 1"]
+
+    outside.execute("UPDATE pharmacies SET name = 'Pharmacy One' WHERE id = 2")
+    outside.commit()
+    outside.close()
+    assert [p["name"] for p in _request_with_statement_count(engine, "GET", url)[1]["items"]] == ["Pharmacy One"]
+
 # 2. List masks in pharmacy, sorted
 
 def test_masks_by_pharmacy_name_valid():
     response = client.get('/pharmacies/Carepoint/masks?sort_by=name&order=asc')
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
     assert isinstance(data, list)
     if data:
         assert 'name' in data[0]
@@ -54,7 +126,7 @@ def test_masks_by_pharmacy_name_invalid():
 def test_mask_count_valid():
     response = client.get('/pharmacies/mask_count?min_price=5&max_price=7&count=2&op=gt')
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
     assert isinstance(data, list)
     if data:
         assert 'id' in data[0]
@@ -66,6 +138,36 @@ def test_mask_count_missing_param():
     response = client.get('/pharmacies/mask_count?min_price=5&count=2&op=gt')
     assert response.status_code == 422
 
+def test_cheapest_offers_match_sql():
+    from app import models
+    from app.database import SessionLocal
+
+    response = client.get('/masks/cheapest', params={"mask_name": "MaskT (green) (10 per pack)", "top": 3})
+    assert response.status_code == 200
+    data = response.json()
+    assert data["product"]["brand"] == "MaskT"
+    assert data["product"]["units_per_pack"] == 10
+
+    with SessionLocal() as db:
+        expected = db.query(models.Mask.id, models.Mask.price).filter(
+            models.Mask.product_id == data["product"]["id"]
+        ).order_by(models.Mask.price, models.Mask.id).limit(3).all()
+    assert [(offer["mask_id"], offer["price"]) for offer in data["offers"]] == [tuple(row) for row in expected]
+    assert client.get(f'/masks/cheapest?product_id={data["product"]["id"]}&top=3').json() == data
+
+def test_cheapest_offers_only_from_open_pharmacies():
+    params = {"mask_name": "MaskT (green) (10 per pack)", "top": 100}
+    everywhere = client.get('/masks/cheapest', params=params).json()["offers"]
+    open_ids = {row["id"] for row in client.get('/pharmacies/open?day=Mon&time=10:00&limit=100').json()["items"]}
+    response = client.get('/masks/cheapest', params={**params, "day": "Mon", "time": "10:00"})
+    assert response.status_code == 200
+    assert response.json()["offers"] == [offer for offer in everywhere if offer["pharmacy_id"] in open_ids]
+
+def test_cheapest_offers_invalid():
+    assert client.get('/masks/cheapest').status_code == 400
+    assert client.get('/masks/cheapest?mask_name=NoSuchMask').status_code == 404
+    assert client.get('/masks/cheapest?product_id=1&top=0').status_code == 422
+
 # 4. Top users by transaction amount
 
 def test_top_users_valid():
@@ -79,6 +181,17 @@ def test_top_users_valid():
         assert 'cash_balance' in data[0]
         assert 'total_amount' in data[0]
 
+def test_top_users_includes_new_purchase():
+    today = datetime.now().strftime("%Y-%m-%d")
+    url = f'/users/top_users?top=20&start_date={today}&end_date={today}'
+    before = {u['id']: u['total_amount'] for u in client.get(url).json()}
+    body = {"user_id": 3, "purchases": [{"pharmacy_id": 2, "mask_id": 6, "quantity": 1}]}
+    purchase = client.post('/purchase', json=body)
+    assert purchase.status_code == 200
+
+    after = {u['id']: u['total_amount'] for u in client.get(url).json()}
+    assert after[3] == round(before.get(3, 0) + purchase.json()['total_cost'], 2)
+
 # 5. Transaction summary
 
 def test_transaction_summary_valid():
@@ -88,18 +201,349 @@ def test_transaction_summary_valid():
     assert 'total_transactions' in data
     assert 'total_amount' in data
 
+def test_transaction_summary_includes_new_purchase():
+    before = client.get('/transactions/summary').json()
+    body = {"user_id": 2, "purchases": [{"pharmacy_id": 1, "mask_id": 2, "quantity": 1}]}
+    purchase = client.post('/purchase', json=body)
+    assert purchase.status_code == 200
+    today = datetime.now().strftime("%Y-%m-%d")
+
+    after = client.get('/transactions/summary').json()
+    assert after['total_transactions'] == before['total_transactions'] + 1
+    assert after['total_amount'] == round(before['total_amount'] + purchase.json()['total_cost'], 2)
+    today_summary = client.get(f'/transactions/summary?start_date={today}&end_date={today}').json()
+    assert today_summary['total_transactions'] >= 1
+
+def test_summarize_transactions_partial_days():
+    from sqlalchemy.orm import sessionmaker
+    from app import models
+    from app.rollups import rebuild_rollups, summarize_transactions
+
+    db = sessionmaker(bind=_seed_catalog_db(1))()
+    db.add(models.User(id=1, name="Test User", cash_balance=0.0))
+    for day, hour, amount in [(1, 9, 1.0), (1, 18, 2.0), (2, 12, 4.0), (3, 8, 8.0), (3, 20, 16.0)]:
+        db.add(models.PurchaseHistory(
+            user_id=1,
+            pharmacy_id=1,
+            transaction_amount=amount,
+            transaction_date=datetime(2021, 1, day, hour)
+        ))
+    db.flush()
+    rebuild_rollups(db)
+
+    assert summarize_transactions(db) == (5, 31.0)
+    assert summarize_transactions(db, datetime(2021, 1, 2), datetime(2021, 1, 3)) == (1, 4.0)
+    assert summarize_transactions(db, datetime(2021, 1, 1, 12), datetime(2021, 1, 3, 12)) == (3, 14.0)
+    assert summarize_transactions(db, datetime(2021, 1, 1, 8), datetime(2021, 1, 1, 10)) == (1, 1.0)
+    assert summarize_transactions(db, datetime(2021, 1, 3, 12)) == (1, 16.0)
+    db.close()
+
+# Purchase history export
+
+def test_export_purchases_ndjson_for_user():
+    from sqlalchemy.orm import sessionmaker
+    from app import models
+    from app.database import engine
+
+    response = client.get('/purchases/export?user_id=1')
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    rows = [json.loads(line) for line in response.text.splitlines()]
+
+    db = sessionmaker(bind=engine)()
+    expected = db.query(models.PurchaseHistory).filter(models.PurchaseHistory.user_id == 1).order_by(models.PurchaseHistory.id).all()
+    # the mask name comes from the product of the purchase
+    names = [h.product.name for h in expected]
+    db.close()
+    assert [r["id"] for r in rows] == [h.id for h in expected]
+    assert all(r["user_id"] == 1 for r in rows)
+    assert [r["mask_name"] for r in rows] == names
+
+def test_export_purchases_csv_date_range(tmp_path):
+    import csv
+    from app.export import main
+
+    response = client.get('/purchases/export?format=csv&start_date=2021-01-01&end_date=2021-01-03')
+    assert response.status_code == 200
+    rows = list(csv.DictReader(response.text.splitlines()))
+    assert rows and all("2021-01-01" <= r["transaction_date"] < "2021-01-04" for r in rows)
+    summary = client.get('/transactions/summary?start_date=2021-01-01&end_date=2021-01-03').json()
+    assert len(rows) == summary["total_transactions"]
+
+    # the CLI writes the same export
+    output = tmp_path / "export.csv"
+    main(["--format", "csv", "--start-date", "2021-01-01", "--end-date", "2021-01-03", "--output", str(output)])
+    assert output.read_bytes() == response.content
+
+def test_export_purchases_invalid_format():
+    assert client.get('/purchases/export?format=xml').status_code == 422
+
 # 6. Search API
 
 def test_search_valid():
     response = client.get('/search?keyword=c')
     assert response.status_code == 200
-    data = response.json()
+    data = response.json()["items"]
     assert isinstance(data, list)
     if data:
         assert 'type' in data[0]
         assert 'name' in data[0]
         assert 'relevance' in data[0]
 
+def test_search_limit_returns_top_results():
+    full = client.get('/search?keyword=c').json()["items"]
+    response = client.get('/search?keyword=c&limit=3')
+    assert response.status_code == 200
+    assert response.json()["items"] == full[:3]
+
+def test_search_index_follows_catalog_writes():
+    import sqlite3
+    from sqlalchemy.orm import sessionmaker
+    from app import models
+    from app.search import SearchIndex, search_indexes
+
+    index = SearchIndex(
+        [(1, "Carepoint")],
+        [(1, "Masquerade (blue) (6 per pack)"), (2, "Cotton Kiss (green) (3 per pack)")]
+    )
+    assert [r["name"] for r in index.search("care")] == ["Carepoint"]
+    assert [r["type"] for r in index.search("c")] == ["pharmacy", "mask", "mask"]
+    assert len(index.search("pack", limit=1)) == 1
+
+    # pages walked with the rank keys line up with one full ranking
+    names = ["Mask %d (%s)" % (i, "x" * (i % 4)) for i in range(30)]
+    index = SearchIndex([(i, "Pharmacy mask %d" % i) for i in range(10)], list(enumerate(names)))
+    for keyword in ("mask", "as", "k 1"):
+        full = index.search(keyword)
+        assert [len(r["name"]) for r in full] == sorted(len(r["name"]) for r in full)
+        walked, after = [], None
+        while True:
+            page, keys = index.search_page(keyword, 4, after)
+            walked += page
+            if len(page) < 4:
+                break
+            after = list(keys[-1])
+        assert walked == full
+
+    # a small delta patches the previous index and matches a full build
+    pharmacies = [(i, "Pharmacy mask %d" % i) for i in range(10)]
+    masks = list(enumerate(names))
+    changed_masks = masks[1:] + [(30, "Mask 30 (new)")]
+    changed_masks[3] = (4, "Renamed 4")
+    patched = SearchIndex.build([pharmacies, changed_masks], index)
+    rebuilt = SearchIndex(pharmacies, changed_masks)
+    assert patched._names == rebuilt._names
+    assert patched._postings == rebuilt._postings
+    for keyword in ("mask", "renamed", "new", "m"):
+        assert patched.search(keyword) == rebuilt.search(keyword)
+    # untouched buckets are shared and the previous index is unchanged
+    assert patched._postings["pha"] is index._postings["pha"]
+    assert [r["name"] for r in index.search("renamed")] == []
+    assert SearchIndex.build([pharmacies, masks], index)._names == index._names
+
+    db = sessionmaker(bind=_seed_catalog_db(2))()
+    index = search_indexes.get(db)
+    assert [r["name"] for r in index.search("pharmacy")] == ["Pharmacy 0", "Pharmacy 1"]
+
+    # a purchase or a price change leaves the index alone
+    db.get(models.Pharmacy, 1).cash_balance += 5.0
+    db.get(models.Mask, 1).price += 1.0
+    db.commit()
+    assert search_indexes.get(db) is index
+
+    # a rename by another process is picked up
+    outside = sqlite3.connect(db.get_bind().url.database)
+    outside.execute("UPDATE pharmacies SET name = 'Centrico' WHERE id = 1")
+    outside.execute("DELETE FROM masks WHERE pharmacy_id = 2")
+    outside.commit()
+    outside.close()
+    index = search_indexes.get(db)
+    assert [r["name"] for r in index.search("centr")] == ["Centrico"]
+    assert [r["name"] for r in index.search("pharmacy")] == ["Pharmacy 1"]
+    assert index.search("mask 1-") == [] and len(index.search("mask 0-")) == 4
+    db.close()
+
+# keyset pagination
+
+def _walk_pages(url, limit):
+    items, cursor = [], None
+    while True:
+        page = client.get(f"{url}&limit={limit}" + (f"&cursor={cursor}" if cursor else "")).json()
+        assert len(page["items"]) <= limit
+        items += page["items"]
+        cursor = page["next_cursor"]
+        if cursor is None:
+            return items
+
+@pytest.mark.parametrize("url", [
+    "/pharmacies/open?day=Mon",
+    "/pharmacies/open?time=10:00",
+    "/pharmacies/Carepoint/masks?sort_by=price&order=desc",
+    "/pharmacies/Carepoint/masks?sort_by=name&order=asc",
+    "/pharmacies/mask_count?min_price=0&max_price=100&count=0&op=gt",
+    "/search?keyword=a",
+])
+def test_pages_cover_the_full_listing(url):
+    full = client.get(f"{url}&limit=1000").json()
+    assert full["next_cursor"] is None
+    assert _walk_pages(url, 2) == full["items"]
+
+def test_invalid_cursor_is_rejected():
+    assert client.get("/search?keyword=a&cursor=not-a-cursor").status_code == 400
+    # a cursor only continues the listing it was issued for
+    cursor = client.get("/pharmacies/Carepoint/masks?sort_by=price&limit=1").json()["next_cursor"]
+    response = client.get(f"/pharmacies/Carepoint/masks?sort_by=name&cursor={cursor}")
+    assert response.status_code == 400
+    assert response.json() == {"detail": "Invalid cursor"}
+
+# benchmark harness
+
+def test_benchmark_reports_every_selected_route():
+    import asyncio
+    from app.benchmark import compare, run_benchmark
+
+    results = asyncio.run(run_benchmark(requests=5, concurrency=2, warmup=1, routes=["pharmacies_open", "search", "masks_cheapest"]))
+    assert set(results["routes"]) == {"pharmacies_open", "search", "masks_cheapest"}
+    for route in results["routes"].values():
+        assert route["requests"] == 5 and route["errors"] == 0
+        assert route["latency_ms"]["p50"] <= route["latency_ms"]["p99"] <= route["latency_ms"]["max"]
+
+    slower = json.loads(json.dumps(results))
+    slower["routes"]["search"]["latency_ms"]["p95"] = results["routes"]["search"]["latency_ms"]["p95"] * 2 + 1
+    assert compare(results, results) == []
+    assert [r.split(":")[0] for r in compare(results, slower)] == ["search"]
+
+def test_benchmark_purchase_batch_sends_valid_orders():
+    from app.benchmark import ROUTES, Samples
+    from app.purchases import MAX_BATCH_ORDERS
+
+    samples = Samples(["Carepoint"], [1, 2, 3], [(1, 1), (1, 2)], [(1, "Mask A")], ["Care"], datetime(2021, 1, 1), datetime(2021, 1, 8))
+    route = next(route for route in ROUTES if route.name == "purchase_batch")
+    url, body = route.build(samples, 3)
+    assert (url, route.method, route.writes) == ("/purchase/batch", "POST", True)
+    orders = [schemas.PurchaseRequest(**order) for order in body]
+    assert 1 < len(orders) <= MAX_BATCH_ORDERS
+    assert {order.user_id for order in orders} == {1, 2, 3}
+
+# fast serialization
+
+@pytest.mark.parametrize("url, response_type", [
+    ("/pharmacies/open?day=Mon&time=10:00", schemas.Page[schemas.PharmacyOpenInfo]),
+    ("/pharmacies/open_now", schemas.Page[schemas.PharmacyOpenInfo]),
+    ("/pharmacies/Carepoint/masks?sort_by=price&limit=2", schemas.Page[schemas.MaskSchema]),
+    ("/pharmacies/mask_count?min_price=5&max_price=30&count=0&op=gt", schemas.Page[schemas.PharmacyMaskCountSchema]),
+    ("/pharmacies/mask_count?min_price=500&max_price=600&count=1&op=gt", schemas.Page[schemas.PharmacyMaskCountSchema]),
+    ("/masks/cheapest?product_id=1&top=3", schemas.CheapestOffers),
+    ("/users/top_users?top=3", List[schemas.UserWithTotalAmount]),
+    ("/search?keyword=Mask&limit=3", schemas.Page[schemas.SearchResult]),
+])
+def test_fast_responses_keep_the_schema_shapes(url, response_type):
+    from pydantic import TypeAdapter
+
+    adapter = TypeAdapter(response_type)
+    response = client.get(url)
+    assert response.status_code == 200
+    # byte for byte what FastAPI would have produced from the schema objects
+    assert response.content == adapter.dump_json(adapter.validate_json(response.content))
+
+def test_serialization_benchmark_compares_both_paths():
+    from app.benchmark import serialization_benchmark
+
+    results = serialization_benchmark(rows=50, repeat=1)
+    assert set(results) == {"mask_count", "pharmacies_open"}
+    assert all(r["rows"] == 50 and r["fast_ms"] >= 0 for r in results.values())
+
+# metrics
+
+def _metric(text, name, **labels):
+    selector = "{" + ",".join(f'{key}="{value}"' for key, value in labels.items()) + "}"
+    values = [float(line.rsplit(" ", 1)[1]) for line in text.splitlines() if line.startswith(name + selector)]
+    return values[0] if values else None
+
+def test_metrics_by_route_template():
+    from app.cache import response_cache
+    from app.metrics import metrics
+
+    metrics.reset()
+    response_cache.clear()
+    for name in ("Carepoint", "First Pharmacy", "Carepoint"):
+        assert client.get(f"/pharmacies/{name}/masks").status_code == 200
+    assert client.get("/no/such/route").status_code == 404
+    assert client.get("/users/top_users?top=3").status_code == 200
+    body = {"user_id": 1, "purchases": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 1}]}
+    client.post('/purchase', json=body)
+
+    response = client.get("/metrics")
+    assert response.status_code == 200
+    assert response.headers["content-type"].startswith("text/plain")
+    text = response.text
+    masks = {"method": "GET", "route": "/pharmacies/{pharmacy_name}/masks"}
+    # the repeated Carepoint request came from the response cache, but is still counted
+    assert _metric(text, "phantom_mask_http_requests_total", **masks, status="200") == 3
+    assert _metric(text, "phantom_mask_http_request_duration_seconds_count", **masks) == 3
+    assert _metric(text, "phantom_mask_http_request_duration_seconds_bucket", **masks, le="+Inf") == 3
+    assert _metric(text, "phantom_mask_sql_statements_per_request_bucket", **masks, le="0") >= 1
+    top_users = {"method": "GET", "route": "/users/top_users"}
+    assert _metric(text, "phantom_mask_sql_statements_total", **top_users) > 0
+    # at least the three ranked users, read through the async driver
+    assert _metric(text, "phantom_mask_sql_rows_total", **top_users) >= 3
+    assert _metric(text, "phantom_mask_http_requests_total", method="GET", route="unmatched", status="404") == 1
+    purchase = {"method": "POST", "route": "/purchase"}
+    assert _metric(text, "phantom_mask_sql_statements_total", **purchase) > 0
+    assert _metric(text, "phantom_mask_sql_rows_total", **purchase) > 0
+
+# profiling
+
+def test_profiling_records_samples_and_query_plans(tmp_path):
+    from sqlalchemy import event
+    from app.database import async_engine, engine
+    from app.profiling import ProfilingMiddleware, _after_cursor_execute, _before_cursor_execute, record_query_plans
+
+    engines = [engine, async_engine.sync_engine]
+    for e in engines:
+        record_query_plans(e)
+    profiled = TestClient(ProfilingMiddleware(app, mode="header", directory=str(tmp_path), token="secret"))
+    try:
+        plain = profiled.get('/users/top_users?top=3')
+        assert "x-profile-id" not in plain.headers
+        assert list(tmp_path.iterdir()) == []
+
+        # already cached by the plain request, but a profiled request is always computed
+        response = profiled.get('/users/top_users?top=3', headers={"X-Profile": "secret"})
+        body = {"user_id": 1, "purchases": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 1}]}
+        purchase = profiled.post('/purchase', json=body, headers={"X-Profile": "secret"})
+    finally:
+        for e in engines:
+            event.remove(e, "before_cursor_execute", _before_cursor_execute)
+            event.remove(e, "after_cursor_execute", _after_cursor_execute)
+
+    assert response.json() == plain.json()
+    report = json.loads((tmp_path / f"{response.headers['x-profile-id']}.json").read_text())
+    assert report["path"] == "/users/top_users" and report["status"] == 200
+    assert report["profile"]["samples"] == sum(report["profile"]["packages"].values())
+    users_query = next(s for s in report["statements"] if "FROM users" in s["sql"])
+    assert any("users USING INTEGER PRIMARY KEY" in line for line in users_query["plan"])
+
+    report = json.loads((tmp_path / f"{purchase.headers['x-profile-id']}.json").read_text())
+    assert report["method"] == "POST" and report["statements"]
+    assert all("plan" in s or "plan_error" in s for s in report["statements"])
+
+def test_profiling_header_needs_the_token_or_a_loopback_client(tmp_path):
+    from app.profiling import ProfilingMiddleware
+
+    def profiled(client, **options):
+        middleware = ProfilingMiddleware(app, mode="header", directory=str(tmp_path), keep=2, **options)
+        response = TestClient(middleware, client=(client, 50000)).get('/', headers={"X-Profile": "1"})
+        return "x-profile-id" in response.headers
+
+    assert not profiled("203.0.113.7")
+    assert not profiled("testclient")
+    assert profiled("127.0.0.1") and profiled("::1")
+    assert not profiled("127.0.0.1", token="secret")
+    assert profiled("203.0.113.7", token="1")
+    # only the newest `keep` reports are left
+    assert len(list(tmp_path.iterdir())) == 2
+
 # 7. Purchase API
 
 def test_purchase_success():
@@ -185,38 +629,890 @@ def sample_user_data():
         }
     ]
 
-def test_load_pharmacies(sample_pharmacy_data):
-    m = mock_open(read_data=json.dumps(sample_pharmacy_data))
-    with patch("builtins.open", m):
-        with patch("app.etl.SessionLocal") as mock_session:
-            mock_db = MagicMock()
-            mock_session.return_value = mock_db
-            etl.load_pharmacies("fake_path.json")
-            assert mock_db.add.call_count >= 1
-            assert mock_db.commit.called
-            assert mock_db.close.called
-
-def test_load_users(sample_user_data):
-    m = mock_open(read_data=json.dumps(sample_user_data))
-    with patch("builtins.open", m):
-        with patch("app.etl.SessionLocal") as mock_session:
-            mock_db = MagicMock()
-            mock_session.return_value = mock_db
-
-            # mock pharmacy lookup
-            fake_pharmacy = MagicMock()
-            fake_pharmacy.name = "Test Pharmacy"
-            fake_pharmacy.id = 1
-            mock_db.query.return_value.all.return_value = [fake_pharmacy]
-
-            etl.load_users("fake_path.json")
-            assert mock_db.add.call_count >= 2
-            assert mock_db.commit.called
-            assert mock_db.close.called
+@pytest.fixture
+def etl_session():
+    from sqlalchemy.orm import sessionmaker
+
+    engine = _seed_catalog_db(0)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    with patch("app.etl.SessionLocal", Session):
+        yield Session
+
+def _write_json(tmp_path, name, data):
+    path = tmp_path / name
+    path.write_text(json.dumps(data, indent=2))
+    return str(path)
+
+def test_parse_mask_name():
+    from app.utils import parse_mask_name
+
+    assert parse_mask_name("True Barrier (green) (3 per pack)") == ("True Barrier", "green", 3)
+    assert parse_mask_name("Second Smile (black) (10 per pack)") == ("Second Smile", "black", 10)
+    assert parse_mask_name("Mask A") == ("Mask A", None, None)
+
+def test_iter_json_array_small_chunks(tmp_path, sample_pharmacy_data, sample_user_data):
+    data = sample_pharmacy_data + sample_user_data + [1234567, "a]b", []]
+    path = _write_json(tmp_path, "data.json", data)
+    for chunk_size in (1, 3, 64):
+        assert list(etl.iter_json_array(path, chunk_size)) == data
+
+def test_iter_json_array_truncated(tmp_path):
+    path = tmp_path / "broken.json"
+    path.write_text('[{"name": "A"}, {"name"')
+    with pytest.raises(ValueError):
+        list(etl.iter_json_array(str(path), 4))
+
+def test_load_pharmacies(tmp_path, etl_session, sample_pharmacy_data):
+    from app import models
+
+    data = sample_pharmacy_data + [
+        {"name": f"Pharmacy {i}", "masks": [{"name": "Mask C", "price": 1.0}], "openingHours": "Mon - Wed 08:00 - 12:00"}
+        for i in range(5)
+    ]
+    etl.load_pharmacies(_write_json(tmp_path, "pharmacies.json", data), batch_size=2)
+
+    db = etl_session()
+    pharmacies = db.query(models.Pharmacy).order_by(models.Pharmacy.id).all()
+    assert [p.name for p in pharmacies] == [p["name"] for p in data]
+    assert [m.name for m in pharmacies[0].masks] == ["Mask A", "Mask B"]
+    assert pharmacies[0].cash_balance == 100.0
+    assert db.query(models.Mask).count() == 7
+    assert [oh.day_of_week for oh in pharmacies[1].opening_hours] == ["Mon", "Tue", "Wed"]
+    # one product per distinct mask name, shared by the pharmacies selling it
+    assert [p.name for p in db.query(models.Product).order_by(models.Product.id)] == ["Mask A", "Mask B", "Mask C"]
+    assert {m.product.name for m in db.query(models.Mask)} == {"Mask A", "Mask B", "Mask C"}
+    assert all(m.product.name == m.name for m in db.query(models.Mask))
+    db.close()
+
+def test_load_users(tmp_path, etl_session, sample_pharmacy_data, sample_user_data):
+    from app import models
+
+    etl.load_pharmacies(_write_json(tmp_path, "pharmacies.json", sample_pharmacy_data))
+    etl.load_users(_write_json(tmp_path, "users.json", sample_user_data * 3), batch_size=2)
+
+    db = etl_session()
+    assert db.query(models.User).count() == 3
+    histories = db.query(models.PurchaseHistory).order_by(models.PurchaseHistory.id).all()
+    assert [h.user_id for h in histories] == [1, 2, 3]
+    assert histories[0].pharmacy.name == "Test Pharmacy"
+    assert histories[0].transaction_date == datetime(2021, 1, 1, 10, 0, 0)
+    assert {h.product_id for h in histories} == {db.query(models.Mask).filter_by(name="Mask A").one().product_id}
+    rollup = db.query(models.PurchaseDailyRollup).one()
+    assert (rollup.transaction_count, rollup.transaction_amount) == (3, 16.5)
+    db.close()
+
+def test_delta_etl_keys_purchases_of_the_full_load(tmp_path, etl_session, sample_pharmacy_data, sample_user_data):
+    from app import models, etl_delta
+
+    users = sample_user_data * 2
+    users[1] = dict(users[1], purchaseHistories=users[1]["purchaseHistories"] * 2)
+    etl.load_pharmacies(_write_json(tmp_path, "pharmacies.json", sample_pharmacy_data))
+    etl.load_users(_write_json(tmp_path, "users.json", users))
+
+    db = etl_session()
+    assert db.query(models.EtlRecord).filter_by(kind="purchase").count() == 0
+    assert [(d.first_id, d.last_id) for d in db.query(models.EtlDeferredPurchases)] == [(1, 3)]
+    etl_delta.key_deferred_purchases(db)
+
+    # the same keys as hashing the source records
+    expected = {
+        key: history_id
+        for history_id, key in enumerate(
+            (key for u, user_key in etl.keyed_users(users) for _, key in etl.purchase_records(u, user_key)), start=1
+        )
+    }
+    records = db.query(models.EtlRecord).filter_by(kind="purchase")
+    assert {record.key: record.row_id for record in records} == expected
+    assert db.query(models.EtlDeferredPurchases).count() == 0
+    db.close()
+
+def _pharmacy_feed(count):
+    return [
+        {
+            "name": f"Pharmacy {i}",
+            "cashBalance": 10.0,
+            "openingHours": "Mon 08:00 - 12:00",
+            "masks": [{"name": "Mask A", "price": 5.0}, {"name": "Mask B", "price": 6.0}]
+        }
+        for i in range(count)
+    ]
+
+def test_delta_etl_applies_only_changes(tmp_path, etl_session, sample_user_data):
+    from app import models, etl_delta
+
+    pharmacies = _pharmacy_feed(3)
+    users = [dict(sample_user_data[0], purchaseHistories=[
+        dict(sample_user_data[0]["purchaseHistories"][0], pharmacyName="Pharmacy 0")
+    ])]
+    etl.load_pharmacies(_write_json(tmp_path, "pharmacies.json", pharmacies))
+    etl.load_users(_write_json(tmp_path, "users.json", users))
+
+    pharmacies[0]["masks"][0]["price"] = 4.5
+    pharmacies[1]["openingHours"] = "Tue 09:00 - 10:00"
+    del pharmacies[2]
+    pharmacies.append({"name": "Pharmacy New", "masks": [{"name": "Mask C", "price": 1.0}]})
+    users[0]["purchaseHistories"].append(
+        {"pharmacyName": "Pharmacy New", "maskName": "Mask C", "transactionAmount": 1.0, "transactionDate": "2021-01-02 09:00:00"}
+    )
+    with patch("app.etl_delta.SessionLocal", etl_session):
+        etl_delta.run_delta_etl(
+            _write_json(tmp_path, "pharmacies.json", pharmacies),
+            _write_json(tmp_path, "users.json", users)
+        )
+
+    db = etl_session()
+    assert [p.name for p in db.query(models.Pharmacy).order_by(models.Pharmacy.id)] == ["Pharmacy 0", "Pharmacy 1", "Pharmacy New"]
+    assert db.query(models.Mask.price).filter(models.Mask.id == 1).scalar() == 4.5
+    # unchanged rows keep their ids
+    assert db.query(models.Mask.id).filter(models.Mask.name == "Mask B").all() == [(2,), (4,)]
+    assert [oh.day_of_week for oh in db.get(models.Pharmacy, 2).opening_hours] == ["Tue"]
+    assert db.query(models.PurchaseHistory.id).all() == [(1,), (2,)]
+    assert db.query(models.PurchaseDailyRollup).count() == 2
+    db.close()
+
+def test_delta_etl_resumes_from_checkpoint(tmp_path, etl_session):
+    from app import models, etl_delta
+
+    path = _write_json(tmp_path, "pharmacies.json", _pharmacy_feed(5))
+    sync_batch = etl_delta._sync_pharmacy_batch
+    calls = []
+
+    def failing_batch(db, run_id, batch, products):
+        calls.append([p["name"] for p in batch])
+        if len(calls) == 2:
+            raise RuntimeError("interrupted")
+        sync_batch(db, run_id, batch, products)
+
+    with patch("app.etl_delta.SessionLocal", etl_session):
+        with patch("app.etl_delta._sync_pharmacy_batch", failing_batch):
+            with pytest.raises(RuntimeError):
+                etl_delta.sync_pharmacies(path, checkpoint_every=2)
+        db = etl_session()
+        assert db.query(models.Pharmacy).count() == 2
+        assert db.get(models.EtlCheckpoint, "pharmacies").position == 2
+        db.close()
+
+        with patch("app.etl_delta._sync_pharmacy_batch", failing_batch):
+            etl_delta.sync_pharmacies(path, checkpoint_every=2)
+
+    assert calls[2:] == [["Pharmacy 2", "Pharmacy 3"], ["Pharmacy 4"]]
+    db = etl_session()
+    assert db.query(models.Pharmacy).count() == 5
+    assert db.query(models.Mask).count() == 10
+    assert db.get(models.EtlCheckpoint, "pharmacies").completed
+    db.close()
+
+def test_generated_data_loads_through_etl(tmp_path, etl_session):
+    from app import models
+    from app.datagen import generate
+
+    generate(str(tmp_path), pharmacies=30, masks=400, users=50, transactions=600, days=10, seed=7)
+    etl.load_pharmacies(str(tmp_path / "pharmacies.json"))
+    etl.load_users(str(tmp_path / "users.json"))
+
+    db = etl_session()
+    assert db.query(models.Pharmacy).count() == 30
+    assert db.query(models.Mask).count() == 400
+    assert db.query(models.User).count() == 50
+    # every purchase names a pharmacy that exists, so none is dropped
+    assert db.query(models.PurchaseHistory).count() == 600
+    assert db.query(models.OpeningHour).count() > 0
+    db.close()
+
+    # the same seed gives the same files
+    again = tmp_path / "again"
+    generate(str(again), pharmacies=30, masks=400, users=50, transactions=600, days=10, seed=7)
+    assert (again / "users.json").read_bytes() == (tmp_path / "users.json").read_bytes()
 
 def test_run_etl():
-    with patch("app.etl.init_db") as mock_init, patch("app.etl.load_pharmacies") as mock_pharm, patch("app.etl.load_users") as mock_users:
+    with patch("app.etl.reset_database") as mock_reset, patch("app.etl.init_db") as mock_init, \
+            patch("app.etl.load_pharmacies") as mock_pharm, patch("app.etl.load_users") as mock_users:
         etl.run_etl()
+        mock_reset.assert_called_once_with(etl.engine)
         mock_init.assert_called_once()
         mock_pharm.assert_called_once_with("data/pharmacies.json")
         mock_users.assert_called_once_with("data/users.json")
+
+def test_reset_database_removes_the_configured_file(tmp_path, monkeypatch):
+    from sqlalchemy import create_engine, text
+
+    path = tmp_path / "data" / "masks.db"
+    path.parent.mkdir()
+    engine = create_engine(f"sqlite:///{path}")
+    with engine.begin() as conn:
+        conn.execute(text("CREATE TABLE t (x INTEGER)"))
+    for suffix in ("-wal", "-shm"):
+        (tmp_path / "data" / f"masks.db{suffix}").write_bytes(b"")
+    # a database in the working directory is not the configured one
+    monkeypatch.chdir(tmp_path)
+    (tmp_path / "phantom_mask.db").write_bytes(b"keep")
+
+    etl.reset_database(engine)
+    assert list((tmp_path / "data").iterdir()) == []
+    assert (tmp_path / "phantom_mask.db").read_bytes() == b"keep"
+
+# mask_count query count
+
+def _seed_catalog_db(pharmacy_count):
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from app import models
+
+    # a file, so that the async engine of the read endpoints sees the same data
+    path = os.path.join(tempfile.mkdtemp(), "catalog.db")
+    engine = create_engine(f"sqlite:///{path}", connect_args={"check_same_thread": False})
+    models.Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    for i in range(pharmacy_count):
+        pharmacy = models.Pharmacy(name=f"Pharmacy {i}", cash_balance=100.0)
+        pharmacy.masks = [
+            models.Mask(name=f"Mask {i}-{j}", price=5.0 + j)
+            for j in range(4)
+        ]
+        db.add(pharmacy)
+    db.commit()
+    db.close()
+    return engine
+
+def _request_with_statement_count(engine, method, url, clear_cache=True, **kwargs):
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+    from sqlalchemy.orm import sessionmaker
+    from sqlalchemy.pool import NullPool
+    from app.cache import response_cache
+    from app.database import get_async_db, get_db
+
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{engine.url.database}", poolclass=NullPool)
+    AsyncSession = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    def override_get_db():
+        db = Session()
+        try:
+            yield db
+        finally:
+            db.close()
+
+    async def override_get_async_db():
+        async with AsyncSession() as db:
+            yield db
+
+    # the seeded database is a different data set from whatever the cache has seen
+    if clear_cache:
+        response_cache.clear()
+    # listen on every engine: reads go through the async engine, purchases through the sync one
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    app.dependency_overrides[get_db] = override_get_db
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    try:
+        response = client.request(method, url, **kwargs)
+    finally:
+        app.dependency_overrides.clear()
+        event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+    assert response.status_code in (200, 304)
+    return len(statements), response.json() if response.status_code == 200 else response
+
+@pytest.mark.parametrize("op, count, expected", [("gt", 2, 3), ("lt", 4, 3), ("lt", 2, None)])
+def test_mask_count_statement_count_is_constant(op, count, expected):
+    url = f"/pharmacies/mask_count?min_price=5&max_price=7&count={count}&op={op}"
+
+    small_count, small_data = _request_with_statement_count(_seed_catalog_db(5), "GET", url)
+    large_count, large_data = _request_with_statement_count(_seed_catalog_db(50), "GET", url)
+
+    assert small_count == large_count
+    small_data, large_data = small_data["items"], large_data["items"]
+    if expected is None:
+        assert small_data == [] and large_data == []
+    else:
+        assert len(small_data) == 5 and len(large_data) == 50
+        assert all(p["mask_count"] == expected for p in large_data)
+        assert all(len(p["masks"]) == expected for p in large_data)
+
+# purchase query count
+
+@pytest.mark.parametrize("pharmacy_count", [2, 40])
+def test_purchase_statement_count_is_constant(pharmacy_count):
+    from sqlalchemy.orm import sessionmaker
+    from app import models
+
+    engine = _seed_catalog_db(pharmacy_count)
+    db = sessionmaker(bind=engine)()
+    db.add(models.User(id=1, name="Test User", cash_balance=10000.0))
+    db.commit()
+    mask_rows = db.query(models.Mask.id, models.Mask.pharmacy_id, models.Mask.price).all()
+    db.close()
+
+    body = {
+        "user_id": 1,
+        "purchases": [
+            {"pharmacy_id": pharmacy_id, "mask_id": mask_id, "quantity": 2}
+            for mask_id, pharmacy_id, _ in mask_rows
+        ]
+    }
+    statement_count, data = _request_with_statement_count(engine, "POST", "/purchase", json=body)
+
+    # user, masks, pharmacy balances, histories, user balance, two rollups
+    assert statement_count <= 8
+    assert len(data["details"]) == len(mask_rows)
+    expected_cost = round(sum(round(price * 2, 2) for _, _, price in mask_rows), 2)
+    assert data["total_cost"] == expected_cost
+
+    db = sessionmaker(bind=engine)()
+    assert db.query(models.PurchaseHistory).count() == len(mask_rows)
+    assert round(db.get(models.Pharmacy, 1).cash_balance, 2) == round(100.0 + sum(round(p * 2, 2) for p in (5.0, 6.0, 7.0, 8.0)), 2)
+    assert round(db.get(models.User, 1).cash_balance, 2) == round(10000.0 - expected_cost, 2)
+    db.close()
+
+def test_batch_purchase_reports_each_order():
+    from sqlalchemy.orm import sessionmaker
+    from app import models
+
+    engine = _seed_catalog_db(2)
+    db = sessionmaker(bind=engine)()
+    db.add_all([models.User(id=1, name="Rich", cash_balance=100.0), models.User(id=2, name="Poor", cash_balance=1.0)])
+    db.commit()
+    db.close()
+
+    orders = [
+        {"user_id": 1, "purchases": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 2}]},
+        {"user_id": 2, "purchases": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 1}]},
+        {"user_id": 9, "purchases": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 1}]},
+        {"user_id": 1, "purchases": [{"pharmacy_id": 2, "mask_id": 9, "quantity": 1}]},
+        {"user_id": 1, "purchases": [{"pharmacy_id": 2, "mask_id": 5, "quantity": 3}]},
+    ] * 4
+    statement_count, data = _request_with_statement_count(engine, "POST", "/purchase/batch", json=orders)
+
+    assert [row["status_code"] for row in data[:5]] == [200, 400, 404, 404, 200]
+    assert data[1]["detail"] == "Insufficient balance"
+    assert data[4]["result"]["total_cost"] == 15.0
+    # prefetch twice, a debit per order, then credits, histories and two rollups per user
+    assert statement_count <= 2 + len(orders) + 2 + 2 * 3
+
+    db = sessionmaker(bind=engine)()
+    assert db.get(models.User, 1).cash_balance == 100.0 - 4 * (10.0 + 15.0)
+    assert db.get(models.User, 2).cash_balance == 1.0
+    assert db.get(models.Pharmacy, 1).cash_balance == 100.0 + 4 * 10.0
+    assert db.get(models.Pharmacy, 2).cash_balance == 100.0 + 4 * 15.0
+    assert db.query(models.PurchaseHistory).count() == 8
+    assert db.query(models.PurchaseDailyRollup).one().transaction_count == 8
+    db.close()
+
+def test_batch_purchase_limit():
+    from app.purchases import MAX_BATCH_ORDERS
+
+    order = {"user_id": 9999, "purchases": [{"pharmacy_id": 1, "mask_id": 1, "quantity": 1}]}
+    assert client.post('/purchase/batch', json=[order] * (MAX_BATCH_ORDERS + 1)).status_code == 400
+
+# month partitions of purchase histories
+
+def test_archived_months_are_read_only_and_still_queried(tmp_path):
+    from sqlalchemy import create_engine, insert
+    from sqlalchemy.exc import IntegrityError
+    from sqlalchemy.orm import sessionmaker
+    from app import models, partitions
+    from app.etl_delta import _delete_histories
+    from app.export import export_query
+    from app.rollups import rebuild_rollups, summarize_transactions
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'partitions.db'}")
+    models.Base.metadata.create_all(bind=engine)
+    db = sessionmaker(bind=engine)()
+    db.add_all(models.User(id=i, name=f"User {i}", cash_balance=0.0) for i in (1, 2))
+    db.add_all(
+        models.PurchaseHistory(
+            user_id=day % 2 + 1, pharmacy_id=1, transaction_amount=float(day),
+            transaction_date=datetime(2021, month, day, 12)
+        )
+        for month in (1, 2, 3) for day in (1, 15, 28)
+    )
+    rebuild_rollups(db)
+    db.commit()
+    expected_ids = [row.id for row in db.execute(export_query(partitions.history_tables(db)))]
+    expected_edge = summarize_transactions(db, datetime(2021, 2, 14, 18), datetime(2021, 3, 1, 6))
+
+    assert partitions.archive_months(db, date(2021, 3, 1)) == [date(2021, 1, 1), date(2021, 2, 1)]
+    db.commit()
+    assert db.query(models.PurchaseHistory).count() == 3
+    february = partitions.partition_table(date(2021, 2, 1))
+    assert partitions.history_tables(db, datetime(2021, 2, 10), datetime(2021, 2, 20)) == [partitions.HOT_TABLE, february]
+    assert len(partitions.history_tables(db)) == 3
+
+    # reads see the same data, in the same id order
+    assert [row.id for row in db.execute(export_query(partitions.history_tables(db)))] == expected_ids
+    assert summarize_transactions(db, datetime(2021, 2, 14, 18), datetime(2021, 3, 1, 6)) == expected_edge
+
+    with pytest.raises(IntegrityError, match="read-only"):
+        db.execute(february.delete())
+    db.rollback()
+
+    # ids of archived rows are not reused, even once purchase_histories is empty
+    partitions.archive_month(db, date(2021, 3, 1))
+    db.commit()
+    assert db.execute(insert(partitions.HOT_TABLE).values(
+        user_id=1, pharmacy_id=1, transaction_amount=1.0, transaction_date=datetime(2021, 4, 1)
+    ).returning(partitions.HOT_TABLE.c.id)).scalar() == max(expected_ids) + 1
+    db.rollback()
+
+    # maintenance goes through writable() and keeps the rollups in step
+    _delete_histories(db, "user_id", [2])
+    db.commit()
+    assert db.query(models.PurchaseHistory).count() == 0
+    assert sum(amount for _, amount in db.query(models.UserDailySpend.user_id, models.UserDailySpend.transaction_amount)) == 3 * 28.0
+    with pytest.raises(IntegrityError):
+        db.execute(february.delete())
+    db.rollback()
+
+    partitions.compact(engine)
+    assert db.query(models.HistoryPartition).filter(models.HistoryPartition.compacted_at.is_(None)).count() == 0
+    db.close()
+    engine.dispose()
+
+# concurrent purchases
+
+def test_concurrent_purchases_do_not_lose_updates(tmp_path):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from fastapi import HTTPException
+    from sqlalchemy import create_engine, func
+    from sqlalchemy.orm import sessionmaker
+    from app import models, schemas
+    from app.purchases import execute_purchase
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'stress.db'}", connect_args={"check_same_thread": False})
+    models.Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    user_count, buyer_count, attempts_per_buyer = 10, 50, 10
+    db = Session()
+    pharmacy = models.Pharmacy(name="Stress Pharmacy", cash_balance=0.0)
+    pharmacy.masks = [models.Mask(name="Stress Mask", price=1.0)]
+    db.add(pharmacy)
+    db.add_all(models.User(id=i, name=f"User {i}", cash_balance=20.0) for i in range(1, user_count + 1))
+    db.commit()
+    mask_id = pharmacy.masks[0].id
+    db.close()
+
+    barrier = threading.Barrier(buyer_count)
+
+    def buyer(n):
+        purchase = schemas.PurchaseRequest(
+            user_id=n % user_count + 1,
+            purchases=[schemas.PurchaseItem(pharmacy_id=1, mask_id=mask_id, quantity=1)]
+        )
+        succeeded = 0
+        db = Session()
+        barrier.wait()
+        try:
+            for _ in range(attempts_per_buyer):
+                try:
+                    execute_purchase(db, purchase)
+                    succeeded += 1
+                except HTTPException as e:
+                    assert e.detail == "Insufficient balance"
+        finally:
+            db.close()
+        return succeeded
+
+    with ThreadPoolExecutor(max_workers=buyer_count) as pool:
+        succeeded = sum(pool.map(buyer, range(buyer_count)))
+
+    # every user can afford exactly 20 masks out of 50 attempts
+    assert succeeded == user_count * 20
+    db = Session()
+    assert db.query(func.max(models.User.cash_balance)).scalar() == 0.0
+    assert db.query(func.min(models.User.cash_balance)).scalar() == 0.0
+    assert db.get(models.Pharmacy, 1).cash_balance == succeeded
+    assert db.query(models.PurchaseHistory).count() == succeeded
+    assert db.query(func.sum(models.PurchaseDailyRollup.transaction_count)).scalar() == succeeded
+    db.close()
+    engine.dispose()
+
+def test_group_commit_coalesces_concurrent_purchases(tmp_path):
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from fastapi import HTTPException
+    from sqlalchemy import create_engine, event
+    from sqlalchemy.orm import sessionmaker
+    from app import models, schemas
+    from app.purchases import GroupCommitQueue
+
+    engine = create_engine(f"sqlite:///{tmp_path / 'group.db'}", connect_args={"check_same_thread": False})
+    models.Base.metadata.create_all(bind=engine)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+    db = Session()
+    pharmacy = models.Pharmacy(name="Group Pharmacy", cash_balance=0.0)
+    pharmacy.masks = [models.Mask(name="Group Mask", price=1.0)]
+    db.add(pharmacy)
+    db.add_all(models.User(id=i, name=f"User {i}", cash_balance=1.0) for i in range(1, 11))
+    db.commit()
+    db.close()
+
+    commits = []
+    event.listen(engine, "commit", lambda conn: commits.append(1))
+    group_commit = GroupCommitQueue(Session, window=0.2)
+    barrier = threading.Barrier(20)
+
+    def buyer(n):
+        # users 1-10 twice each: the second order of every user cannot be paid
+        purchase = schemas.PurchaseRequest(
+            user_id=n % 10 + 1, purchases=[schemas.PurchaseItem(pharmacy_id=1, mask_id=1, quantity=1)]
+        )
+        barrier.wait()
+        try:
+            return group_commit.submit(purchase).remaining_balance
+        except HTTPException as e:
+            return e.detail
+
+    try:
+        with ThreadPoolExecutor(max_workers=20) as pool:
+            results = list(pool.map(buyer, range(20)))
+    finally:
+        group_commit.close()
+
+    assert sorted(results, key=str) == [0.0] * 10 + ["Insufficient balance"] * 10
+    assert len(commits) < 20
+    db = Session()
+    assert db.get(models.Pharmacy, 1).cash_balance == 10.0
+    assert db.query(models.PurchaseHistory).count() == 10
+    db.close()
+    engine.dispose()
+
+# query plans
+
+def _query_plans(engine, action):
+    """Run `action` and return the EXPLAIN QUERY PLAN text of every SELECT it issued."""
+    from sqlalchemy import event
+    from sqlalchemy.engine import Engine
+
+    statements = []
+
+    def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        if statement.lstrip().upper().startswith("SELECT"):
+            statements.append((statement, parameters))
+
+    event.listen(Engine, "before_cursor_execute", before_cursor_execute)
+    try:
+        action()
+    finally:
+        event.remove(Engine, "before_cursor_execute", before_cursor_execute)
+
+    raw = engine.raw_connection()
+    try:
+        return [
+            "\n".join(row[-1] for row in raw.cursor().execute(f"EXPLAIN QUERY PLAN {statement}", parameters))
+            for statement, parameters in statements
+        ]
+    finally:
+        raw.close()
+
+def test_hot_queries_use_indexes():
+    from sqlalchemy.orm import sessionmaker
+    from app import models
+    from app.rollups import summarize_transactions
+
+    engine = _seed_catalog_db(10)
+    Session = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+
+    # the masks listings are answered from the catalog snapshot once it is loaded
+    _request_with_statement_count(engine, "GET", "/pharmacies/Pharmacy 3/masks?sort_by=price")
+    for url in ("/pharmacies/Pharmacy 3/masks?sort_by=price", "/pharmacies/mask_count?min_price=5&max_price=7&count=2&op=gt"):
+        statement_count, _ = _request_with_statement_count(engine, "GET", url)
+        assert statement_count == 0
+
+    db = Session()
+    edge_plan = _query_plans(engine, lambda: summarize_transactions(
+        db, datetime(2021, 1, 1, 12), datetime(2021, 1, 3, 12)
+    ))
+    assert any("USING COVERING INDEX ix_purchase_histories_date_user_amount" in plan for plan in edge_plan)
+
+    open_plan = _query_plans(engine, lambda: db.query(models.OpeningHour.pharmacy_id).filter(
+        models.OpeningHour.day_of_week == "Mon",
+        models.OpeningHour.open_time <= datetime(2021, 1, 1, 10).time()
+    ).all())
+    assert any("ix_opening_hours_day_open_close" in plan for plan in open_plan)
+    db.close()
+
+def test_catalog_snapshot_matches_sql_and_follows_writes():
+    import sqlite3
+    from sqlalchemy.orm import sessionmaker
+    from app import models
+    from app.catalog import catalog
+
+    db = sessionmaker(bind=_seed_catalog_db(3))()
+    db.add(models.Mask(pharmacy_id=2, name="Mask 1-0", price=6.0))
+    db.commit()
+    snapshot = catalog.ensure_current(db)
+    assert catalog.ensure_current(db) is snapshot
+
+    expected = db.query(models.Mask.name, models.Mask.price, models.Mask.id).filter(
+        models.Mask.pharmacy_id == 2
+    ).order_by(models.Mask.price.desc(), models.Mask.id.desc()).all()
+    index = snapshot.pharmacy_index("Pharmacy 1")
+    assert snapshot.masks_page(index, "price", True, None, 10) == [tuple(row) for row in expected]
+    assert snapshot.masks_page(index, "price", True, expected[1][1:], 2) == [tuple(row) for row in expected[2:4]]
+    assert snapshot.pharmacy_index("Pharmacy 9") is None
+    assert [row[:3] for row in snapshot.mask_count_page(6, 7, 2, "gt", None, 10)] == [(2, "Pharmacy 1", 3)]
+    assert [row[0] for row in snapshot.mask_count_page(6, 7, 3, "lt", 1, 10)] == [3]
+
+    # a commit replaces the snapshot as a whole
+    db.add(models.Mask(pharmacy_id=1, name="Mask 0-4", price=6.5))
+    db.commit()
+    current = catalog.ensure_current(db)
+    assert current is not snapshot
+    assert [row[:3] for row in current.mask_count_page(6, 7, 2, "gt", None, 10)] == [(1, "Pharmacy 0", 3), (2, "Pharmacy 1", 3)]
+    assert current.mask_count_page(6, 7, 2, "gt", None, 10)[0][3] == [("Mask 0-1", 6.0), ("Mask 0-2", 7.0), ("Mask 0-4", 6.5)]
+
+    # a purchase moves the data revision but not the catalog
+    db.get(models.Pharmacy, 1).cash_balance += 6.0
+    db.add(models.PurchaseHistory(user_id=1, pharmacy_id=1, transaction_amount=6.0,
+                                  transaction_date=datetime(2021, 1, 1)))
+    db.commit()
+    assert catalog.ensure_current(db) is current
+
+    # nor does a write through another connection go unnoticed
+    outside = sqlite3.connect(db.get_bind().url.database)
+    outside.execute("UPDATE pharmacies SET name = 'Pharmacy Zero' WHERE id = 1")
+    outside.commit()
+    outside.close()
+    renamed = catalog.ensure_current(db)
+    assert renamed is not current
+    assert renamed.pharmacy_index("Pharmacy Zero") == 0 and renamed.pharmacy_index("Pharmacy 0") is None
+    db.close()
+
+def _concurrent_requests(engine, urls, timeout=20):
+    """Send every GET in `urls` at once on one event loop, against `engine`."""
+    import asyncio
+
+    async def send_all(concurrent_client):
+        return await asyncio.gather(*(concurrent_client.get(url) for url in urls))
+
+    return _run_against(engine, send_all, timeout)
+
+def _run_against(engine, scenario, timeout=20):
+    """Run `scenario(client)` on an event loop of its own, the app reading `engine`."""
+    import asyncio
+    import threading
+    import httpx
+    from sqlalchemy.ext.asyncio import async_sessionmaker, create_async_engine
+    from sqlalchemy.pool import NullPool
+    from app.cache import response_cache
+    from app.database import get_async_db
+
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{engine.url.database}", poolclass=NullPool)
+    AsyncSession = async_sessionmaker(async_engine, autoflush=False, expire_on_commit=False)
+
+    async def override_get_async_db():
+        async with AsyncSession() as db:
+            yield db
+
+    async def run():
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://testserver") as concurrent_client:
+            return await scenario(concurrent_client)
+
+    responses = []
+    # a blocked event loop cannot time itself out, so wait for it from here
+    runner = threading.Thread(target=lambda: responses.extend(asyncio.run(run())), daemon=True)
+    response_cache.clear()
+    app.dependency_overrides[get_async_db] = override_get_async_db
+    try:
+        runner.start()
+        runner.join(timeout)
+    finally:
+        app.dependency_overrides.clear()
+    assert not runner.is_alive(), "concurrent requests did not finish"
+    return responses
+
+def test_catalog_reload_serves_concurrent_requests():
+    from app.cache import revision_for
+
+    engine = _seed_catalog_db(20)
+    urls = [
+        f"/pharmacies/Pharmacy {i}/masks?sort_by=price" for i in range(6)
+    ] + ["/pharmacies/mask_count?min_price=5&max_price=7&count=2&op=gt"] * 4
+    _concurrent_requests(engine, urls[:1])
+
+    # every request finds the snapshot stale, and all of them share one load
+    revision_for(engine.url).bump()
+    responses = _concurrent_requests(engine, urls)
+    assert [response.status_code for response in responses] == [200] * len(urls)
+    assert [mask["name"] for mask in responses[3].json()["items"]] == [f"Mask 3-{j}" for j in range(4)]
+    assert len(responses[-1].json()["items"]) == 20
+
+def test_catalog_is_served_while_a_new_snapshot_builds(monkeypatch):
+    import asyncio
+    import sqlite3
+    import threading
+    from app.cache import response_cache
+    from app.catalog import CatalogSnapshot
+
+    engine = _seed_catalog_db(2)
+    url = "/pharmacies/Pharmacy 0/masks"
+    _concurrent_requests(engine, [url])
+    outside = sqlite3.connect(engine.url.database)
+    outside.execute("UPDATE masks SET price = price + 100 WHERE pharmacy_id = 1")
+    outside.commit()
+    outside.close()
+
+    started, release = threading.Event(), threading.Event()
+    build = CatalogSnapshot.build.__func__
+
+    def slow_build(cls, rows, previous=None):
+        started.set()
+        release.wait(10)
+        return build(cls, rows, previous)
+
+    monkeypatch.setattr(CatalogSnapshot, "build", classmethod(slow_build))
+
+    async def scenario(concurrent_client):
+        rebuilding = asyncio.ensure_future(concurrent_client.get(url))
+        while not started.is_set():
+            await asyncio.sleep(0.01)
+        # the loop still answers, from the snapshot being replaced
+        during = await concurrent_client.get(url)
+        # nor is that answer kept by the response cache
+        assert len(response_cache) == 0
+        release.set()
+        return [during, await rebuilding]
+
+    during, after = _run_against(engine, scenario)
+    assert [mask["price"] for mask in during.json()["items"]] == [5.0, 6.0, 7.0, 8.0]
+    assert [mask["price"] for mask in after.json()["items"]] == [105.0, 106.0, 107.0, 108.0]
+
+def test_migrate_upgrades_legacy_schema(tmp_path):
+    import sqlite3
+    from sqlalchemy import create_engine, inspect
+    from app.migrations import MIGRATIONS, migrate
+
+    path = tmp_path / "legacy.db"
+    legacy = sqlite3.connect(path)
+    legacy.executescript("""
+        CREATE TABLE pharmacies (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL UNIQUE, cash_balance FLOAT);
+        CREATE TABLE users (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, cash_balance FLOAT);
+        CREATE TABLE masks (id INTEGER PRIMARY KEY, name VARCHAR NOT NULL, price FLOAT NOT NULL, pharmacy_id INTEGER);
+        CREATE TABLE opening_hours (id INTEGER PRIMARY KEY, pharmacy_id INTEGER, day_of_week VARCHAR NOT NULL,
+                                    open_time TIME NOT NULL, close_time TIME NOT NULL);
+        CREATE TABLE purchase_histories (id INTEGER PRIMARY KEY, user_id INTEGER, pharmacy_id INTEGER,
+                                         mask_name VARCHAR NOT NULL, transaction_amount FLOAT NOT NULL,
+                                         transaction_date DATETIME NOT NULL);
+        INSERT INTO users VALUES (1, 'Test User', 10.0);
+        INSERT INTO masks VALUES (1, 'True Barrier (green) (3 per pack)', 13.7, 1);
+        INSERT INTO purchase_histories VALUES (1, 1, 1, 'Mask A', 5.5, '2021-01-01 10:00:00.000000');
+        -- an archived month, read-only, from before the histories lost their mask names
+        CREATE TABLE history_partitions (month DATE PRIMARY KEY, sealed_at DATETIME NOT NULL, compacted_at DATETIME);
+        INSERT INTO history_partitions VALUES ('2020-12-01', '2021-01-01 00:00:00.000000', NULL);
+        CREATE TABLE purchase_histories_202012 (id INTEGER PRIMARY KEY, user_id INTEGER, pharmacy_id INTEGER,
+                                                mask_name VARCHAR NOT NULL, product_id INTEGER,
+                                                transaction_amount FLOAT NOT NULL, transaction_date DATETIME NOT NULL);
+        INSERT INTO purchase_histories_202012 VALUES (0, 1, 1, 'Mask B', NULL, 2.5, '2020-12-01 10:00:00.000000');
+        CREATE TRIGGER purchase_histories_202012_read_only_update BEFORE UPDATE ON purchase_histories_202012
+        BEGIN SELECT RAISE(ABORT, 'purchase_histories_202012 is read-only'); END;
+    """)
+    legacy.close()
+
+    engine = create_engine(f"sqlite:///{path}")
+    migrate(engine)
+    migrate(engine)
+
+    inspector = inspect(engine)
+    assert "ix_purchase_histories_date_user_amount" in {i["name"] for i in inspector.get_indexes("purchase_histories")}
+    with engine.connect() as conn:
+        assert conn.exec_driver_sql("PRAGMA user_version").scalar() == len(MIGRATIONS)
+        assert conn.exec_driver_sql("SELECT * FROM purchase_daily_rollup").all() == [
+            ("2020-12-01", 1, 2.5), ("2021-01-01", 1, 5.5)
+        ]
+        assert conn.exec_driver_sql("SELECT * FROM products ORDER BY id").all() == [
+            (1, "Mask A", "Mask A", None, None), (2, "True Barrier (green) (3 per pack)", "True Barrier", "green", 3),
+            (3, "Mask B", "Mask B", None, None)
+        ]
+        assert conn.exec_driver_sql("SELECT product_id FROM masks").scalar() == 2
+        assert conn.exec_driver_sql("SELECT product_id FROM purchase_histories").scalar() == 1
+        # the archived month got its product before the names went, and is sealed again
+        assert conn.exec_driver_sql("SELECT product_id FROM purchase_histories_202012").scalar() == 3
+        assert conn.exec_driver_sql(
+            "SELECT count(*) FROM sqlite_master WHERE name LIKE 'purchase_histories_202012_read_only_%'"
+        ).scalar() == 3
+    for table in ("purchase_histories", "purchase_histories_202012"):
+        assert "mask_name" not in {column["name"] for column in inspector.get_columns(table)}
+    engine.dispose()
+
+# connection settings
+
+def test_sqlite_pragmas_applied_on_connect(tmp_path):
+    from sqlalchemy import create_engine, text
+    from sqlalchemy.exc import OperationalError
+    from app.database import SQLITE_PRAGMAS, apply_sqlite_pragmas
+
+    path = tmp_path / "pragmas.db"
+    writer = create_engine(f"sqlite:///{path}")
+    reader = create_engine(f"sqlite:///{path}")
+    apply_sqlite_pragmas(writer)
+    apply_sqlite_pragmas(reader, read_only=True)
+
+    with writer.begin() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1  # NORMAL
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == SQLITE_PRAGMAS["busy_timeout"]
+        conn.execute(text("CREATE TABLE t (x INTEGER)"))
+        conn.execute(text("INSERT INTO t VALUES (1)"))
+
+    with reader.connect() as conn:
+        assert conn.execute(text("SELECT x FROM t")).scalar() == 1
+        with pytest.raises(OperationalError):
+            conn.execute(text("INSERT INTO t VALUES (2)"))
+
+    writer.dispose()
+    reader.dispose()
+
+# response cache
+
+def test_response_cache_hits_and_revalidates():
+    from sqlalchemy.orm import sessionmaker
+    from app import models
+
+    engine = _seed_catalog_db(3)
+    url = "/pharmacies/mask_count?min_price=5&max_price=7&count=2&op=gt"
+
+    first_count, first = _request_with_statement_count(engine, "GET", url)
+    assert first_count > 0
+    # same parameters in another order: served from the cache without touching the database
+    cached_count, cached = _request_with_statement_count(
+        engine, "GET", "/pharmacies/mask_count?op=gt&count=2&max_price=7&min_price=5", clear_cache=False
+    )
+    assert cached_count == 0 and cached == first
+
+    etag = client.get(url).headers["etag"]
+    _, not_modified = _request_with_statement_count(engine, "GET", url, clear_cache=False, headers={"If-None-Match": etag})
+    assert not_modified.status_code == 304 and not_modified.content == b""
+
+    # a purchase moves the data revision on, so the next read is recomputed
+    db = sessionmaker(bind=engine)()
+    db.add(models.User(id=1, name="Test User", cash_balance=100.0))
+    db.commit()
+    mask = db.query(models.Mask).first()
+    body = {"user_id": 1, "purchases": [{"pharmacy_id": mask.pharmacy_id, "mask_id": mask.id, "quantity": 1}]}
+    db.close()
+    _request_with_statement_count(engine, "POST", "/purchase", clear_cache=False, json=body)
+    recomputed_count, recomputed = _request_with_statement_count(engine, "GET", url, clear_cache=False)
+    assert recomputed_count > 0 and recomputed == first
+
+def test_response_cache_evicts_least_recently_used():
+    from app.cache import ResponseCache
+
+    cache = ResponseCache(max_entries=2, max_bytes=10)
+    cache.put("a", (0,), "etag-a", b"application/json", b"1234")
+    cache.put("b", (0,), "etag-b", b"application/json", b"1234")
+    assert cache.get("a", (0,)) is not None
+    cache.put("c", (0,), "etag-c", b"application/json", b"1234")
+    assert cache.get("b", (0,)) is None
+    assert cache.get("a", (0,)) is not None and cache.get("c", (0,)) is not None
+    cache.put("d", (0,), "etag-d", b"application/json", b"12345678")
+    assert len(cache) == 1
+    assert cache.get("d", (1,)) is None and len(cache) == 0
+
+